@@ -0,0 +1,465 @@
+"""
+Single-writer room actors.
+
+Every active room in the process is owned by one ``RoomActor``: an asyncio
+task draining a bounded mailbox. Consumers and the turn timer only enqueue
+actions; the actor applies them one at a time against the room's in-memory
+board, dice and state log and broadcasts the resulting events. Actions on
+a room are therefore totally ordered without any database locking, and an
+action can await (broadcasts, finishing the game) without another action
+on the same room slipping in halfway.
+
+Rolls, moves and client seeds are rejected until the room is in progress,
+so a waiting room never starts its turn timer or logs a move.
+
+A full mailbox rejects new actions instead of queueing without bound.
+Mailbox depths are reported by ``stats`` on the health check.
+"""
+import asyncio
+import json
+import logging
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from .affinity import room_affinity
+from .chat import CHAT_MAX_LENGTH, chat_buffer
+from .dice import get_room_dice
+from .engine import COLORS, YARD, IllegalMove, LudoBoard, get_board, replace_board
+from .models import GameRoom, GamePlayer, RoomFairness
+from .move_buffer import move_buffer
+from .replay import FORFEIT, checkpoint_due, restore_board
+from .state_log import get_room_state
+from .turns import arm_turn_timer, broadcast_room, ensure_turn_timer, finish_room, release_room
+
+logger = logging.getLogger(__name__)
+
+MAILBOX_SIZE = 64
+
+# Rooms in these states are never played again
+FINISHED_STATUSES = ('completed', 'cancelled')
+
+
+@database_sync_to_async
+def load_game_state(room_id):
+    """Get current game state from database"""
+    try:
+        game_room = GameRoom.objects.get(room_id=room_id)
+        players = GamePlayer.objects.filter(
+            game_room=game_room
+        ).select_related('user')
+
+        return {
+            'id': game_room.pk,
+            'room_id': str(game_room.room_id),
+            'status': game_room.status,
+            'bet_amount': float(game_room.bet_amount),
+            'current_players': game_room.current_players,
+            'players': [
+                {
+                    'id': p.pk,
+                    'user_id': p.user_id,
+                    'username': p.user.username,
+                    'color': p.color,
+                    'position': p.position
+                } for p in players
+            ]
+        }
+    except GameRoom.DoesNotExist:
+        return None
+
+
+@database_sync_to_async
+def settle_game(room_pk, winner_player_pk):
+    """Complete the room and pay the winner; False when it was already settled"""
+    from .settlement import settle_room
+
+    game_room = GameRoom.objects.get(pk=room_pk)
+    winner_player = GamePlayer.objects.get(pk=winner_player_pk)
+    return settle_room(game_room, winner_player)
+
+
+@database_sync_to_async
+def save_fairness(room_pk, fairness):
+    """Keep the revealed dice seeds for the room's fairness endpoint"""
+    RoomFairness.objects.update_or_create(game_room_id=room_pk, defaults={
+        'server_seed': fairness['server_seed'],
+        'server_seed_hash': fairness['server_seed_hash'],
+        'client_seed': fairness['client_seed'],
+        'rolls': fairness['nonce'],
+    })
+
+
+class RoomActor:
+    """Owns the in-memory state of one room and applies its actions in order"""
+
+    # Play without the database: no restore, fairness record or settlement (load tests)
+    dry_run = False
+
+    def __init__(self, room_id, mailbox_size=MAILBOX_SIZE):
+        self.room_id = room_id
+        self.board = get_board(room_id)
+        self.dice = get_room_dice(room_id)
+        self.room_state = get_room_state(room_id)
+        self.mailbox = asyncio.Queue(maxsize=mailbox_size)
+        self.processed = 0
+        # Turns in a row each seat let expire
+        self.timeouts = [0] * len(COLORS)
+        self.stopped = False
+        self.ready = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def submit(self, action, *args):
+        """Queue ``action`` (a method name) with its arguments"""
+        if self.stopped:
+            raise IllegalMove('Game is over')
+        try:
+            self.mailbox.put_nowait((action, args))
+        except asyncio.QueueFull:
+            raise IllegalMove('Room is busy, try again') from None
+
+    async def _run(self):
+        try:
+            game_state = await self.game_state()
+        except Exception:
+            logger.exception('Room %s could not be loaded', self.room_id)
+            game_state = None
+        if game_state and game_state['status'] in FINISHED_STATUSES:
+            # Never replay a finished game on a fresh board and dice seed
+            self.stopped = True
+            release_room_actor(self.room_id, self)
+            release_room(self.room_id)
+        elif game_state and game_state['status'] == 'in_progress':
+            # The roster may have been cached before the actor started
+            self.seat_players(game_state)
+            if not self.dry_run:
+                try:
+                    await self._restore(game_state)
+                except Exception:
+                    logger.exception('Room %s could not be restored from its move log', self.room_id)
+        self.ready.set()
+
+        # Runs until the game is finished; actions still queued then are dropped
+        while not self.stopped:
+            action, args = await self.mailbox.get()
+            try:
+                await getattr(self, action)(*args)
+            except Exception:
+                logger.exception('Room %s failed to apply %s', self.room_id, action)
+            self.processed += 1
+
+    async def _restore(self, game_state):
+        """
+        Rebuild the board of a game already in progress (a restarted process,
+        or a room taken over from a worker that died), so new moves carry on
+        from the logged move numbers
+        """
+        board = await database_sync_to_async(restore_board)(game_state['id'])
+        if board.move_number:
+            self.board = board
+            replace_board(self.room_id, board)
+            logger.info('Room %s restored at move %d', self.room_id, board.move_number)
+
+    async def game_state(self):
+        """Roster of the room; cached once the game is running, so reconnects skip the DB"""
+        game_state = self.room_state.snapshot
+        if game_state is None:
+            game_state = await load_game_state(self.room_id)
+            if game_state and game_state['status'] == 'in_progress':
+                self.room_state.snapshot = game_state
+                self.seat_players(game_state)
+        return game_state
+
+    def seat_players(self, game_state):
+        """
+        Give turns to the roster's colours only, so a room with fewer than
+        four players has no empty seats to auto-play. Only before the first
+        roll; a restored board keeps its seats.
+        """
+        board = self.board
+        colors = [player['color'] for player in game_state['players']]
+        if board.move_number or self.dice.nonce or not colors:
+            return
+        self.board = LudoBoard(colors)
+        replace_board(self.room_id, self.board)
+
+    async def join(self, since=None, epoch=None):
+        """
+        Return the roster and the text frame for a connecting socket: the
+        events it missed when the log still covers ``since`` of ``epoch``,
+        otherwise the full game state.
+        """
+        await self.ready.wait()
+        game_state = await self.game_state()
+        if game_state and game_state['status'] == 'in_progress':
+            ensure_turn_timer(self.room_id)
+
+        room_state = self.room_state
+        if since is not None:
+            events = room_state.events_since(since, epoch)
+            if events is not None:
+                # Logged events are already JSON, splice them in as-is
+                return game_state, '{"type": "resume", "epoch": "%s", "version": %d, "events": [%s]}' % (
+                    room_state.epoch, room_state.version, ', '.join(events)
+                )
+
+        data = game_state
+        if game_state:
+            data = dict(
+                game_state,
+                board=self.board.snapshot(),
+                fairness=self.dice.commitment(),
+                chat=list(room_state.chat)
+            )
+        return game_state, json.dumps({
+            'type': 'game_state',
+            'epoch': room_state.epoch,
+            'version': room_state.version,
+            'data': data
+        })
+
+    async def started(self, sender):
+        """Whether the room is in progress; rejects the sender's action when not"""
+        game_state = await self.game_state()
+        if game_state and game_state['status'] == 'in_progress':
+            return True
+        await self.reject(sender, 'Game has not started')
+        return False
+
+    async def reject(self, sender, error):
+        try:
+            await sender.send_error(str(error))
+        except Exception:
+            # The sender may have disconnected while the action was queued
+            logger.debug('Could not send error to %s', sender.channel_name)
+
+    # Actions
+
+    async def roll(self, sender):
+        if not await self.started(sender):
+            return
+        # Only use up a roll of the committed stream when the roll is legal
+        try:
+            legal_moves = self.board.roll(sender.seat, self.dice.peek())
+        except IllegalMove as e:
+            await self.reject(sender, e)
+            return
+        dice_value, nonce = self.dice.roll()
+        self.timeouts[sender.seat] = 0
+        arm_turn_timer(self.room_id)
+
+        await broadcast_room(self.room_id, {
+            'type': 'dice_rolled',
+            'user': sender.scope['user'].username,
+            'color': sender.color,
+            'dice_value': dice_value,
+            'nonce': nonce,
+            'legal_moves': legal_moves
+        })
+
+    async def move(self, sender, piece_id):
+        if not await self.started(sender):
+            return
+        # Positions are computed by the engine, never taken from the client
+        dice_value = self.board.dice
+        try:
+            from_position, to_position, captured = self.board.move(sender.seat, piece_id)
+        except IllegalMove as e:
+            await self.reject(sender, e)
+            return
+        self.timeouts[sender.seat] = 0
+
+        self.save_move(sender.game_room_pk, sender.player_pk, piece_id,
+                       dice_value, from_position, to_position)
+        await broadcast_room(self.room_id, {
+            'type': 'piece_moved',
+            'user': sender.scope['user'].username,
+            'color': sender.color,
+            'piece_id': piece_id,
+            'from_position': from_position,
+            'to_position': to_position,
+            'captured': captured
+        })
+
+        if self.board.winner is not None:
+            await self.finish(sender.scope['user'].username)
+        else:
+            arm_turn_timer(self.room_id)
+
+    async def chat(self, sender, message):
+        user = sender.scope['user']
+        message = message.strip()[:CHAT_MAX_LENGTH]
+        sent_at = timezone.now()
+        entry = {
+            'user': user.username,
+            'message': message,
+            'sent_at': sent_at.isoformat()
+        }
+        self.room_state.chat.append(entry)
+        if sender.game_room_pk is not None:
+            chat_buffer.add(sender.game_room_pk, user.id, message, sent_at)
+
+        await broadcast_room(self.room_id, {'type': 'chat_message', **entry})
+
+    async def client_seed(self, sender, seed):
+        if not await self.started(sender):
+            return
+        try:
+            self.dice.set_client_seed(sender.color, seed)
+        except IllegalMove as e:
+            await self.reject(sender, e)
+            return
+
+        await broadcast_room(self.room_id, {
+            'type': 'client_seed_set',
+            'color': sender.color,
+            'client_seed': self.dice.client_seed
+        })
+
+    async def timeout(self):
+        """
+        Play the expired turn on behalf of the player: roll if they have
+        not, then move the first legal piece. A seat that lets
+        ``TURN_TIMEOUT_FORFEIT`` turns in a row expire forfeits the game,
+        so abandoned rooms end instead of auto-playing forever.
+        """
+        board = self.board
+        if board.winner is not None:
+            return
+
+        seat = board.turn
+        color = COLORS[seat]
+        player = self.player(seat)
+        username = player['username'] if player else None
+
+        self.timeouts[seat] += 1
+        if self.timeouts[seat] >= settings.TURN_TIMEOUT_FORFEIT:
+            board.remove_seat(seat)
+            if player:
+                # Logged so a replay takes the seat out of the turn order too
+                self.save_move(self.room_state.snapshot['id'], player['id'], 0,
+                               FORFEIT, YARD, YARD)
+            await broadcast_room(self.room_id, {
+                'type': 'player_forfeited',
+                'user': username,
+                'color': color
+            })
+            if board.winner is not None:
+                await self.finish(self.username(board.winner))
+            else:
+                arm_turn_timer(self.room_id)
+            return
+
+        if not board.dice:
+            legal_moves = board.roll(seat, self.dice.peek())
+            dice_value, nonce = self.dice.roll()
+            await broadcast_room(self.room_id, {
+                'type': 'dice_rolled',
+                'user': username,
+                'color': color,
+                'dice_value': dice_value,
+                'nonce': nonce,
+                'legal_moves': legal_moves,
+                'auto': True
+            })
+
+        if board.dice:
+            dice_value = board.dice
+            piece_id = board.legal_moves(seat, dice_value)[0]
+            from_position, to_position, captured = board.move(seat, piece_id)
+            if player:
+                self.save_move(self.room_state.snapshot['id'], player['id'], piece_id,
+                               dice_value, from_position, to_position)
+            await broadcast_room(self.room_id, {
+                'type': 'piece_moved',
+                'user': username,
+                'color': color,
+                'piece_id': piece_id,
+                'from_position': from_position,
+                'to_position': to_position,
+                'captured': captured,
+                'auto': True
+            })
+            if board.winner is not None:
+                await self.finish(username)
+                return
+
+        arm_turn_timer(self.room_id)
+
+    def player(self, seat):
+        """Roster entry of the player in ``seat``, when the roster is loaded"""
+        game_state = self.room_state.snapshot
+        if not game_state:
+            return None
+        color = COLORS[seat]
+        return next((p for p in game_state['players'] if p['color'] == color), None)
+
+    def username(self, seat):
+        player = self.player(seat)
+        return player['username'] if player else None
+
+    async def finish(self, winner):
+        self.stopped = True
+        # Settle before letting go of the room: a room still in progress in
+        # the database would be restarted from scratch by the next connect
+        player = self.player(self.board.winner)
+        if player is not None and not self.dry_run:
+            try:
+                await save_fairness(self.room_state.snapshot['id'], self.dice.reveal())
+            except Exception:
+                logger.exception('Dice seeds of room %s could not be saved', self.room_id)
+            try:
+                await settle_game(self.room_state.snapshot['id'], player['id'])
+            except Exception:
+                # Keep the stopped actor so the room is not replayed
+                logger.exception('Room %s could not be settled', self.room_id)
+                await finish_room(self.room_id, winner)
+                return
+        release_room_actor(self.room_id, self)
+        await finish_room(self.room_id, winner)
+        await room_affinity.release(self.room_id)
+
+    def save_move(self, game_room_pk, player_pk, piece_id, dice_value,
+                  from_position, to_position):
+        """Queue move for a batched write to the database"""
+        move_number = self.board.move_number
+        move_buffer.add(
+            game_room_pk, player_pk, dice_value, piece_id,
+            from_position, to_position, move_number
+        )
+        if checkpoint_due(move_number):
+            move_buffer.add_checkpoint(game_room_pk, move_number, self.board.to_bytes())
+
+
+# Actors of the rooms active in this process
+_actors = {}
+
+
+def get_room_actor(room_id):
+    """Return the actor of ``room_id``, starting it on first use"""
+    actor = _actors.get(room_id)
+    if actor is None:
+        actor = _actors[room_id] = RoomActor(room_id)
+    return actor
+
+
+def has_room_actor(room_id):
+    return room_id in _actors
+
+
+def release_room_actor(room_id, actor=None):
+    """Deregister the actor of ``room_id`` (only if it is still ``actor``, when given)"""
+    if actor is None or _actors.get(room_id) is actor:
+        return _actors.pop(room_id, None)
+    return None
+
+
+def stats():
+    depths = [actor.mailbox.qsize() for actor in _actors.values()]
+    return {
+        'rooms': len(depths),
+        'mailbox_depth': sum(depths),
+        'max_mailbox_depth': max(depths, default=0),
+        'processed': sum(actor.processed for actor in _actors.values()),
+    }
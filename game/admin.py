@@ -1,10 +1,10 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.utils.html import format_html
-from users.models import User, UserActivity
+from users.models import User, UserActivity, LedgerAccount, LedgerEntry, BalanceSnapshot
 from .models import (
-    GameRoom, GamePlayer, GameMove, Transaction,
-    Tournament, TournamentParticipant, PlatformSettings
+    GameRoom, GamePlayer, GameMove, ChatMessage, Transaction, RoomFairness,
+    PayoutBatch, Tournament, TournamentParticipant, PlatformSettings
 )
 
 # User Admin
@@ -16,6 +16,9 @@ class UserAdmin(BaseUserAdmin):
     search_fields = ['username', 'email', 'phone_number']
     ordering = ['-created_at']
     
+    # Balances only change through ledger entries
+    readonly_fields = ['wallet_balance']
+    
     fieldsets = BaseUserAdmin.fieldsets + (
         ('Wallet Info', {'fields': ('wallet_balance', 'usdt_address')}),
         ('Game Stats', {'fields': ('total_games_played', 'total_games_won', 
@@ -83,6 +86,29 @@ class GameMoveAdmin(admin.ModelAdmin):
     readonly_fields = ['timestamp']
 
 
+# Room Fairness Admin
+@admin.register(RoomFairness)
+class RoomFairnessAdmin(admin.ModelAdmin):
+    list_display = ['game_room', 'server_seed_hash', 'rolls', 'created_at']
+    search_fields = ['game_room__room_id', 'server_seed_hash']
+    readonly_fields = ['game_room', 'server_seed', 'server_seed_hash', 'client_seed', 'rolls', 'created_at']
+    
+    def has_add_permission(self, request):
+        return False
+
+
+# Chat Message Admin
+@admin.register(ChatMessage)
+class ChatMessageAdmin(admin.ModelAdmin):
+    list_display = ['game_room', 'user', 'message', 'created_at']
+    list_filter = ['created_at']
+    search_fields = ['game_room__room_id', 'user__username', 'message']
+    readonly_fields = ['game_room', 'user', 'message', 'created_at']
+    
+    def has_add_permission(self, request):
+        return False
+
+
 # Transaction Admin
 @admin.register(Transaction)
 class TransactionAdmin(admin.ModelAdmin):
@@ -98,6 +124,54 @@ class TransactionAdmin(admin.ModelAdmin):
     amount_display.short_description = 'Amount'
 
 
+# Payout Batch Admin
+@admin.register(PayoutBatch)
+class PayoutBatchAdmin(admin.ModelAdmin):
+    list_display = ['nonce', 'tx_hash', 'created_at']
+    search_fields = ['tx_hash']
+    readonly_fields = ['tx_hash', 'nonce', 'raw_transaction', 'created_at']
+    
+    def has_add_permission(self, request):
+        return False
+
+
+# Ledger Admin (append-only)
+@admin.register(LedgerEntry)
+class LedgerEntryAdmin(admin.ModelAdmin):
+    list_display = ['created_at', 'debit_account', 'credit_account', 'amount', 
+                    'entry_type', 'reference']
+    list_filter = ['entry_type', 'created_at']
+    search_fields = ['debit_account', 'credit_account', 'reference']
+    readonly_fields = ['debit_account', 'credit_account', 'amount', 'entry_type', 
+                       'reference', 'description', 'created_at']
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(LedgerAccount)
+class LedgerAccountAdmin(admin.ModelAdmin):
+    list_display = ['code', 'balance', 'updated_at']
+    readonly_fields = ['code', 'balance', 'updated_at']
+    
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(BalanceSnapshot)
+class BalanceSnapshotAdmin(admin.ModelAdmin):
+    list_display = ['account', 'balance', 'cutoff']
+    list_filter = ['cutoff']
+    search_fields = ['account']
+    readonly_fields = ['account', 'balance', 'cutoff', 'created_at']
+    
+    def has_add_permission(self, request):
+        return False
+
+
 # Tournament Admin
 @admin.register(Tournament)
 class TournamentAdmin(admin.ModelAdmin):
@@ -0,0 +1,322 @@
+"""
+Room-to-worker affinity for multi-process deployments.
+
+Each ASGI worker registers itself in Redis with a heartbeat and the name of
+a channel it listens on. The live workers form a consistent-hash ring with
+``RING_REPLICAS`` virtual nodes per worker, and a room belongs to the first
+worker clockwise from the hash of its ``room_id``. That owner runs the
+room's actor. Sockets that land on any other worker forward their join and
+their actions to the owner over the channel layer. Broadcasts already reach
+every worker through the room group.
+
+Ownership is sticky: the worker that starts a room claims it in Redis, and
+keeps it for as long as it stays alive, so a joining worker only takes new
+rooms. When a worker stops heartbeating, its rooms fall to their ring
+owners, which rebuild each board from the move log (``replay.restore_board``)
+before applying anything. A claim only replaces a missing or dead owner,
+checked in one script (``CLAIM_LUA``), so two workers whose rings disagree
+for a moment still agree on the winner, and the loser forwards to it.
+
+Disabled by default (``ROOM_AFFINITY``); a single worker owns every room
+without touching Redis.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import socket
+import time
+from bisect import bisect
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .engine import IllegalMove
+from .local_redis import LocalRedis
+
+logger = logging.getLogger(__name__)
+
+WORKERS_KEY = 'affinity:workers'
+CHANNELS_KEY = 'affinity:channels'
+OWNERS_KEY = 'affinity:owners'
+RING_REPLICAS = 64
+JOIN_TIMEOUT = 5
+
+# Claim KEYS[1][ARGV[1]] for ARGV[2] unless a worker that heartbeated since
+# ARGV[3] holds it; returns the owner either way
+CLAIM_LUA = """
+    local owner = redis.call('HGET', KEYS[1], ARGV[1])
+    if owner then
+        local seen = redis.call('ZSCORE', KEYS[2], owner)
+        if seen and tonumber(seen) >= tonumber(ARGV[3]) then
+            return owner
+        end
+    end
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+    return ARGV[2]
+"""
+
+
+@LocalRedis.script(CLAIM_LUA)
+def _claim_local(redis, keys, args):
+    owners, workers = keys
+    room_id, worker_id, oldest = args
+    owner = redis.hget(owners, room_id)
+    if owner is not None:
+        seen = redis.zscore(workers, owner)
+        if seen is not None and seen >= float(oldest):
+            return owner
+    redis.hset(owners, room_id, worker_id)
+    return worker_id
+
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent-hash ring over worker ids"""
+
+    def __init__(self, nodes=(), replicas=RING_REPLICAS):
+        points = sorted(
+            (ring_hash(f'{node}#{i}'), node)
+            for node in nodes for i in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def owner(self, key):
+        if not self._nodes:
+            return None
+        return self._nodes[bisect(self._hashes, ring_hash(key)) % len(self._nodes)]
+
+
+_redis = None
+
+
+def get_redis():
+    global _redis
+    if _redis is None:
+        import redis
+        _redis = redis.Redis.from_url(
+            settings.AFFINITY_REDIS_URL, decode_responses=True
+        )
+    return _redis
+
+
+class RemoteSender:
+    """Stands in for a consumer on another worker when its action reaches the actor"""
+
+    def __init__(self, info):
+        self.channel_name = info['channel_name']
+        self.seat = info['seat']
+        self.color = info['color']
+        self.game_room_pk = info['game_room_pk']
+        self.player_pk = info['player_pk']
+        self.scope = {'user': _RemoteUser(info['user_id'], info['username'])}
+
+    async def send_error(self, message):
+        await get_channel_layer().send(self.channel_name, {
+            'type': 'room.error',
+            'message': message
+        })
+
+
+class _RemoteUser:
+    __slots__ = ('id', 'username')
+    is_authenticated = True
+
+    def __init__(self, user_id, username):
+        self.id = user_id
+        self.username = username
+
+
+class RoomAffinity:
+    """This worker's membership in the ring and its forwarding endpoint"""
+
+    def __init__(self, redis=None, heartbeat=5.0, ttl=15.0):
+        self._redis = redis
+        self.heartbeat = heartbeat
+        self.ttl = ttl
+        self.worker_id = None
+        self.channel_name = None
+        self.members = {}
+        self.ring = HashRing()
+        # Bumped whenever membership changes, so consumers re-resolve owners
+        self.version = 0
+        self._started = None
+        self._joins = set()
+
+    @property
+    def enabled(self):
+        return settings.ROOM_AFFINITY
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            self._redis = get_redis()
+        return self._redis
+
+    async def start(self):
+        """Register this worker and start listening; safe to call on every connect"""
+        if not self.enabled:
+            return
+        if self._started is None:
+            self._started = asyncio.ensure_future(self._start())
+        await asyncio.shield(self._started)
+
+    async def _start(self):
+        self.worker_id = settings.WORKER_ID or f'{socket.gethostname()}-{os.getpid()}'
+        self.channel_name = await get_channel_layer().new_channel('room_owner.')
+        await sync_to_async(self.refresh, thread_sensitive=False)()
+        loop = asyncio.get_running_loop()
+        loop.create_task(self._heartbeat_loop())
+        loop.create_task(self._listen())
+        logger.info('Worker %s joined the room ring (%d workers)', self.worker_id, len(self.members))
+
+    def refresh(self):
+        """Heartbeat, drop dead workers and rebuild the ring if membership changed"""
+        now = time.time()
+        with self.redis.pipeline(transaction=False) as pipe:
+            pipe.zadd(WORKERS_KEY, {self.worker_id: now})
+            pipe.hset(CHANNELS_KEY, self.worker_id, self.channel_name)
+            pipe.zremrangebyscore(WORKERS_KEY, 0, now - self.ttl)
+            pipe.zrangebyscore(WORKERS_KEY, now - self.ttl, '+inf')
+            pipe.hgetall(CHANNELS_KEY)
+            *_, live, channels = pipe.execute()
+
+        members = {worker: channels[worker] for worker in live if worker in channels}
+        if members.keys() != self.members.keys():
+            dead = [worker for worker in channels if worker not in members]
+            if dead:
+                self.redis.hdel(CHANNELS_KEY, *dead)
+            self.members = members
+            self.ring = HashRing(members)
+            self.version += 1
+            logger.info('Room ring now has %d workers', len(members))
+
+    def resolve_sync(self, room_id):
+        """Return the channel of the owner of ``room_id``, or None when it is this worker"""
+        claim = self.redis.hget(OWNERS_KEY, room_id)
+        if claim in self.members:
+            owner = claim
+        else:
+            # Unclaimed, or claimed by a worker that has died
+            owner = self.ring.owner(room_id) or self.worker_id
+            if owner == self.worker_id:
+                owner = self.claim(room_id)
+        if owner == self.worker_id:
+            return None
+        return self.channel_of(owner)
+
+    def claim(self, room_id):
+        """Claim ``room_id`` unless a live worker owns it; returns the owner"""
+        return self.redis.eval(
+            CLAIM_LUA, 2, OWNERS_KEY, WORKERS_KEY,
+            room_id, self.worker_id, time.time() - self.ttl
+        )
+
+    def channel_of(self, worker):
+        if worker not in self.members:
+            # A worker that joined since our last heartbeat
+            self.refresh()
+        return self.members[worker]
+
+    async def resolve(self, room_id):
+        if not self.enabled:
+            return None
+        return await sync_to_async(self.resolve_sync, thread_sensitive=False)(room_id)
+
+    async def release(self, room_id):
+        """Drop this worker's claim on a finished room"""
+        if self.enabled:
+            await sync_to_async(self.redis.hdel, thread_sensitive=False)(OWNERS_KEY, room_id)
+
+    async def request_join(self, owner_channel, room_id, since, epoch):
+        """Ask the owner for the roster and the connect payload of a room"""
+        channel_layer = get_channel_layer()
+        reply_channel = await channel_layer.new_channel('room_join.')
+        await channel_layer.send(owner_channel, {
+            'type': 'room.join',
+            'room_id': room_id,
+            'since': since,
+            'epoch': epoch,
+            'reply_channel': reply_channel
+        })
+        reply = await asyncio.wait_for(channel_layer.receive(reply_channel), JOIN_TIMEOUT)
+        return reply['game_state'], reply['text']
+
+    async def forward(self, owner_channel, room_id, action, args, sender_info):
+        await get_channel_layer().send(owner_channel, {
+            'type': 'room.action',
+            'room_id': room_id,
+            'action': action,
+            'args': list(args),
+            'sender': sender_info
+        })
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            try:
+                await sync_to_async(self.refresh, thread_sensitive=False)()
+            except Exception:
+                logger.exception('Room ring heartbeat failed')
+
+    async def _listen(self):
+        channel_layer = get_channel_layer()
+        while True:
+            message = await channel_layer.receive(self.channel_name)
+            if message['type'] == 'room.join':
+                # A join waits for its room to load; keep the actions of
+                # other rooms flowing meanwhile
+                task = asyncio.ensure_future(self._handle(channel_layer, message))
+                self._joins.add(task)
+                task.add_done_callback(self._joins.discard)
+            else:
+                # Inline, so actions reach each room in the order they came
+                await self._handle(channel_layer, message)
+
+    async def _handle(self, channel_layer, message):
+        try:
+            await self._dispatch(channel_layer, message)
+        except Exception:
+            logger.exception('Failed to handle forwarded %s', message.get('type'))
+
+    async def _dispatch(self, channel_layer, message):
+        from .actors import get_room_actor, has_room_actor
+
+        room_id = message['room_id']
+        if not has_room_actor(room_id):
+            # First contact: a worker resolved this room to us
+            owner = await sync_to_async(self.claim, thread_sensitive=False)(room_id)
+            if owner != self.worker_id:
+                # Another live worker won the room; pass the message on
+                channel = await sync_to_async(self.channel_of, thread_sensitive=False)(owner)
+                await channel_layer.send(channel, message)
+                return
+        actor = get_room_actor(room_id)
+        if message['type'] == 'room.action':
+            sender = RemoteSender(message['sender'])
+            try:
+                actor.submit(message['action'], sender, *message['args'])
+            except IllegalMove as e:
+                await sender.send_error(str(e))
+        elif message['type'] == 'room.join':
+            game_state, text = await actor.join(message['since'], message.get('epoch'))
+            await channel_layer.send(message['reply_channel'], {
+                'type': 'room.joined',
+                'game_state': game_state,
+                'text': text
+            })
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'worker_id': self.worker_id,
+            'workers': len(self.members),
+        }
+
+
+room_affinity = RoomAffinity()
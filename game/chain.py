@@ -0,0 +1,200 @@
+"""
+Clients that send USDT payouts on chain.
+
+A client signs one batch of ``(address, amount)`` payouts as a single
+transaction from the platform wallet. Sending many transfers in one
+transaction costs the base gas once per batch rather than once per
+withdrawal. ``WITHDRAWAL_CHAIN_CLIENT`` names the class to use:
+
+    game.chain.Web3ChainClient      ERC-20 payouts through a disperse
+                                    contract at ``USDT_DISPERSE_ADDRESS``
+    game.chain.InMemoryChainClient  no network; records batches and credits
+                                    in-memory balances, for tests and
+                                    local development
+
+``sign_batch(payouts, nonce)`` returns the hash and the raw signed
+transaction, and ``broadcast`` sends the raw transaction. The caller keeps
+both along with the nonce, so a transaction can only ever be sent again
+as itself. Two transactions with the same nonce cannot both be mined, so
+a payout cannot go out twice. ``receipt_status(tx_hash, nonce)`` says what
+became of a transaction:
+
+    CONFIRMED  mined with status 1 and ``WITHDRAWAL_CONFIRMATIONS`` deep
+    FAILED     mined but reverted; nothing was paid
+    PENDING    waiting in the mempool, or mined but not deep enough
+    MISSING    unknown to the node, but its nonce is still unused, so it
+               can still be mined; broadcast it again
+    DROPPED    another transaction used its nonce ``WITHDRAWAL_CONFIRMATIONS``
+               blocks deep, so it will never be mined
+
+A node that does not know a hash only means MISSING: a load-balanced RPC,
+a lagging node or a restarted mempool can hide a transaction that is
+still mined later.
+"""
+import json
+import hashlib
+from decimal import Decimal
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+USDT_DECIMALS = 6
+
+CONFIRMED = 'confirmed'
+FAILED = 'failed'
+PENDING = 'pending'
+MISSING = 'missing'
+DROPPED = 'dropped'
+
+# disperseToken(token, recipients, values), as in the Disperse contract
+DISPERSE_ABI = [{
+    'name': 'disperseToken',
+    'type': 'function',
+    'stateMutability': 'nonpayable',
+    'inputs': [
+        {'name': 'token', 'type': 'address'},
+        {'name': 'recipients', 'type': 'address[]'},
+        {'name': 'values', 'type': 'uint256[]'},
+    ],
+    'outputs': [],
+}]
+
+
+class ChainError(Exception):
+    """A batch could not be broadcast; nothing was sent"""
+
+
+def to_base_units(amount):
+    return int(Decimal(amount).scaleb(USDT_DECIMALS))
+
+
+class InMemoryChainClient:
+    """
+    Chain stand-in that settles batches in memory. A broadcast batch is
+    mined at once, or waits in ``mempool`` until :meth:`mine` while ``hold``
+    is set. :meth:`forget` drops one from the mempool, as a restarted node
+    would. Set ``outcomes[tx_hash]`` to make a mined batch report FAILED or
+    PENDING.
+    """
+
+    def __init__(self):
+        # Mined batches, (tx_hash, payouts)
+        self.batches = []
+        self.balances = {}
+        self.outcomes = {}
+        self.fail_next = 0
+        self.hold = False
+        # tx_hash -> (nonce, payouts) of broadcast batches not mined yet
+        self.mempool = {}
+        # nonce -> hash of the transaction mined with it
+        self.mined = {}
+
+    def next_nonce(self):
+        used = list(self.mined) + [nonce for nonce, _ in self.mempool.values()]
+        return max(used, default=-1) + 1
+
+    def sign_batch(self, payouts, nonce):
+        if self.fail_next:
+            self.fail_next -= 1
+            raise ChainError('Simulated signing failure')
+        raw = json.dumps({'nonce': nonce, 'payouts': [[address, str(amount)] for address, amount in payouts]})
+        return self._hash(raw), raw
+
+    def broadcast(self, raw_transaction):
+        tx = json.loads(raw_transaction)
+        if tx['nonce'] in self.mined:
+            raise ChainError('Nonce too low')
+        tx_hash = self._hash(raw_transaction)
+        self.mempool[tx_hash] = (tx['nonce'], [(address, Decimal(amount)) for address, amount in tx['payouts']])
+        if not self.hold:
+            self.mine(tx_hash)
+
+    def mine(self, tx_hash):
+        nonce, payouts = self.mempool.pop(tx_hash)
+        if nonce in self.mined:
+            return
+        self.mined[nonce] = tx_hash
+        for address, amount in payouts:
+            self.balances[address] = self.balances.get(address, Decimal('0')) + amount
+        self.batches.append((tx_hash, payouts))
+
+    def forget(self, tx_hash):
+        self.mempool.pop(tx_hash, None)
+
+    def receipt_status(self, tx_hash, nonce):
+        if self.mined.get(nonce) == tx_hash:
+            return self.outcomes.get(tx_hash, CONFIRMED)
+        if nonce in self.mined:
+            return DROPPED
+        return PENDING if tx_hash in self.mempool else MISSING
+
+    def _hash(self, raw_transaction):
+        return '0x' + hashlib.sha256(raw_transaction.encode()).hexdigest()
+
+
+class Web3ChainClient:
+    """Pays a batch from the platform wallet with one ``disperseToken`` call"""
+
+    def __init__(self):
+        from web3 import Web3
+        self.web3 = Web3(Web3.HTTPProvider(settings.ETHEREUM_NODE_URL))
+        self.account = self.web3.eth.account.from_key(settings.PLATFORM_WALLET_PRIVATE_KEY)
+        self.token = Web3.to_checksum_address(settings.USDT_CONTRACT_ADDRESS)
+        self.disperse = self.web3.eth.contract(
+            address=Web3.to_checksum_address(settings.USDT_DISPERSE_ADDRESS), abi=DISPERSE_ABI
+        )
+
+    def next_nonce(self):
+        try:
+            return self.web3.eth.get_transaction_count(self.account.address, 'pending')
+        except Exception as e:
+            raise ChainError(f'Could not read the wallet nonce: {e}') from e
+
+    def sign_batch(self, payouts, nonce):
+        from web3 import Web3
+        recipients = [Web3.to_checksum_address(address) for address, _ in payouts]
+        values = [to_base_units(amount) for _, amount in payouts]
+        try:
+            tx = self.disperse.functions.disperseToken(self.token, recipients, values).build_transaction({
+                'from': self.account.address,
+                'nonce': nonce,
+            })
+            signed = self.account.sign_transaction(tx)
+        except Exception as e:
+            raise ChainError(f'Could not build payout batch: {e}') from e
+        return signed.hash.hex(), signed.rawTransaction.hex()
+
+    def broadcast(self, raw_transaction):
+        self.web3.eth.send_raw_transaction(raw_transaction)
+
+    def receipt_status(self, tx_hash, nonce):
+        from web3.exceptions import TransactionNotFound
+        try:
+            receipt = self.web3.eth.get_transaction_receipt(tx_hash)
+        except TransactionNotFound:
+            # Only a nonce used deep enough not to be reorganised away rules
+            # the transaction out; a node not knowing the hash does not
+            final_block = self.web3.eth.block_number - settings.WITHDRAWAL_CONFIRMATIONS + 1
+            if final_block >= 0 and self.web3.eth.get_transaction_count(
+                    self.account.address, final_block) > nonce:
+                return DROPPED
+            try:
+                self.web3.eth.get_transaction(tx_hash)
+            except TransactionNotFound:
+                return MISSING
+            return PENDING
+        if receipt['status'] != 1:
+            return FAILED
+        depth = self.web3.eth.block_number - receipt['blockNumber'] + 1
+        return CONFIRMED if depth >= settings.WITHDRAWAL_CONFIRMATIONS else PENDING
+
+
+_client = None
+
+
+def get_chain_client():
+    """The ``WITHDRAWAL_CHAIN_CLIENT`` instance shared by the process"""
+    global _client
+    if _client is None:
+        _client = import_string(settings.WITHDRAWAL_CHAIN_CLIENT)()
+    return _client
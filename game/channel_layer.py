@@ -0,0 +1,208 @@
+"""
+Redis channel layer that pipelines the sends of one event-loop tick.
+
+``RedisChannelLayer`` makes about four Redis round trips per ``group_send``
+(expire old members, read members, expire old messages, push) and four
+per ``send``. A dice roll, the move after it and the lobby update each
+paid that separately, even though they are issued by many rooms at once.
+
+``BatchedRedisChannelLayer`` queues every ``send`` and ``group_send``
+made during one tick of the event loop and flushes them together: one
+pipeline reads the members of all groups involved, and one pipeline per
+Redis host expires old messages and pushes every message. That is two
+round trips per tick, however many sends it contains. Each caller still
+awaits its own send, so errors such as ``ChannelFull`` reach the right
+sender and messages to a channel keep their order.
+
+Enable it in ``CHANNEL_LAYERS``::
+
+    'BACKEND': 'game.channel_layer.BatchedRedisChannelLayer'
+"""
+import asyncio
+import logging
+import time
+from collections import defaultdict
+
+from channels.exceptions import ChannelFull
+from channels_redis.core import RedisChannelLayer
+
+logger = logging.getLogger(__name__)
+
+# Same script RedisChannelLayer.group_send runs: push to every key that is
+# under capacity and return how many were not
+PUSH_LUA = """
+    local over_capacity = 0
+    local current_time = ARGV[#ARGV - 1]
+    local expiry = ARGV[#ARGV]
+    for i=1,#KEYS do
+        if redis.call('ZCOUNT', KEYS[i], '-inf', '+inf') < tonumber(ARGV[i + #KEYS]) then
+            redis.call('ZADD', KEYS[i], current_time, ARGV[i])
+            redis.call('EXPIRE', KEYS[i], expiry)
+        else
+            over_capacity = over_capacity + 1
+        end
+    end
+    return over_capacity
+"""
+SCORE_STEP = 1e-6
+
+
+class _Send:
+    """One queued ``send`` or ``group_send`` and the future its caller awaits"""
+
+    __slots__ = ('group', 'message', 'future', 'pushes', 'over_capacity')
+
+    def __init__(self, group, message, future):
+        self.group = group
+        self.message = message
+        self.future = future
+        # Connection index -> [(channel keys, serialized messages, capacities)]
+        self.pushes = {}
+        self.over_capacity = 0
+
+
+class BatchedRedisChannelLayer(RedisChannelLayer):
+    """RedisChannelLayer whose sends are flushed once per event-loop tick"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Sends waiting for the next flush, and the latest flush, per event loop
+        self._batches = {}
+        self._flushes = {}
+        self._last_score = 0.0
+        self.batch_stats = {'sends': 0, 'flushes': 0, 'round_trips': 0}
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        assert "__asgi_channel__" not in message
+        channel_non_local_name = channel
+        if "!" in channel:
+            message = dict(message.items())
+            message["__asgi_channel__"] = channel
+            channel_non_local_name = self.non_local_name(channel)
+            index = self.consistent_hash(channel)
+        else:
+            index = next(self._send_index_generator)
+
+        pending = self._queue(None, message)
+        pending.pushes[index] = [(
+            [self.prefix + channel_non_local_name],
+            [self.serialize(message)],
+            [self.get_capacity(channel)],
+        )]
+        await pending.future
+        if pending.over_capacity:
+            raise ChannelFull()
+
+    async def group_send(self, group, message):
+        assert self.valid_group_name(group), "Group name not valid"
+        pending = self._queue(group, message)
+        await pending.future
+        if pending.over_capacity:
+            logger.info(
+                "%s channels over capacity in group %s", pending.over_capacity, group
+            )
+
+    def _queue(self, group, message):
+        loop = asyncio.get_running_loop()
+        batch = self._batches.get(loop)
+        if batch is None:
+            batch = self._batches[loop] = []
+            # The task's first step runs after everything already scheduled
+            # for this tick, so their sends join the batch
+            previous = self._flushes.get(loop)
+            self._flushes[loop] = loop.create_task(self._flush(loop, previous))
+        pending = _Send(group, message, loop.create_future())
+        batch.append(pending)
+        return pending
+
+    async def _flush(self, loop, previous):
+        # One flush at a time, so a later batch cannot overtake an earlier one;
+        # sends keep joining this batch until the previous flush is done
+        if previous is not None:
+            await previous
+        batch = self._batches.pop(loop)
+        try:
+            await self._flush_batch(batch)
+        except Exception as e:
+            for pending in batch:
+                if not pending.future.done():
+                    pending.future.set_exception(e)
+        else:
+            for pending in batch:
+                if not pending.future.done():
+                    pending.future.set_result(None)
+        if self._flushes.get(loop) is asyncio.current_task():
+            del self._flushes[loop]
+
+    async def _flush_batch(self, batch):
+        self.batch_stats['sends'] += len(batch)
+        self.batch_stats['flushes'] += 1
+
+        # Round trip 1: members of every group in the batch
+        group_sends = defaultdict(list)
+        for pending in batch:
+            if pending.group is not None:
+                group_sends[self.consistent_hash(pending.group)].append(pending)
+        if group_sends:
+            await asyncio.gather(*(
+                self._read_groups(index, sends) for index, sends in group_sends.items()
+            ))
+
+        # Round trip 2: expire old messages and push, per host
+        pushes = defaultdict(list)
+        for pending in batch:
+            for index, chunks in pending.pushes.items():
+                pushes[index].extend((pending, chunk) for chunk in chunks)
+        await asyncio.gather(*(
+            self._push(index, chunks) for index, chunks in pushes.items()
+        ))
+
+    async def _read_groups(self, index, sends):
+        pipe = self.connection(index).pipeline(transaction=False)
+        expired = int(time.time()) - self.group_expiry
+        for pending in sends:
+            key = self._group_key(pending.group)
+            pipe.zremrangebyscore(key, min=0, max=expired)
+            pipe.zrange(key, 0, -1)
+        results = await pipe.execute()
+        self.batch_stats['round_trips'] += 1
+
+        for pending, members in zip(sends, results[1::2]):
+            channel_names = [x.decode("utf8") for x in members]
+            (
+                connection_to_channel_keys,
+                channel_keys_to_message,
+                channel_keys_to_capacity,
+            ) = self._map_channel_keys_to_connection(channel_names, pending.message)
+            for connection_index, channel_keys in connection_to_channel_keys.items():
+                pending.pushes.setdefault(connection_index, []).append((
+                    channel_keys,
+                    [channel_keys_to_message[key] for key in channel_keys],
+                    [channel_keys_to_capacity[key] for key in channel_keys],
+                ))
+
+    async def _push(self, index, chunks):
+        pipe = self.connection(index).pipeline(transaction=False)
+        now = time.time()
+        expired = int(now) - int(self.expiry)
+        seen = set()
+        for _, (channel_keys, _, _) in chunks:
+            for key in channel_keys:
+                if key not in seen:
+                    seen.add(key)
+                    pipe.zremrangebyscore(key, min=0, max=expired)
+        # Channels are sorted sets ordered by score, so every push needs a
+        # later score than the one before it for messages to keep their order
+        score = max(now, self._last_score)
+        for _, (channel_keys, messages, capacities) in chunks:
+            score += SCORE_STEP
+            pipe.eval(PUSH_LUA, len(channel_keys), *channel_keys,
+                      *messages, *capacities, score, self.expiry)
+        self._last_score = score
+        results = await pipe.execute()
+        self.batch_stats['round_trips'] += 1
+
+        for (pending, _), over_capacity in zip(chunks, results[len(seen):]):
+            pending.over_capacity += over_capacity
@@ -0,0 +1,50 @@
+"""
+Chat persistence.
+
+Chat messages are broadcast right away and kept in the room's bounded
+history (``RoomState.chat``) for the connect snapshot. Every message is also
+queued on ``chat_buffer`` and written to ``ChatMessage`` in bulk, off the
+event loop, for moderation.
+"""
+import atexit
+import logging
+
+from .models import ChatMessage
+from .move_buffer import WriteBehindBuffer
+
+logger = logging.getLogger(__name__)
+
+CHAT_MAX_LENGTH = 500
+
+
+class ChatBuffer(WriteBehindBuffer):
+    """Batches ChatMessage inserts"""
+
+    name = 'chat messages'
+
+    def add(self, game_room_id, user_id, message, created_at):
+        """Queue a message; must be called from the event loop"""
+        self._append((game_room_id, user_id, message, created_at))
+
+    def _persist(self, batch, extra):
+        ChatMessage.objects.bulk_create([
+            ChatMessage(
+                game_room_id=game_room_id,
+                user_id=user_id,
+                message=message,
+                created_at=created_at,
+            )
+            for game_room_id, user_id, message, created_at in batch
+        ], batch_size=self.max_size)
+
+
+# Chat is not latency sensitive, so let batches fill up for longer
+chat_buffer = ChatBuffer(max_delay=1.0)
+
+
+@atexit.register
+def _flush_on_shutdown():
+    try:
+        chat_buffer.flush_sync()
+    except Exception:
+        logger.exception('Failed to flush chat messages on shutdown')
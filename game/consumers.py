@@ -1,15 +1,30 @@
+import asyncio
 import json
+import time
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from .models import GameRoom, GamePlayer, GameMove
-from users.models import User
+from django.conf import settings
+from users.middleware import accept_subprotocol
+from . import ratelimit
+from .actors import get_room_actor
+from .affinity import room_affinity
+from .engine import COLOR_INDEX, IllegalMove
+from .turns import room_group
+from .protocol import BINARY_SUBPROTOCOL
+from .lobby import band_group, bet_bands, refresh_waiting_rooms, reload_waiting_rooms, waiting_rooms
+from .matchmaking import user_group
+
+# Actions that need the sender's turn
+TURN_ACTIONS = frozenset({'roll_dice', 'move_piece'})
+
 
 class GameConsumer(AsyncWebsocketConsumer):
     """WebSocket consumer for real-time game updates"""
     
     async def connect(self):
         self.room_id = self.scope['url_route']['kwargs']['room_id']
-        self.room_group_name = f'game_{self.room_id}'
+        self.room_group_name = room_group(self.room_id)
         
         # Join room group
         await self.channel_layer.group_add(
@@ -17,14 +32,41 @@ class GameConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
         
-        await self.accept()
+        # Negotiate the binary subprotocol; JSON stays the default
+        subprotocol = accept_subprotocol(self.scope, [BINARY_SUBPROTOCOL])
+        self.binary = subprotocol == BINARY_SUBPROTOCOL
+        await self.accept(subprotocol=subprotocol)
         
-        # Send current game state
-        game_state = await self.get_game_state()
-        await self.send(text_data=json.dumps({
-            'type': 'game_state',
-            'data': game_state
-        }))
+        self.limiter = ratelimit.connection_limiter()
+        self.room_limiter = ratelimit.get_room_limiter(self.room_id)
+        self.strikes = ratelimit.strike_bucket(time.monotonic())
+        self.rate_limited = False
+        
+        # Game actions go through the room's actor, which owns its state and
+        # may live on another worker
+        await room_affinity.start()
+        try:
+            await self.resolve_owner()
+            game_state, text = await self.join_room(*self.get_resume_point())
+        except asyncio.TimeoutError:
+            await self.close(code=1013)
+            return
+        
+        self.game_room_pk = None
+        self.player_pk = None
+        self.color = None
+        self.seat = None
+        if game_state:
+            self.game_room_pk = game_state['id']
+            user_id = self.scope['user'].id
+            for player in game_state['players']:
+                if player['user_id'] == user_id:
+                    self.player_pk = player['id']
+                    self.color = player['color']
+                    self.seat = COLOR_INDEX[self.color]
+        
+        # Resume payload or full game state
+        await self.send(text_data=text)
     
     async def disconnect(self, close_code):
         # Leave room group
@@ -33,10 +75,42 @@ class GameConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
     
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """Receive message from WebSocket"""
-        data = json.loads(text_data)
-        message_type = data.get('type')
+        if text_data is None or self.strikes is None:
+            return
+        
+        # Budget checks come before any parsing or broadcasting
+        now = time.monotonic()
+        if len(text_data) > settings.WS_MAX_FRAME_BYTES or not self.limiter.allow('frame', now):
+            await self.drop_frame(now)
+            return
+        try:
+            data = json.loads(text_data)
+        except ValueError:
+            data = None
+        message_type = data.get('type') if isinstance(data, dict) else None
+        if not isinstance(message_type, str):
+            await self.drop_frame(now)
+            return
+        if not self.limiter.allow(message_type, now):
+            await self.drop_frame(now)
+            return
+        
+        # Only the player whose turn it is spends the room's game budget,
+        # so spectators and other seats cannot starve them
+        if message_type in TURN_ACTIONS:
+            if self.seat is None:
+                await self.send_error('Only players can play')
+                return
+            if self.actor is not None and self.actor.board.turn != self.seat:
+                await self.send_error('Not your turn')
+                return
+        if not self.room_limiter.allow(message_type, now):
+            # The room is over budget, not this client: no strike
+            await self.drop_frame(now, strike=False)
+            return
+        self.rate_limited = False
         
         if message_type == 'roll_dice':
             await self.handle_dice_roll(data)
@@ -44,183 +118,203 @@ class GameConsumer(AsyncWebsocketConsumer):
             await self.handle_piece_move(data)
         elif message_type == 'chat_message':
             await self.handle_chat(data)
+        elif message_type == 'client_seed':
+            await self.handle_client_seed(data)
+    
+    async def drop_frame(self, now, strike=True):
+        """Drop an over-budget frame; disconnect clients that keep sending them"""
+        if not ratelimit.record_drop(self.strikes if strike else None, now):
+            # Ignore whatever else arrives before the close completes
+            self.strikes = None
+            await self.close(code=4029)
+            return
+        # One notice per burst of dropped frames, not one per frame
+        if not self.rate_limited:
+            self.rate_limited = True
+            await self.send_error('Rate limit exceeded, slow down')
     
     async def handle_dice_roll(self, data):
         """Handle dice roll"""
-        import random
-        dice_value = random.randint(1, 6)
-        
-        # Broadcast to room group
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'dice_rolled',
-                'user': self.scope['user'].username,
-                'dice_value': dice_value
-            }
-        )
+        await self.submit('roll')
+    
+    async def handle_client_seed(self, data):
+        """Add the player's seed to the room's client seed before the first roll"""
+        if self.color is None:
+            await self.send_error('Only players can set a client seed')
+            return
+        await self.submit('client_seed', data.get('seed'))
     
     async def handle_piece_move(self, data):
         """Handle piece movement"""
         piece_id = data.get('piece_id')
-        from_position = data.get('from_position')
-        to_position = data.get('to_position')
-        
-        # Save move to database
-        await self.save_move(piece_id, from_position, to_position)
-        
-        # Broadcast to room group
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'piece_moved',
-                'user': self.scope['user'].username,
-                'piece_id': piece_id,
-                'from_position': from_position,
-                'to_position': to_position
-            }
-        )
+        if not isinstance(piece_id, int):
+            await self.send_error('Invalid piece')
+            return
+        await self.submit('move', piece_id)
     
     async def handle_chat(self, data):
         """Handle chat message"""
         message = data.get('message')
-        
-        # Broadcast to room group
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'chat_message',
-                'user': self.scope['user'].username,
-                'message': message
-            }
-        )
+        if not isinstance(message, str) or not message.strip():
+            await self.send_error('Invalid message')
+            return
+        if not self.scope['user'].is_authenticated:
+            await self.send_error('Log in to chat')
+            return
+        await self.submit('chat', message)
     
-    # Receive message from room group
-    async def dice_rolled(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'dice_rolled',
-            'user': event['user'],
-            'dice_value': event['dice_value']
-        }))
+    async def resolve_owner(self):
+        """Find the room's actor: local, or the channel of the owning worker"""
+        self.owner_version = room_affinity.version
+        self.owner_channel = await room_affinity.resolve(self.room_id)
+        self.actor = get_room_actor(self.room_id) if self.owner_channel is None else None
     
-    async def piece_moved(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'piece_moved',
-            'user': event['user'],
-            'piece_id': event['piece_id'],
-            'from_position': event['from_position'],
-            'to_position': event['to_position']
-        }))
+    async def join_room(self, since, epoch):
+        if self.actor is not None:
+            return await self.actor.join(since, epoch)
+        return await room_affinity.request_join(self.owner_channel, self.room_id, since, epoch)
     
-    async def chat_message(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'user': event['user'],
-            'message': event['message']
-        }))
+    async def submit(self, action, *args):
+        """Queue an action on the room's actor; it replies to errors itself"""
+        if room_affinity.version != self.owner_version:
+            # Workers joined or left, the room may have a new owner
+            await self.resolve_owner()
+        if self.actor is not None:
+            try:
+                self.actor.submit(action, self, *args)
+            except IllegalMove as e:
+                await self.send_error(str(e))
+        else:
+            await room_affinity.forward(self.owner_channel, self.room_id, action, args, {
+                'channel_name': self.channel_name,
+                'seat': self.seat,
+                'color': self.color,
+                'game_room_pk': self.game_room_pk,
+                'player_pk': self.player_pk,
+                'user_id': self.scope['user'].id,
+                'username': self.scope['user'].username
+            })
     
-    async def player_joined(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'player_joined',
-            'user': event['user'],
-            'color': event['color']
-        }))
+    async def room_error(self, event):
+        """Error for a forwarded action, sent back by the owning worker"""
+        await self.send_error(event['message'])
     
-    async def game_started(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'game_started',
-            'message': 'Game has started!'
-        }))
+    # Receive message from room group
+    async def broadcast_frame(self, event):
+        """Forward a pre-encoded broadcast without re-serializing it"""
+        if self.binary and event['bytes'] is not None:
+            await self.send(bytes_data=event['bytes'])
+        else:
+            await self.send(text_data=event['text'])
+    
+    def get_resume_point(self):
+        """Parse the ``since`` and ``epoch`` query parameters sent by reconnecting clients"""
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        epoch = query.get('epoch', [None])[0]
+        try:
+            return int(query['since'][0]), epoch
+        except (KeyError, ValueError):
+            return None, epoch
     
-    async def game_ended(self, event):
+    async def send_error(self, message):
         await self.send(text_data=json.dumps({
-            'type': 'game_ended',
-            'winner': event['winner']
+            'type': 'error',
+            'message': message
         }))
-    
-    @database_sync_to_async
-    def get_game_state(self):
-        """Get current game state from database"""
-        try:
-            game_room = GameRoom.objects.get(room_id=self.room_id)
-            players = GamePlayer.objects.filter(game_room=game_room)
-            
-            return {
-                'room_id': str(game_room.room_id),
-                'status': game_room.status,
-                'bet_amount': float(game_room.bet_amount),
-                'current_players': game_room.current_players,
-                'players': [
-                    {
-                        'username': p.user.username,
-                        'color': p.color,
-                        'position': p.position
-                    } for p in players
-                ]
-            }
-        except GameRoom.DoesNotExist:
-            return None
-    
-    @database_sync_to_async
-    def save_move(self, piece_id, from_position, to_position):
-        """Save move to database"""
-        # Implementation for saving move
-        pass
 
 
 class LobbyConsumer(AsyncWebsocketConsumer):
     """WebSocket consumer for lobby updates"""
     
     async def connect(self):
-        self.room_group_name = 'lobby'
+        self.bands = set()
         
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+        # Personal group for matchmaking notifications
+        self.user_group_name = None
+        if self.scope['user'].is_authenticated:
+            self.user_group_name = user_group(self.scope['user'].id)
+            await self.channel_layer.group_add(
+                self.user_group_name,
+                self.channel_name
+            )
         
-        await self.accept()
+        await self.accept(subprotocol=accept_subprotocol(self.scope))
         
-        # Send available rooms
-        rooms = await self.get_available_rooms()
-        await self.send(text_data=json.dumps({
-            'type': 'available_rooms',
-            'rooms': rooms
-        }))
+        # Subscribe to the requested bet bands (all by default)
+        refresh_waiting_rooms()
+        if waiting_rooms.is_stale():
+            await database_sync_to_async(reload_waiting_rooms)()
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        bands = self.parse_bands(query['bands'][0].split(',')) if 'bands' in query else None
+        await self.subscribe(range(bet_bands()) if bands is None else bands)
     
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
+        if self.user_group_name:
+            await self.channel_layer.group_discard(
+                self.user_group_name,
+                self.channel_name
+            )
+        for band in self.bands:
+            await self.channel_layer.group_discard(
+                band_group(band),
+                self.channel_name
+            )
     
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        # Handle lobby messages
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = json.loads(text_data or '')
+        except ValueError:
+            return
+        if not isinstance(data, dict):
+            return
+        message_type = data.get('type')
+        bands = self.parse_bands(data.get('bands'))
+        
+        if message_type == 'subscribe':
+            await self.subscribe(bands)
+        elif message_type == 'unsubscribe':
+            await self.unsubscribe(bands)
     
-    async def room_created(self, event):
+    async def subscribe(self, bands):
+        """Join band groups and send the snapshot for the newly added bands"""
+        new_bands = sorted(set(bands) - self.bands)
+        for band in new_bands:
+            await self.channel_layer.group_add(
+                band_group(band),
+                self.channel_name
+            )
+        self.bands.update(new_bands)
+        
+        # Send available rooms from the in-memory index
         await self.send(text_data=json.dumps({
-            'type': 'room_created',
-            'room': event['room']
+            'type': 'available_rooms',
+            'bet_bands': settings.LOBBY_BET_BANDS,
+            'bands': new_bands,
+            'rooms': waiting_rooms.snapshot(new_bands)
         }))
     
-    async def room_updated(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'room_updated',
-            'room': event['room']
-        }))
+    async def unsubscribe(self, bands):
+        for band in set(bands) & self.bands:
+            await self.channel_layer.group_discard(
+                band_group(band),
+                self.channel_name
+            )
+            self.bands.discard(band)
     
-    @database_sync_to_async
-    def get_available_rooms(self):
-        """Get available game rooms"""
-        rooms = GameRoom.objects.filter(
-            status='waiting',
-            current_players__lt=4
-        )
-        return [
-            {
-                'room_id': str(room.room_id),
-                'bet_amount': float(room.bet_amount),
-                'current_players': room.current_players
-            } for room in rooms
-        ]
+    def parse_bands(self, bands):
+        """Valid band indexes from client input"""
+        if not isinstance(bands, list):
+            return []
+        valid = []
+        for band in bands:
+            try:
+                band = int(band)
+            except (TypeError, ValueError):
+                continue
+            if 0 <= band < bet_bands():
+                valid.append(band)
+        return valid
+    
+    async def broadcast_frame(self, event):
+        """Forward a pre-encoded lobby broadcast without re-serializing it"""
+        await self.send(text_data=event['text'])
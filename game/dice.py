@@ -0,0 +1,159 @@
+"""
+Provably fair dice.
+
+Each room draws a secret 32-byte server seed when its dice are created and
+publishes only ``sha256(server_seed)``. Roll number ``nonce`` (0, 1, 2, ...)
+is derived as
+
+    digest = HMAC-SHA256(key=server_seed, msg=f'{client_seed}:{nonce}')
+
+and the first digest byte below 252 gives ``byte % 6 + 1``; bytes of 252 and
+above are skipped so all six faces are equally likely. (If all 32 bytes are
+skipped, which practically never happens, the digest is hashed again with
+the same key.) The client seed is the room id followed by the seeds players
+contribute before the first roll (colons removed), in seat order, joined
+with ``:``.
+
+Once ``game_ended`` has been sent the server seed is revealed. Anyone can
+then check it against the published hash and recompute every roll with
+``verify_rolls``.
+
+Rolls are derived in batches of ``batch_size`` ahead of time, so the roll
+handler only pops a byte from an array.
+"""
+import hashlib
+import hmac
+import secrets
+from array import array
+
+from .engine import COLORS, IllegalMove
+
+BATCH_SIZE = 256
+MAX_CLIENT_SEED_LENGTH = 64
+
+
+def seed_hash(server_seed):
+    return hashlib.sha256(server_seed).hexdigest()
+
+
+def derive_roll(server_seed, client_seed, nonce):
+    """Roll number ``nonce`` for the given seeds (1-6)"""
+    return _derive(hmac.new(server_seed, digestmod=hashlib.sha256), client_seed, nonce)
+
+
+def _derive(keyed, client_seed, nonce):
+    # Copying a keyed HMAC skips re-deriving the key pads for every roll
+    mac = keyed.copy()
+    mac.update(f'{client_seed}:{nonce}'.encode())
+    digest = mac.digest()
+    while True:
+        for byte in digest:
+            if byte < 252:
+                return byte % 6 + 1
+        mac = keyed.copy()
+        mac.update(digest)
+        digest = mac.digest()
+
+
+def verify_rolls(server_seed, server_seed_hash, client_seed, rolls):
+    """
+    Check a revealed hex ``server_seed`` against its published hash and the
+    rolls seen during the game (in nonce order). Returns the nonce of the
+    first roll that does not match, or None when everything checks out.
+    """
+    seed = bytes.fromhex(server_seed)
+    if not hmac.compare_digest(seed_hash(seed), server_seed_hash):
+        raise ValueError('Server seed does not match the published hash')
+    for nonce, dice_value in enumerate(rolls):
+        if derive_roll(seed, client_seed, nonce) != dice_value:
+            return nonce
+    return None
+
+
+class RoomDice:
+    """Commit-reveal dice stream of one room"""
+
+    __slots__ = ('room_id', 'server_seed', 'server_seed_hash', 'client_seeds',
+                 'nonce', 'batch_size', '_rolls')
+
+    def __init__(self, room_id, server_seed=None, batch_size=BATCH_SIZE):
+        self.room_id = room_id
+        self.server_seed = server_seed or secrets.token_bytes(32)
+        self.server_seed_hash = seed_hash(self.server_seed)
+        self.client_seeds = {}
+        self.nonce = 0
+        self.batch_size = batch_size
+        # Pending rolls, next roll last so taking one is a pop()
+        self._rolls = array('B')
+
+    @property
+    def client_seed(self):
+        return ':'.join([str(self.room_id)] + [
+            self.client_seeds[color] for color in COLORS if color in self.client_seeds
+        ])
+
+    def set_client_seed(self, color, seed):
+        """Add a player's seed to the client seed; only before the first roll"""
+        if self.nonce:
+            raise IllegalMove('Client seeds are locked after the first roll')
+        if isinstance(seed, str):
+            seed = seed.replace(':', '')
+        if not isinstance(seed, str) or not 0 < len(seed) <= MAX_CLIENT_SEED_LENGTH:
+            raise IllegalMove('Invalid client seed')
+        self.client_seeds[color] = seed
+        # Rolls derived for the old client seed are void
+        del self._rolls[:]
+
+    def peek(self):
+        """Next dice value, without using it up"""
+        if not self._rolls:
+            self._refill()
+        return self._rolls[-1]
+
+    def roll(self):
+        """Return ``(dice_value, nonce)`` for the next roll"""
+        if not self._rolls:
+            self._refill()
+        nonce = self.nonce
+        self.nonce += 1
+        return self._rolls.pop(), nonce
+
+    def commitment(self):
+        """Public fairness data for game state messages"""
+        return {
+            'server_seed_hash': self.server_seed_hash,
+            'client_seed': self.client_seed,
+            'nonce': self.nonce,
+        }
+
+    def reveal(self):
+        """Commitment plus the server seed; only send once the game is over"""
+        return dict(self.commitment(), server_seed=self.server_seed.hex())
+
+    def _refill(self):
+        keyed = hmac.new(self.server_seed, digestmod=hashlib.sha256)
+        client_seed = self.client_seed
+        first = self.nonce
+        rolls = array('B', [
+            _derive(keyed, client_seed, nonce)
+            for nonce in range(first, first + self.batch_size)
+        ])
+        rolls.reverse()
+        self._rolls = rolls
+
+
+# Dice of the rooms active in this process
+_dice = {}
+
+
+def get_room_dice(room_id):
+    """Return the dice of ``room_id``, committing to a new seed on first use"""
+    dice = _dice.get(room_id)
+    if dice is None:
+        dice = _dice[room_id] = RoomDice(room_id)
+    return dice
+
+
+def release_room_dice(room_id):
+    """Drop the dice of a finished room and return them for the reveal"""
+    return _dice.pop(room_id, None)
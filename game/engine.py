@@ -0,0 +1,251 @@
+"""
+Server-authoritative Ludo rules engine.
+
+Each room's board is a fixed array of 16 piece positions (4 seats x 4
+pieces). A position is the number of steps a piece has travelled from its
+own start square:
+
+    0        piece is in the yard
+    1..51    piece is on the shared track
+    52..56   piece is in its home column
+    57       piece has reached home
+
+All board geometry is precomputed into flat tables at import time, so
+validating and applying a move is a constant number of array lookups.
+"""
+import struct
+from array import array
+
+COLORS = ('red', 'blue', 'green', 'yellow')
+COLOR_INDEX = {color: seat for seat, color in enumerate(COLORS)}
+
+PIECES_PER_SEAT = 4
+TRACK_LENGTH = 52
+YARD = 0
+LAST_TRACK_STEP = 51
+HOME = 57
+STRIDE = HOME + 1
+
+START_SQUARES = (0, 13, 26, 39)
+SAFE_SQUARES = frozenset({0, 8, 13, 21, 26, 34, 39, 47})
+
+# _SQUARE[seat * STRIDE + step] -> absolute track square, or -1 when the
+# step is off the shared track (yard, home column, home).
+_SQUARE = tuple(
+    (START_SQUARES[seat] + step - 1) % TRACK_LENGTH
+    if 1 <= step <= LAST_TRACK_STEP else -1
+    for seat in range(len(COLORS))
+    for step in range(STRIDE)
+)
+_SAFE = tuple(square in SAFE_SQUARES for square in range(TRACK_LENGTH))
+
+# Checkpoint layout: positions, seat bitmask, turn, dice, winner (255 = none),
+# move number
+_CHECKPOINT = struct.Struct('<16sBBBBH')
+_NO_WINNER = 255
+
+
+class IllegalMove(ValueError):
+    """Raised when a roll or move violates the rules or turn order"""
+
+
+class LudoBoard:
+    """Compact board state for a single room"""
+
+    __slots__ = ('positions', 'turn', 'dice', 'winner', 'move_number', '_next')
+
+    def __init__(self, colors=COLORS):
+        seats = sorted(COLOR_INDEX[color] for color in colors)
+        if not seats:
+            raise ValueError('A board needs at least one seat')
+
+        self.positions = array('B', bytes(len(COLORS) * PIECES_PER_SEAT))
+        self.turn = seats[0]
+        self.dice = 0
+        self.winner = None
+        self.move_number = 0
+
+        # Precompute turn order so passing the turn is a single lookup
+        nxt = [seats[0]] * len(COLORS)
+        for i, seat in enumerate(seats):
+            nxt[seat] = seats[(i + 1) % len(seats)]
+        self._next = tuple(nxt)
+
+    def legal_moves(self, seat, dice):
+        """Return the piece numbers (0-3) ``seat`` may move with ``dice``"""
+        positions = self.positions
+        base = seat * PIECES_PER_SEAT
+        moves = []
+        for piece in range(PIECES_PER_SEAT):
+            step = positions[base + piece]
+            if step == YARD:
+                if dice == 6:
+                    moves.append(piece)
+            elif step + dice <= HOME:
+                moves.append(piece)
+        return moves
+
+    def roll(self, seat, dice):
+        """
+        Register a dice roll for ``seat``.
+
+        Returns the legal moves for the roll. When there are none the turn
+        passes immediately.
+        """
+        self._check_turn(seat)
+        if self.dice:
+            raise IllegalMove('Move a piece before rolling again')
+        if not 1 <= dice <= 6:
+            raise IllegalMove('Invalid dice value')
+
+        moves = self.legal_moves(seat, dice)
+        if moves:
+            self.dice = dice
+        else:
+            self.turn = self._next[seat]
+        return moves
+
+    def move(self, seat, piece):
+        """
+        Move ``piece`` of ``seat`` by the pending dice value.
+
+        Returns ``(from_step, to_step, captured)`` where ``captured`` is a
+        bitmask of global piece indices sent back to the yard.
+        """
+        self._check_turn(seat)
+        dice = self.dice
+        if not dice:
+            raise IllegalMove('Roll the dice first')
+        if not 0 <= piece < PIECES_PER_SEAT:
+            raise IllegalMove('Invalid piece')
+
+        positions = self.positions
+        index = seat * PIECES_PER_SEAT + piece
+        from_step = positions[index]
+        if from_step == YARD:
+            if dice != 6:
+                raise IllegalMove('A six is needed to leave the yard')
+            to_step = 1
+        else:
+            to_step = from_step + dice
+            if to_step > HOME:
+                raise IllegalMove('Move overshoots home')
+
+        captured = 0
+        square = _SQUARE[seat * STRIDE + to_step]
+        if square >= 0 and not _SAFE[square]:
+            for other in range(len(positions)):
+                step = positions[other]
+                if (step and other // PIECES_PER_SEAT != seat
+                        and _SQUARE[(other // PIECES_PER_SEAT) * STRIDE + step] == square):
+                    positions[other] = YARD
+                    captured |= 1 << other
+
+        positions[index] = to_step
+        self.dice = 0
+        self.move_number += 1
+
+        if to_step == HOME and self._all_home(seat):
+            self.winner = seat
+        elif not (dice == 6 or captured or to_step == HOME):
+            self.turn = self._next[seat]
+
+        return from_step, to_step, captured
+
+    def skip_turn(self, seat):
+        """Forfeit the current turn of ``seat`` (turn timeout)"""
+        self._check_turn(seat)
+        self.dice = 0
+        self.turn = self._next[seat]
+
+    def remove_seat(self, seat):
+        """
+        Take ``seat`` out of the turn order (forfeit). Its pieces stay on
+        the board. When a single seat is left it wins. Counts as a move, so
+        the forfeit has its own place in the move log.
+        """
+        if self.winner is not None:
+            raise IllegalMove('Game is over')
+        seats = sorted(set(self._next))
+        if seat not in seats or len(seats) == 1:
+            raise IllegalMove('Seat cannot forfeit')
+        seats.remove(seat)
+        if self.turn == seat:
+            self.dice = 0
+            self.turn = self._next[seat]
+        nxt = [seats[0]] * len(COLORS)
+        for i, other in enumerate(seats):
+            nxt[other] = seats[(i + 1) % len(seats)]
+        self._next = tuple(nxt)
+        self.move_number += 1
+        if len(seats) == 1:
+            self.winner = seats[0]
+
+    def snapshot(self):
+        """Serializable view of the board for game state messages"""
+        return {
+            'positions': list(self.positions),
+            'turn': COLORS[self.turn],
+            'dice': self.dice,
+            'winner': COLORS[self.winner] if self.winner is not None else None,
+            'move_number': self.move_number,
+        }
+
+    def to_bytes(self):
+        """Pack the full board state into a 22-byte checkpoint"""
+        seats = 0
+        for seat in set(self._next):
+            seats |= 1 << seat
+        return _CHECKPOINT.pack(
+            self.positions.tobytes(), seats, self.turn, self.dice,
+            _NO_WINNER if self.winner is None else self.winner,
+            self.move_number
+        )
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Rebuild a board from a :meth:`to_bytes` checkpoint"""
+        positions, seats, turn, dice, winner, move_number = _CHECKPOINT.unpack(data)
+        board = cls([color for seat, color in enumerate(COLORS) if seats >> seat & 1])
+        board.positions = array('B', positions)
+        board.turn = turn
+        board.dice = dice
+        board.winner = None if winner == _NO_WINNER else winner
+        board.move_number = move_number
+        return board
+
+    def _check_turn(self, seat):
+        if self.winner is not None:
+            raise IllegalMove('Game is over')
+        if seat != self.turn:
+            raise IllegalMove('Not your turn')
+
+    def _all_home(self, seat):
+        base = seat * PIECES_PER_SEAT
+        positions = self.positions
+        for piece in range(PIECES_PER_SEAT):
+            if positions[base + piece] != HOME:
+                return False
+        return True
+
+
+# Boards for the rooms active in this process
+_boards = {}
+
+
+def get_board(room_id, colors=COLORS):
+    """Return the board for ``room_id``, creating it on first use"""
+    board = _boards.get(room_id)
+    if board is None:
+        board = _boards[room_id] = LudoBoard(colors)
+    return board
+
+
+def replace_board(room_id, board):
+    """Install a board rebuilt elsewhere (replay) for ``room_id``"""
+    _boards[room_id] = board
+
+
+def release_board(room_id):
+    """Drop the board of a finished room"""
+    _boards.pop(room_id, None)
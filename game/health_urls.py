@@ -1,13 +1,26 @@
 from django.urls import path
 from django.http import JsonResponse
 from django.views.decorators.http import require_http_methods
+from . import actors, ratelimit
+from .affinity import room_affinity
+from .chat import chat_buffer
+from .idempotency import idempotency_store
+from .move_buffer import move_buffer
+from users.middleware import auth_cache_stats
 
 @require_http_methods(["GET"])
 def health_check(request):
     """Simple health check endpoint"""
     return JsonResponse({
         'status': 'healthy',
-        'service': 'Zugu Ludo Backend'
+        'service': 'Zugu Ludo Backend',
+        'move_buffer': move_buffer.stats(),
+        'chat_buffer': chat_buffer.stats(),
+        'ws_auth_cache': auth_cache_stats(),
+        'rate_limit': ratelimit.stats(),
+        'room_actors': actors.stats(),
+        'affinity': room_affinity.stats(),
+        'idempotency': idempotency_store.stats(),
     })
 
 urlpatterns = [
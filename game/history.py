@@ -0,0 +1,153 @@
+"""
+Transaction history: keyset pages and streamed exports.
+
+Pages are ordered newest first on ``(created_at, id)`` and the cursor is
+the position of the last row served, so each page is one index range scan
+on ``(user, created_at, id)`` however deep the client has scrolled. The
+cursor is opaque to clients: ``next`` in the response is the URL of the
+following page, or null on the last one.
+
+Exports write the same rows as CSV or NDJSON through a streaming response.
+The queryset is read with ``iterator()`` (a server-side cursor on
+PostgreSQL) in chunks of ``TRANSACTION_EXPORT_CHUNK`` rows, so memory stays
+flat however long the history is.
+
+Filters, shared by both:
+
+    type    transaction type, several separated by commas
+    status  transaction status
+    since   ISO date or datetime, inclusive
+    until   ISO date or datetime, exclusive (a date means its midnight)
+"""
+import base64
+import csv
+import json
+from datetime import datetime, time
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.utils.urls import replace_query_param
+
+EXPORT_FIELDS = [
+    'id', 'transaction_id', 'room_id', 'transaction_type', 'amount',
+    'status', 'usdt_tx_hash', 'description', 'created_at'
+]
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+class InvalidQuery(ValueError):
+    """A filter or cursor that cannot be parsed"""
+
+
+def _parse_when(value, name):
+    when = parse_datetime(value)
+    if when is None:
+        day = parse_date(value)
+        if day is None:
+            raise InvalidQuery(f'Invalid {name}: {value}')
+        when = datetime.combine(day, time.min)
+    if timezone.is_naive(when):
+        when = timezone.make_aware(when)
+    return when
+
+
+def filter_transactions(queryset, params):
+    """Apply the ``type``, ``status``, ``since`` and ``until`` filters"""
+    types = [t for t in params.get('type', '').split(',') if t]
+    if types:
+        queryset = queryset.filter(transaction_type__in=types)
+    if params.get('status'):
+        queryset = queryset.filter(status=params['status'])
+    if params.get('since'):
+        queryset = queryset.filter(created_at__gte=_parse_when(params['since'], 'since'))
+    if params.get('until'):
+        queryset = queryset.filter(created_at__lt=_parse_when(params['until'], 'until'))
+    return queryset
+
+
+def encode_cursor(row):
+    position = f'{row.created_at.isoformat()}|{row.pk}'
+    return base64.urlsafe_b64encode(position.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        position = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, pk = position.rsplit('|', 1)
+        return datetime.fromisoformat(created_at), int(pk)
+    except ValueError:
+        raise InvalidQuery('Invalid cursor')
+
+
+def page_size(params):
+    """``limit`` from the query, defaulting to PAGE_SIZE and capped"""
+    default = settings.REST_FRAMEWORK.get('PAGE_SIZE', 20)
+    try:
+        size = int(params.get('limit', default))
+    except ValueError:
+        raise InvalidQuery('Invalid limit')
+    return min(max(size, 1), settings.TRANSACTION_PAGE_MAX)
+
+
+def keyset_page(request, queryset):
+    """
+    One page of ``queryset`` after the ``cursor`` in the request. Returns
+    ``(rows, next_url)``; ``next_url`` is None on the last page.
+    """
+    params = request.query_params
+    size = page_size(params)
+    if params.get('cursor'):
+        created_at, pk = decode_cursor(params['cursor'])
+        queryset = queryset.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk)
+        )
+    rows = list(queryset.order_by('-created_at', '-pk')[:size + 1])
+    if len(rows) <= size:
+        return rows, None
+    rows = rows[:size]
+    url = request.build_absolute_uri()
+    return rows, replace_query_param(url, 'cursor', encode_cursor(rows[-1]))
+
+
+class _Echo:
+    """File-like object for csv.writer that hands each line back"""
+
+    def write(self, value):
+        return value
+
+
+def _rows(queryset):
+    rows = queryset.order_by('-created_at', '-pk').values_list(
+        'pk', 'transaction_id', 'game_room__room_id', 'transaction_type', 'amount',
+        'status', 'usdt_tx_hash', 'description', 'created_at'
+    )
+    return rows.iterator(chunk_size=settings.TRANSACTION_EXPORT_CHUNK)
+
+
+def _csv_lines(queryset):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPORT_FIELDS)
+    for row in _rows(queryset):
+        yield writer.writerow(row)
+
+
+def _ndjson_lines(queryset):
+    for row in _rows(queryset):
+        yield json.dumps(dict(zip(EXPORT_FIELDS, row)), cls=DjangoJSONEncoder) + '\n'
+
+
+def export_response(queryset, export_format, filename='transactions'):
+    """Streaming CSV or NDJSON download of ``queryset``"""
+    if export_format not in EXPORT_FORMATS:
+        raise InvalidQuery(f'Unknown export format: {export_format}')
+    lines = _csv_lines(queryset) if export_format == 'csv' else _ndjson_lines(queryset)
+    response = StreamingHttpResponse(lines, content_type=EXPORT_FORMATS[export_format])
+    response['Content-Disposition'] = f'attachment; filename="{filename}.{export_format}"'
+    return response
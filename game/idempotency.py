@@ -0,0 +1,212 @@
+"""
+Idempotency keys for endpoints that move money.
+
+A client that may retry sends ``Idempotency-Key: <unique value>`` with the
+request. The first request with a given key, per user and endpoint, runs
+normally and its response is stored for ``IDEMPOTENCY_TTL_SECONDS``; any
+retry with the same key gets that response back, marked with
+``Idempotent-Replayed: true``, without running the view again. Requests
+without the header are not affected.
+
+Each key is a single Redis string, so retries landing on another worker
+are caught too:
+
+- The first request claims the key with ``SET NX`` and a short expiry
+  (``IDEMPOTENCY_LOCK_SECONDS``) while it runs.
+- It then overwrites the key with its response and the full TTL.
+
+A duplicate that arrives while the first is still running polls the key
+until the response appears, for up to ``IDEMPOTENCY_WAIT_SECONDS``. After
+that it gets a 409 and can retry later. If the first request fails with a
+5xx or an exception, it drops its claim so a retry runs the view again.
+The claim is dropped with a compare-and-delete script (``RELEASE_LUA``), so
+a request whose claim already expired cannot delete someone else's. The
+request payload is fingerprinted, and reusing a key with a different
+payload gets a 422.
+
+Once the view has run, money may have moved, so a failure to store its
+response must not turn into an error the client retries. The store is
+attempted ``STORE_ATTEMPTS`` times, and if it still fails the response is
+returned anyway and the error logged. The claim then keeps duplicates out
+until it expires.
+
+Every key expires, so the store stays bounded by the request rate over
+the TTL. The lock expiry must stay longer than the slowest of these
+requests.
+"""
+import functools
+import hashlib
+import json
+import logging
+import time
+import uuid
+
+from django.conf import settings
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from .local_redis import LocalRedis
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+KEY_PREFIX = 'idempotency'
+STORE_ATTEMPTS = 3
+
+# Delete KEYS[1] only while it still holds the claim with token ARGV[1]
+RELEASE_LUA = """
+    local raw = redis.call('GET', KEYS[1])
+    if raw and cjson.decode(raw)['token'] == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+"""
+
+
+@LocalRedis.script(RELEASE_LUA)
+def _release_local(redis, keys, args):
+    raw = redis.get(keys[0])
+    if raw is not None and json.loads(raw).get('token') == args[0]:
+        return redis.delete(keys[0])
+    return 0
+
+
+_redis = None
+
+
+def get_redis():
+    global _redis
+    if _redis is None:
+        import redis
+        _redis = redis.Redis.from_url(
+            settings.IDEMPOTENCY_REDIS_URL, decode_responses=True
+        )
+    return _redis
+
+
+def _fingerprint(data):
+    payload = json.dumps(data, sort_keys=True, cls=JSONEncoder)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class IdempotencyStore:
+    """Stored responses and in-flight claims, one Redis key per request"""
+
+    def __init__(self, redis=None, clock=time.monotonic, sleep=time.sleep):
+        self._redis = redis
+        self.clock = clock
+        self.sleep = sleep
+        self._stats = {'executed': 0, 'replayed': 0, 'waited': 0, 'conflicts': 0, 'unstored': 0}
+
+    @property
+    def redis(self):
+        return self._redis if self._redis is not None else get_redis()
+
+    def storage_key(self, request, key):
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return f'{KEY_PREFIX}:{request.user.pk}:{request.method}:{request.path}:{digest}'
+
+    def run(self, storage_key, fingerprint, execute):
+        """
+        Return the stored response for ``storage_key``, or call ``execute``
+        and store what it returns.
+        """
+        deadline = self.clock() + settings.IDEMPOTENCY_WAIT_SECONDS
+        waited = False
+        while True:
+            token = uuid.uuid4().hex
+            claim = json.dumps({'token': token, 'fingerprint': fingerprint})
+            if self.redis.set(storage_key, claim, nx=True, ex=settings.IDEMPOTENCY_LOCK_SECONDS):
+                break
+            raw = self.redis.get(storage_key)
+            if raw is None:
+                # Finished with a failure or expired since the SET; claim again
+                continue
+            record = json.loads(raw)
+            if record['fingerprint'] != fingerprint:
+                self._stats['conflicts'] += 1
+                return Response(
+                    {'error': f'{HEADER} was already used with a different request'},
+                    status=status.HTTP_422_UNPROCESSABLE_ENTITY
+                )
+            if 'status' in record:
+                self._stats['replayed'] += 1
+                return Response(record['data'], status=record['status'],
+                                headers={REPLAYED_HEADER: 'true'})
+            if self.clock() >= deadline:
+                self._stats['conflicts'] += 1
+                return Response(
+                    {'error': f'A request with this {HEADER} is still in progress'},
+                    status=status.HTTP_409_CONFLICT
+                )
+            if not waited:
+                waited = True
+                self._stats['waited'] += 1
+            self.sleep(settings.IDEMPOTENCY_POLL_SECONDS)
+
+        self._stats['executed'] += 1
+        try:
+            response = execute()
+        except Exception:
+            self._release(storage_key, token)
+            raise
+        if response.status_code >= 500:
+            self._release(storage_key, token)
+            return response
+
+        record = {'fingerprint': fingerprint, 'status': response.status_code, 'data': response.data}
+        self._store(storage_key, json.dumps(record, cls=JSONEncoder))
+        return response
+
+    def _store(self, storage_key, record):
+        for attempt in range(1, STORE_ATTEMPTS + 1):
+            try:
+                self.redis.set(storage_key, record, ex=settings.IDEMPOTENCY_TTL_SECONDS)
+                return
+            except Exception:
+                if attempt == STORE_ATTEMPTS:
+                    self._stats['unstored'] += 1
+                    logger.exception('Response for %s not stored; duplicates are held off '
+                                     'only until its claim expires', storage_key)
+                    return
+                self.sleep(settings.IDEMPOTENCY_POLL_SECONDS)
+
+    def _release(self, storage_key, token):
+        try:
+            self.redis.eval(RELEASE_LUA, 1, storage_key, token)
+        except Exception:
+            # The claim expires on its own
+            logger.exception('Could not release %s', storage_key)
+
+    def stats(self):
+        return dict(self._stats)
+
+
+# Shared by every request in the process
+idempotency_store = IdempotencyStore()
+
+
+def idempotent(view):
+    """
+    Honour the ``Idempotency-Key`` header on a view method. Goes under
+    ``@action`` so the action wraps the idempotent view.
+    """
+    @functools.wraps(view)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key:
+            return view(self, request, *args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return Response(
+                {'error': f'{HEADER} must be at most {MAX_KEY_LENGTH} characters'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return idempotency_store.run(
+            idempotency_store.storage_key(request, key),
+            _fingerprint(request.data),
+            lambda: view(self, request, *args, **kwargs)
+        )
+    return wrapper
@@ -0,0 +1,363 @@
+"""
+In-memory index of rooms waiting for players.
+
+The index is loaded from the database once and then kept current from
+GameRoom saves (see ``signals.py``), so lobby connects and the REST room
+list never scan the ``GameRoom`` table. ``QuerySet.update()`` sends no
+signal: code that updates waiting rooms that way calls
+``publish_rooms_changed`` afterwards. Each change is pushed to lobby
+subscribers as a diff by the worker that made it, through the channel
+layer, so every worker's clients see it once. Other workers' changes reach
+the local index through ``refresh_waiting_rooms``, which reloads it every
+``refresh_interval`` without publishing anything:
+
+    room_created   a new waiting room
+    room_updated   a waiting room gained or lost players
+    room_removed   a room started, filled up or was cancelled
+
+Lobby clients subscribe to bet bands (``LOBBY_BET_BANDS``), each backed by
+its own channel group, so they only receive changes for the stakes they
+follow. Diffs are coalesced by ``LobbyPublisher`` and sent once per
+``LOBBY_TICK_SECONDS`` as a single ``lobby_updates`` message per band, so a
+burst of joins costs one message per lobby client per tick. Flushes run on
+an event loop: the one lobby sockets are served from, once one has
+connected, or else a single background loop thread. Either way every flush
+reuses the same channel layer connections.
+
+Rooms are ordered by bet amount, then oldest first.
+"""
+import asyncio
+import logging
+import threading
+import time
+import weakref
+from bisect import bisect_left, bisect_right, insort
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .models import GameRoom
+from .protocol import make_frame
+
+logger = logging.getLogger(__name__)
+
+ROOM_FIELDS = ('id', 'room_id', 'bet_amount', 'current_players', 'max_players', 'status', 'created_at')
+
+def bet_bands():
+    """Number of lobby bands defined by ``LOBBY_BET_BANDS``"""
+    return len(settings.LOBBY_BET_BANDS) - 1
+
+
+def bet_band(amount):
+    """Band index for a bet amount; out-of-range bets go to the edge bands"""
+    band = bisect_right(settings.LOBBY_BET_BANDS, float(amount)) - 1
+    return min(max(band, 0), bet_bands() - 1)
+
+
+def band_group(band):
+    return f'lobby_{band}'
+
+
+def room_summary(room):
+    """Lobby view of a waiting room"""
+    return {
+        'id': room.pk,
+        'room_id': str(room.room_id),
+        'bet_amount': float(room.bet_amount),
+        'current_players': room.current_players,
+        'max_players': room.max_players,
+        'created_at': room.created_at.isoformat(),
+    }
+
+
+def is_waiting(room):
+    return room.status == 'waiting' and room.current_players < room.max_players
+
+
+class WaitingRoomIndex:
+    """Waiting rooms ordered by (bet amount, age), updated incrementally"""
+
+    def __init__(self, refresh_interval=30.0):
+        # Other workers' changes are picked up by a periodic reload
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._keys = []
+        self._rooms = {}
+        self._loaded_at = None
+
+    def is_stale(self):
+        return (
+            self._loaded_at is None
+            or time.monotonic() - self._loaded_at > self.refresh_interval
+        )
+
+    def load(self):
+        """Rebuild the index from the database"""
+        rooms = GameRoom.objects.filter(status='waiting').only(*ROOM_FIELDS)
+        keys = []
+        entries = {}
+        for room in rooms:
+            if is_waiting(room):
+                summary = room_summary(room)
+                key = self._key(summary)
+                keys.append(key)
+                entries[summary['room_id']] = (key, summary)
+        keys.sort()
+
+        with self._lock:
+            self._keys = keys
+            self._rooms = entries
+            self._loaded_at = time.monotonic()
+
+    def prime(self, summaries):
+        """Replace the index with ready-made room summaries (load tests)"""
+        entries = {summary['room_id']: (self._key(summary), summary) for summary in summaries}
+        with self._lock:
+            self._keys = sorted(key for key, _ in entries.values())
+            self._rooms = entries
+            self._loaded_at = time.monotonic()
+
+    def apply(self, room):
+        """
+        Bring the index in line with ``room`` and return the lobby diff
+        event, or ``None`` when the change is invisible to the lobby.
+        """
+        room_id = str(room.room_id)
+        waiting = is_waiting(room)
+
+        with self._lock:
+            existing = self._rooms.pop(room_id, None)
+            if existing is not None:
+                del self._keys[bisect_left(self._keys, existing[0])]
+
+            if not waiting:
+                if existing is None:
+                    return None
+                return self._removed(existing[1])
+
+            summary = room_summary(room)
+            key = self._key(summary)
+            insort(self._keys, key)
+            self._rooms[room_id] = (key, summary)
+
+        if existing is None:
+            return {'type': 'room_created', 'room': summary}
+        if existing[1] == summary:
+            return None
+        return {'type': 'room_updated', 'room': summary}
+
+    def remove(self, room_id):
+        room_id = str(room_id)
+        with self._lock:
+            existing = self._rooms.pop(room_id, None)
+            if existing is None:
+                return None
+            del self._keys[bisect_left(self._keys, existing[0])]
+        return self._removed(existing[1])
+
+    def snapshot(self, bands=None):
+        """Waiting rooms in lobby order, optionally limited to ``bands``"""
+        with self._lock:
+            rooms = self._rooms
+            keys = self._keys
+            if bands is None:
+                return [rooms[key[2]][1] for key in keys]
+
+            # Keys sort by bet amount first, so each band is a contiguous slice
+            result = []
+            for band in sorted(bands):
+                start = 0 if band == 0 else bisect_left(keys, (settings.LOBBY_BET_BANDS[band],))
+                end = len(keys) if band == bet_bands() - 1 else bisect_left(
+                    keys, (settings.LOBBY_BET_BANDS[band + 1],)
+                )
+                result.extend(rooms[key[2]][1] for key in keys[start:end])
+            return result
+
+    @staticmethod
+    def _removed(summary):
+        return {
+            'type': 'room_removed',
+            'room_id': summary['room_id'],
+            'bet_amount': summary['bet_amount'],
+        }
+
+    @staticmethod
+    def _key(summary):
+        return (summary['bet_amount'], summary['created_at'], summary['room_id'])
+
+
+waiting_rooms = WaitingRoomIndex()
+
+
+async def notify_lobby(channel_layer, band, event):
+    """Send a lobby event to every client subscribed to ``band``, encoded once"""
+    await channel_layer.group_send(band_group(band), make_frame(event))
+
+
+def _diff_key(event):
+    """``(room_id, bet_amount)`` of a lobby diff"""
+    if event['type'] == 'room_removed':
+        return event['room_id'], event['bet_amount']
+    return event['room']['room_id'], event['room']['bet_amount']
+
+
+_background_loop = None
+
+
+def background_loop():
+    """Event loop thread for flushes in processes that serve no sockets"""
+    global _background_loop
+    if _background_loop is None:
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, name='lobby-publisher', daemon=True).start()
+        _background_loop = loop
+    return _background_loop
+
+
+class LobbyPublisher:
+    """Coalesces lobby diffs per room and flushes them once per tick and band"""
+
+    def __init__(self, tick=None):
+        self.tick = tick
+        self._lock = threading.Lock()
+        self._pending = {}
+        # Loop flushes run on, and the one a flush is scheduled on
+        self._loop = None
+        self._scheduled = None
+        self._flushing = None
+
+    def bind(self, loop=None):
+        """Flush on ``loop``, by default the running one (the ASGI server's)"""
+        with self._lock:
+            self._loop = loop or asyncio.get_running_loop()
+
+    def publish(self, event):
+        """Queue a diff; safe to call from any thread"""
+        room_id, _ = _diff_key(event)
+        with self._lock:
+            merged = self._merge(self._pending.get(room_id), event)
+            if merged is None:
+                self._pending.pop(room_id, None)
+            else:
+                self._pending[room_id] = merged
+
+            if not self._pending or (self._scheduled is not None and not self._scheduled.is_closed()):
+                return
+            if self._loop is None or self._loop.is_closed():
+                self._loop = background_loop()
+            loop = self._scheduled = self._loop
+        loop.call_soon_threadsafe(self._schedule_flush)
+
+    def _schedule_flush(self):
+        tick = self.tick if self.tick is not None else settings.LOBBY_TICK_SECONDS
+        loop = asyncio.get_running_loop()
+        loop.call_later(tick, self._start_flush)
+
+    def _start_flush(self):
+        self._flushing = asyncio.get_running_loop().create_task(self._flush_logged())
+
+    async def _flush_logged(self):
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception('Lobby updates could not be sent')
+
+    async def flush(self):
+        """Send pending diffs as one ``lobby_updates`` message per band"""
+        with self._lock:
+            self._scheduled = None
+            changes, self._pending = list(self._pending.values()), {}
+        if not changes:
+            return 0
+
+        by_band = {}
+        for change in changes:
+            _, amount = _diff_key(change)
+            by_band.setdefault(bet_band(amount), []).append(change)
+
+        channel_layer = get_channel_layer()
+        for band, band_changes in by_band.items():
+            await notify_lobby(channel_layer, band, {
+                'type': 'lobby_updates',
+                'band': band,
+                'changes': band_changes,
+            })
+        return len(changes)
+
+    @staticmethod
+    def _merge(previous, event):
+        """Collapse two diffs for the same room into what the client needs"""
+        if previous is None:
+            return event
+        if previous['type'] == 'room_created':
+            if event['type'] == 'room_removed':
+                # Client never saw the room
+                return None
+            return dict(event, type='room_created')
+        if previous['type'] == 'room_removed' and event['type'] == 'room_created':
+            # Client still has the room from before the removal
+            return dict(event, type='room_updated')
+        return event
+
+
+lobby_publisher = LobbyPublisher()
+
+
+def publish_room_change(room):
+    """Apply a saved room to the index and queue the diff for the lobby"""
+    event = waiting_rooms.apply(room)
+    if event is not None:
+        lobby_publisher.publish(event)
+
+
+def publish_room_removed(room_id):
+    event = waiting_rooms.remove(room_id)
+    if event is not None:
+        lobby_publisher.publish(event)
+
+
+def publish_rooms_changed(room_pks):
+    """
+    Re-read rooms written with ``QuerySet.update()``, which sends no
+    ``post_save``, and publish their changes. Call it once the update has
+    committed.
+    """
+    for room in GameRoom.objects.filter(pk__in=list(room_pks)).only(*ROOM_FIELDS):
+        publish_room_change(room)
+
+
+def reload_waiting_rooms():
+    """
+    Reload the index. Nothing is published: each worker already published
+    the diffs of its own changes, and republishing them from every worker
+    would hand lobby clients duplicates.
+    """
+    waiting_rooms.load()
+
+
+# Refresh task of each loop serving lobby sockets
+_refreshers = weakref.WeakKeyDictionary()
+
+
+def refresh_waiting_rooms():
+    """
+    Bind the publisher to the running loop and keep the index fresh from
+    it; called by each lobby connect, starts once per loop
+    """
+    loop = asyncio.get_running_loop()
+    if loop in _refreshers:
+        return
+    lobby_publisher.bind(loop)
+    _refreshers[loop] = loop.create_task(_refresh_loop())
+
+
+async def _refresh_loop():
+    while True:
+        await asyncio.sleep(waiting_rooms.refresh_interval)
+        if not waiting_rooms.is_stale():
+            continue
+        try:
+            await database_sync_to_async(reload_waiting_rooms)()
+        except Exception:
+            logger.exception('Lobby index could not be reloaded')
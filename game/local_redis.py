@@ -0,0 +1,230 @@
+"""
+In-process stand-in for the subset of the Redis API used by the game app.
+
+Used by benchmarks and tests so queues can be exercised without a Redis
+server. Sorted sets keep members ordered by ``(score, member)`` exactly like
+Redis, with O(log n) lookups.
+
+Lua cannot run here, so a module that ``eval``s a script registers a Python
+version of it with ``LocalRedis.script(source)``.
+"""
+import time
+from bisect import bisect_left, bisect_right, insort
+
+
+def _score(value):
+    # Redis accepts '-inf' and '+inf' as score bounds
+    return float(value)
+
+
+def _by_score(entry):
+    return entry[0]
+
+
+class LocalRedis:
+    """Minimal single-process Redis replacement"""
+
+    # Python versions of Lua scripts, by source
+    scripts = {}
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._zsets = {}
+        self._hashes = {}
+        self._sets = {}
+        self._strings = {}
+
+    # Sorted sets
+
+    def zadd(self, key, mapping, nx=False):
+        scores, order = self._zsets.setdefault(key, ({}, []))
+        added = 0
+        for member, score in mapping.items():
+            member = str(member)
+            old = scores.get(member)
+            if old is not None:
+                if nx:
+                    continue
+                del order[bisect_left(order, (old, member))]
+            else:
+                added += 1
+            scores[member] = score
+            insort(order, (score, member))
+        return added
+
+    def zrem(self, key, *members):
+        if key not in self._zsets:
+            return 0
+        scores, order = self._zsets[key]
+        removed = 0
+        for member in members:
+            member = str(member)
+            score = scores.pop(member, None)
+            if score is not None:
+                del order[bisect_left(order, (score, member))]
+                removed += 1
+        return removed
+
+    def zpopmin(self, key, count=1):
+        if key not in self._zsets:
+            return []
+        scores, order = self._zsets[key]
+        popped = order[:count]
+        del order[:count]
+        for _, member in popped:
+            del scores[member]
+        return [(member, score) for score, member in popped]
+
+    def zcard(self, key):
+        return len(self._zsets[key][1]) if key in self._zsets else 0
+
+    def zscore(self, key, member):
+        if key not in self._zsets:
+            return None
+        return self._zsets[key][0].get(str(member))
+
+    def zrange(self, key, start, end):
+        if key not in self._zsets:
+            return []
+        order = self._zsets[key][1]
+        end = len(order) + end + 1 if end < 0 else end + 1
+        return [member for _, member in order[start:end]]
+
+    def _score_range(self, key, min, max):
+        order = self._zsets[key][1]
+        low = bisect_left(order, _score(min), key=_by_score)
+        high = bisect_right(order, _score(max), key=_by_score)
+        # An empty range when min > max, as in Redis
+        return order, low, high if high > low else low
+
+    def zcount(self, key, min, max):
+        if key not in self._zsets:
+            return 0
+        _, low, high = self._score_range(key, min, max)
+        return high - low
+
+    def zrangebyscore(self, key, min, max):
+        if key not in self._zsets:
+            return []
+        order, low, high = self._score_range(key, min, max)
+        return [member for _, member in order[low:high]]
+
+    def zremrangebyscore(self, key, min, max):
+        if key not in self._zsets:
+            return 0
+        order, low, high = self._score_range(key, min, max)
+        scores = self._zsets[key][0]
+        for _, member in order[low:high]:
+            del scores[member]
+        del order[low:high]
+        return high - low
+
+    # Strings, which expire like Redis keys
+
+    def get(self, key):
+        entry = self._strings.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and expires <= self.clock():
+            del self._strings[key]
+            return None
+        return value
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and self.get(key) is not None:
+            return None
+        expires = None if ex is None else self.clock() + ex
+        self._strings[key] = (str(value), expires)
+        return True
+
+    # Hashes
+
+    def hset(self, key, field, value):
+        self._hashes.setdefault(key, {})[str(field)] = str(value)
+
+    def hget(self, key, field):
+        return self._hashes.get(key, {}).get(str(field))
+
+    def hgetall(self, key):
+        return dict(self._hashes.get(key, {}))
+
+    def hdel(self, key, *fields):
+        values = self._hashes.get(key, {})
+        return sum(values.pop(str(field), None) is not None for field in fields)
+
+    # Sets
+
+    def sadd(self, key, *members):
+        values = self._sets.setdefault(key, set())
+        before = len(values)
+        values.update(str(member) for member in members)
+        return len(values) - before
+
+    def srem(self, key, *members):
+        values = self._sets.get(key, set())
+        before = len(values)
+        values.difference_update(str(member) for member in members)
+        return before - len(values)
+
+    def smembers(self, key):
+        return set(self._sets.get(key, ()))
+
+    def delete(self, *keys):
+        removed = 0
+        for key in keys:
+            for store in (self._zsets, self._hashes, self._sets, self._strings):
+                removed += store.pop(key, None) is not None
+        return removed
+
+    def expire(self, key, seconds):
+        if self.get(key) is not None:
+            self._strings[key] = (self._strings[key][0], self.clock() + seconds)
+            return True
+        # Other keys never outlive the process anyway
+        return any(key in store for store in (self._zsets, self._hashes, self._sets))
+
+    # Scripts
+
+    @classmethod
+    def script(cls, source):
+        """
+        Register the decorated ``function(redis, keys, args)`` as the local
+        version of the Lua script ``source``
+        """
+        def register(function):
+            cls.scripts[source] = function
+            return function
+        return register
+
+    def eval(self, script, numkeys, *args):
+        return self.scripts[script](self, list(args[:numkeys]), list(args[numkeys:]))
+
+    def pipeline(self, transaction=True):
+        return _Pipeline(self)
+
+
+class _Pipeline:
+    """Queues calls and runs them on ``execute`` like a redis-py pipeline"""
+
+    def __init__(self, redis):
+        self._redis = redis
+        self._calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self._redis, name)
+
+        def queue(*args, **kwargs):
+            self._calls.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        return [method(*args, **kwargs) for method, args, kwargs in calls]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._calls = []
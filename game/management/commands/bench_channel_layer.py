@@ -0,0 +1,180 @@
+import asyncio
+import random
+import statistics
+import time
+
+from channels_redis.core import RedisChannelLayer
+from django.core.management.base import BaseCommand, CommandError
+
+from game.channel_layer import BatchedRedisChannelLayer
+from game.local_redis import LocalRedis
+
+
+class CountingRedis:
+    """Async redis-py look-alike over LocalRedis that counts round trips"""
+
+    def __init__(self, latency=0.0):
+        self.redis = LocalRedis()
+        self.latency = latency
+        self.round_trips = 0
+        self.pushed = 0
+
+    async def round_trip(self):
+        self.round_trips += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def command(self, name):
+        if name in ('zrange', 'eval'):
+            return getattr(self, f'_{name}')
+        return getattr(self.redis, name)
+
+    def __getattr__(self, name):
+        method = self.command(name)
+
+        async def call(*args, **kwargs):
+            await self.round_trip()
+            return method(*args, **kwargs)
+        return call
+
+    def pipeline(self, transaction=True):
+        return _CountingPipeline(self)
+
+    def _zrange(self, key, start, end):
+        return [member.encode() for member in self.redis.zrange(key, start, end)]
+
+    def _eval(self, script, numkeys, *args):
+        # Only the channel layer's push script is used: add each message to
+        # its key when the key is under capacity
+        keys, messages, capacities = args[:numkeys], args[numkeys:2 * numkeys], args[2 * numkeys:-2]
+        now = args[-2]
+        over_capacity = 0
+        for key, message, capacity in zip(keys, messages, capacities):
+            if self.redis.zcard(key) < int(capacity):
+                self.redis.zadd(key, {message: now})
+                self.pushed += 1
+            else:
+                over_capacity += 1
+        return over_capacity
+
+
+class _CountingPipeline:
+    def __init__(self, counting):
+        self._counting = counting
+        self._calls = []
+
+    def __getattr__(self, name):
+        method = self._counting.command(name)
+
+        def queue(*args, **kwargs):
+            self._calls.append((method, args, kwargs))
+            return self
+        return queue
+
+    async def execute(self):
+        calls, self._calls = self._calls, []
+        await self._counting.round_trip()
+        return [method(*args, **kwargs) for method, args, kwargs in calls]
+
+
+def counting_layer(base, latency):
+    class CountingLayer(base):
+        def connection(self, index):
+            return self.redis
+
+    layer = CountingLayer(capacity=1_000_000)
+    layer.redis = CountingRedis(latency)
+    return layer
+
+
+SCENARIOS = {
+    'lockstep': 'every room acts at once',
+    'staggered': 'rooms act at random intervals',
+    'single': 'one room on its own',
+}
+
+
+class Command(BaseCommand):
+    help = 'Benchmark Redis round trips per game action: RedisChannelLayer vs BatchedRedisChannelLayer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=250)
+        parser.add_argument('--players', type=int, default=4,
+                            help='Sockets per room group')
+        parser.add_argument('--lobby-clients', type=int, default=50)
+        parser.add_argument('--actions', type=int, default=20,
+                            help='Game actions per room')
+        parser.add_argument('--latency', type=float, default=0.5,
+                            help='Simulated Redis round-trip time in ms')
+        parser.add_argument('--think', type=float, default=200.0,
+                            help='Mean pause between actions of a room in the staggered scenario, in ms')
+        parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                            help=f'Comma-separated, from: {", ".join(SCENARIOS)}')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        scenarios = [name for name in options['scenarios'].split(',') if name]
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f'Unknown scenarios: {", ".join(sorted(unknown))}')
+
+        self.stdout.write(
+            f'{options["actions"]} actions per room (dice roll + move + lobby update), '
+            f'{options["latency"]} ms per round trip'
+        )
+        for scenario in scenarios:
+            rooms = 1 if scenario == 'single' else options['rooms']
+            results = {}
+            for base in (RedisChannelLayer, BatchedRedisChannelLayer):
+                layer = counting_layer(base, options['latency'] / 1000)
+                results[base.__name__] = asyncio.run(self.run(layer, scenario, rooms, options))
+            self.report(scenario, rooms, results, rooms * options['actions'])
+
+    def report(self, scenario, rooms, results, actions):
+        self.stdout.write(f'\n{scenario}: {rooms} rooms, {SCENARIOS[scenario]}')
+        for name, (round_trips, elapsed, delivered, latencies) in results.items():
+            self.stdout.write(
+                f'  {name:26} {round_trips:8} round trips  '
+                f'{round_trips / actions:7.3f} per action  '
+                f'{actions / elapsed:9,.0f} actions/sec  '
+                f'{statistics.mean(latencies) * 1000:6.2f} ms per action  '
+                f'{delivered} messages delivered'
+            )
+
+        (plain, _, plain_delivered, _), (batched, _, batched_delivered, _) = results.values()
+        if plain_delivered != batched_delivered:
+            self.stdout.write(self.style.ERROR('Batched layer delivered a different number of messages'))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f'  {(plain - batched) / actions:.2f} round trips saved per game action '
+                f'({plain / max(batched, 1):.1f}x fewer)'
+            ))
+
+    async def run(self, layer, scenario, rooms, options):
+        for room in range(rooms):
+            for seat in range(options['players']):
+                await layer.group_add(f'game_{room}', f'socket.{room}-{seat}')
+        for client in range(options['lobby_clients']):
+            await layer.group_add('lobby_5', f'lobby.{client}')
+        layer.redis.round_trips = 0
+        # Same pauses for both layers
+        rng = random.Random(options['seed'])
+        think = options['think'] / 1000 if scenario == 'staggered' else 0
+        pauses = [[rng.uniform(0, 2 * think) for _ in range(options['actions'])] for _ in range(rooms)]
+        latencies = []
+
+        async def play(room):
+            group = f'game_{room}'
+            for pause in pauses[room]:
+                if pause:
+                    await asyncio.sleep(pause)
+                sent = time.perf_counter()
+                await layer.group_send(group, {'type': 'broadcast.frame', 'text': 'dice_rolled'})
+                await layer.group_send(group, {'type': 'broadcast.frame', 'text': 'piece_moved'})
+                await layer.group_send('lobby_5', {'type': 'broadcast.frame', 'text': 'lobby_update'})
+                latencies.append(time.perf_counter() - sent)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(play(room) for room in range(rooms)))
+        elapsed = time.perf_counter() - start
+        return layer.redis.round_trips, elapsed, layer.redis.pushed, latencies
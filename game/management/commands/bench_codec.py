@@ -0,0 +1,64 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from game.protocol import decode_frame, encode_event
+
+
+SAMPLE_EVENTS = [
+    {
+        'type': 'dice_rolled',
+        'user': 'player_one',
+        'color': 'blue',
+        'dice_value': 6,
+        'legal_moves': [0, 2, 3],
+        'version': 1042,
+    },
+    {
+        'type': 'piece_moved',
+        'user': 'player_one',
+        'color': 'blue',
+        'piece_id': 2,
+        'from_position': 17,
+        'to_position': 23,
+        'captured': 0,
+        'version': 1043,
+    },
+]
+
+
+class Command(BaseCommand):
+    help = 'Compare JSON and binary encodings of hot game events'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=200000)
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+
+        for event in SAMPLE_EVENTS:
+            assert decode_frame(encode_event(event))['version'] == event['version']
+
+            json_size = len(json.dumps(event).encode())
+            binary_size = len(encode_event(event))
+            json_rate = self._rate(lambda: json.dumps(event), iterations)
+            binary_rate = self._rate(lambda: encode_event(event), iterations)
+
+            self.stdout.write(self.style.MIGRATE_HEADING(event['type']))
+            self.stdout.write(
+                f'  json:   {json_size:4d} bytes  {json_rate:12,.0f} encodes/sec'
+            )
+            self.stdout.write(
+                f'  binary: {binary_size:4d} bytes  {binary_rate:12,.0f} encodes/sec'
+            )
+            self.stdout.write(self.style.SUCCESS(
+                f'  {json_size / binary_size:.1f}x smaller, '
+                f'{binary_rate / json_rate:.1f}x faster'
+            ))
+
+    def _rate(self, encode, iterations):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            encode()
+        return iterations / (time.perf_counter() - start)
@@ -0,0 +1,43 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from game.engine import LudoBoard
+
+
+class Command(BaseCommand):
+    help = 'Microbenchmark the Ludo rules engine (moves/sec)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--games', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        games = options['games']
+        # Pre-roll dice so the RNG is not part of the measurement
+        dice = [rng.randint(1, 6) for _ in range(1 << 16)]
+        mask = len(dice) - 1
+
+        moves = rolls = 0
+        d = 0
+        start = time.perf_counter()
+        for _ in range(games):
+            board = LudoBoard()
+            while board.winner is None:
+                seat = board.turn
+                legal = board.roll(seat, dice[d & mask])
+                d += 1
+                rolls += 1
+                if legal:
+                    board.move(seat, legal[-1])
+                    moves += 1
+        elapsed = time.perf_counter() - start
+
+        self.stdout.write(
+            f'{games} games, {rolls} rolls, {moves} moves in {elapsed:.3f}s'
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'{moves / elapsed:,.0f} moves/sec, {(rolls + moves) / elapsed:,.0f} actions/sec'
+        ))
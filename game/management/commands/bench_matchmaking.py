@@ -0,0 +1,52 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from game.local_redis import LocalRedis
+from game.matchmaking import Matcher, MatchQueue
+
+
+class Command(BaseCommand):
+    help = 'Benchmark matchmaking enqueue throughput and time-to-match'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--players', type=int, default=100000)
+        parser.add_argument('--rate', type=int, default=5000,
+                            help='Enqueues per second')
+        parser.add_argument('--tick', type=float, default=0.05,
+                            help='Matcher interval in seconds')
+        parser.add_argument('--bets', default='1,2,5,10,25,50,100')
+
+    def handle(self, *args, **options):
+        rng = random.Random(7)
+        bets = options['bets'].split(',')
+        queue = MatchQueue(LocalRedis())
+        # Rooms are not written to the database here, only queue work is measured
+        matcher = Matcher(queue, on_match=lambda bet, user_ids: ('bench', []),
+                          notify=lambda notifications: None)
+
+        players = options['players']
+        per_tick = max(1, int(options['rate'] * options['tick']))
+        enqueue_time = 0.0
+
+        user_id = 0
+        while user_id < players:
+            tick_start = time.perf_counter()
+            for _ in range(min(per_tick, players - user_id)):
+                user_id += 1
+                queue.enqueue(user_id, rng.choice(bets))
+            enqueue_time += time.perf_counter() - tick_start
+
+            matcher.run_once()
+            elapsed = time.perf_counter() - tick_start
+            if elapsed < options['tick']:
+                time.sleep(options['tick'] - elapsed)
+        matcher.run_once()
+
+        stats = matcher.stats()
+        self.stdout.write(f'{players} players, {stats["matches"]} tables matched')
+        self.stdout.write(f'enqueue: {players / enqueue_time:,.0f} ops/sec')
+        self.stdout.write(self.style.SUCCESS(
+            f'time-to-match p50 {stats["p50_ms"]} ms, p99 {stats["p99_ms"]} ms'
+        ))
@@ -0,0 +1,71 @@
+import asyncio
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from game.timers import TimerWheel
+
+
+class Command(BaseCommand):
+    help = 'Benchmark turn-timer overhead: timer wheel vs one call_later per room'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=50000)
+        parser.add_argument('--turns', type=int, default=10,
+                            help='Deadline resets per room')
+        parser.add_argument('--timeout', type=float, default=30.0)
+
+    def handle(self, *args, **options):
+        rooms = options['rooms']
+        turns = options['turns']
+        timeout = options['timeout']
+        rng = random.Random(3)
+        noop = lambda room_id: None  # noqa: E731
+
+        # Timer wheel driven by a virtual clock
+        clock = [0.0]
+        wheel = TimerWheel(tick=0.1, clock=lambda: clock[0])
+        start = time.perf_counter()
+        timers = [wheel.schedule(timeout, noop, room_id) for room_id in range(rooms)]
+        for _ in range(turns):
+            for timer in timers:
+                wheel.reschedule(timer, timeout * rng.random())
+        wheel_schedule = time.perf_counter() - start
+
+        ticks = int(timeout / wheel.tick) + 1
+        start = time.perf_counter()
+        for _ in range(ticks):
+            clock[0] += wheel.tick
+            wheel.advance()
+        wheel_fire = time.perf_counter() - start
+
+        # Baseline: one loop handle per room, cancelled and recreated per turn
+        async def call_later_baseline():
+            loop = asyncio.get_running_loop()
+            start = time.perf_counter()
+            handles = [loop.call_later(timeout, noop, room_id) for room_id in range(rooms)]
+            for _ in range(turns):
+                for room_id, handle in enumerate(handles):
+                    handle.cancel()
+                    handles[room_id] = loop.call_later(timeout * rng.random(), noop, room_id)
+            elapsed = time.perf_counter() - start
+            for handle in handles:
+                handle.cancel()
+            return elapsed
+
+        baseline = asyncio.run(call_later_baseline())
+
+        operations = rooms * (turns + 1)
+        self.stdout.write(f'{rooms} rooms, {operations} schedule/reschedule operations')
+        self.stdout.write(
+            f'  timer wheel: {operations / wheel_schedule:12,.0f} ops/sec, '
+            f'{wheel.fired} fired over {ticks} ticks '
+            f'({wheel_fire / ticks * 1000:.3f} ms/tick)'
+        )
+        self.stdout.write(
+            f'  call_later:  {operations / baseline:12,.0f} ops/sec'
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'  wheel is {baseline / wheel_schedule:.1f}x faster at rescheduling'
+        ))
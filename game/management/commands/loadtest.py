@@ -0,0 +1,297 @@
+import asyncio
+import json
+import random
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from game import routing
+from game.actors import RoomActor
+from game.chat import chat_buffer
+from game.engine import COLORS, get_board
+from game.lobby import bet_band, notify_lobby, waiting_rooms
+from game.move_buffer import move_buffer
+from game.protocol import BINARY_SUBPROTOCOL, decode_frame
+from game.state_log import get_room_state
+
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 250, 500, 1000)
+
+
+class Stats:
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.latencies = []
+        self.events = defaultdict(int)
+        self.cpu = defaultdict(float)
+        self.reconnects = 0
+        self.games_finished = 0
+
+
+class Command(BaseCommand):
+    help = (
+        'Drive GameConsumer and LobbyConsumer with simulated players through '
+        'the channels test communicator and report throughput, broadcast '
+        'latency and CPU cost per event'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=250,
+                            help='Concurrent 4-player rooms')
+        parser.add_argument('--lobby-clients', type=int, default=1000)
+        parser.add_argument('--duration', type=float, default=30.0)
+        parser.add_argument('--action-delay', type=float, default=0.0,
+                            help='Think time between a player\'s actions in seconds')
+        parser.add_argument('--chat-rate', type=float, default=0.05,
+                            help='Chance of a chat message after each action')
+        parser.add_argument('--disconnect-rate', type=float, default=0.01,
+                            help='Chance of a player dropping and resuming after each action')
+        parser.add_argument('--lobby-updates', type=float, default=5.0,
+                            help='Lobby update batches pushed per second')
+        parser.add_argument('--channel-layer', choices=['memory', 'configured'], default='memory',
+                            help='InMemoryChannelLayer, or CHANNEL_LAYERS from settings (e.g. Redis). '
+                                 'The in-memory layer scans every channel on receive, so it '
+                                 'understates capacity beyond a few hundred sockets')
+        parser.add_argument('--binary', action='store_true',
+                            help='Negotiate the binary subprotocol')
+        parser.add_argument('--calibration-actions', type=int, default=2000,
+                            help='Actions played in an isolated room to measure CPU per event')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        # Rooms are synthetic, keep them out of the database: no moves, chat,
+        # restores or settlement
+        move_buffer.dry_run = True
+        chat_buffer.dry_run = True
+        RoomActor.dry_run = True
+        if options['channel_layer'] == 'memory':
+            layers = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+        else:
+            layers = settings.CHANNEL_LAYERS
+        # Simulated players act as fast as the server answers
+        with override_settings(CHANNEL_LAYERS=layers, WS_RATE_LIMITS={}, WS_ROOM_RATE_LIMITS={}):
+            stats, wall, cpu, calibration = asyncio.run(self.run(options))
+        self.report(stats, wall, cpu, calibration, options)
+
+    async def run(self, options):
+        self.options = options
+        self.rng = random.Random(options['seed'])
+        self.application = URLRouter(routing.websocket_urlpatterns)
+        stats = Stats()
+
+        deadline = time.monotonic() + options['duration']
+        waiting_rooms.prime([])
+        # Nothing to reload from: the database is not used
+        waiting_rooms.refresh_interval = float('inf')
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        lobby = [self.lobby_client(i, stats, deadline) for i in range(options['lobby_clients'])]
+        rooms = [self.play_room(i, stats, deadline) for i in range(options['rooms'])]
+        await asyncio.gather(self.lobby_feed(deadline), *lobby, *rooms)
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+
+        calibration = await self.calibrate(options)
+        return stats, wall, cpu, calibration
+
+    async def calibrate(self, options):
+        """Play a single room with nothing else running to isolate CPU per event"""
+        self.options = dict(options, chat_rate=0.1, disconnect_rate=0, action_delay=0)
+        stats = Stats()
+        index = options['rooms']
+        while sum(stats.events.values()) < options['calibration_actions']:
+            index += 1
+            await self.play_room(index, stats, time.monotonic() + 60)
+        return stats
+
+    def make_user(self, user_id):
+        return SimpleNamespace(
+            id=user_id,
+            pk=user_id,
+            username=f'load_{user_id}',
+            is_authenticated=True,
+        )
+
+    async def open_socket(self, path, user):
+        subprotocols = [BINARY_SUBPROTOCOL] if self.options['binary'] else None
+        communicator = WebsocketCommunicator(self.application, path, subprotocols=subprotocols)
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect(timeout=10)
+        if not connected:
+            raise RuntimeError(f'Connection to {path} refused')
+        return communicator
+
+    async def receive(self, client, stats, timeout=10):
+        frame = await client.receive_from(timeout)
+        stats.frames += 1
+        stats.bytes += len(frame)
+        if isinstance(frame, bytes):
+            return decode_frame(frame)
+        return json.loads(frame)
+
+    async def play_room(self, index, stats, deadline):
+        room_id = f'load-{index}'
+        users = [self.make_user(index * 4 + seat + 1) for seat in range(4)]
+
+        # Seed the cached roster so consumers never query the database
+        get_room_state(room_id).snapshot = {
+            'id': index + 1,
+            'room_id': room_id,
+            'status': 'in_progress',
+            'bet_amount': 5.0,
+            'current_players': 4,
+            'players': [
+                {
+                    'id': user.id,
+                    'user_id': user.id,
+                    'username': user.username,
+                    'color': color,
+                    'position': seat + 1,
+                } for seat, (user, color) in enumerate(zip(users, COLORS))
+            ],
+        }
+        path = f'ws/game/{room_id}/'
+        clients = [await self.open_socket(path, user) for user in users]
+        versions = [0] * 4
+        for client in clients:
+            epoch = (await self.receive(client, stats))['epoch']
+
+        board = get_board(room_id)
+        while time.monotonic() < deadline and board.winner is None:
+            seat = board.turn
+            await self.act(clients, versions, seat, {'type': 'roll_dice'}, 'dice_rolled', stats)
+            if board.dice and board.winner is None:
+                piece_id = board.legal_moves(seat, board.dice)[0]
+                await self.act(clients, versions, seat, {
+                    'type': 'move_piece', 'piece_id': piece_id
+                }, 'piece_moved', stats)
+            if board.winner is not None:
+                # The actor has stopped and rejects anything else
+                break
+
+            if self.rng.random() < self.options['chat_rate']:
+                await self.act(clients, versions, seat, {
+                    'type': 'chat_message', 'message': 'gg'
+                }, 'chat_message', stats)
+
+            if self.rng.random() < self.options['disconnect_rate']:
+                victim = self.rng.randrange(4)
+                await clients[victim].disconnect()
+                clients[victim] = await self.open_socket(
+                    f'{path}?since={versions[victim]}&epoch={epoch}', users[victim]
+                )
+                await self.receive(clients[victim], stats)
+                stats.reconnects += 1
+
+            if self.options['action_delay']:
+                await asyncio.sleep(self.options['action_delay'])
+
+        if board.winner is not None:
+            stats.games_finished += 1
+        for client in clients:
+            await client.disconnect()
+
+    async def act(self, clients, versions, seat, message, expected, stats):
+        """Send one action and wait until every player has seen its broadcast"""
+        cpu_start = time.process_time()
+        sent = time.perf_counter()
+        await clients[seat].send_to(text_data=json.dumps(message))
+        for i, client in enumerate(clients):
+            while True:
+                event = await self.receive(client, stats)
+                versions[i] = event.get('version', versions[i])
+                if event['type'] == expected:
+                    stats.latencies.append(time.perf_counter() - sent)
+                    break
+        stats.events[expected] += 1
+        stats.cpu[expected] += time.process_time() - cpu_start
+
+    async def lobby_client(self, index, stats, deadline):
+        client = await self.open_socket('ws/lobby/', self.make_user(1000000 + index))
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # Wait on the output queue directly: a communicator receive
+            # timeout would cancel the consumer
+            try:
+                message = await asyncio.wait_for(client.output_queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            frame = message.get('text') or message.get('bytes') or ''
+            stats.frames += 1
+            stats.bytes += len(frame)
+        await client.disconnect()
+
+    async def lobby_feed(self, deadline):
+        """Push synthetic lobby_updates batches like the lobby publisher does"""
+        if not self.options['lobby_updates']:
+            return
+        channel_layer = get_channel_layer()
+        interval = 1 / self.options['lobby_updates']
+        n = 0
+        while time.monotonic() < deadline:
+            n += 1
+            bet_amount = self.rng.choice((1.0, 5.0, 25.0, 100.0))
+            await notify_lobby(channel_layer, bet_band(bet_amount), {
+                'type': 'lobby_updates',
+                'band': bet_band(bet_amount),
+                'changes': [{
+                    'type': 'room_updated',
+                    'room': {
+                        'room_id': f'lobby-{n}',
+                        'bet_amount': bet_amount,
+                        'current_players': self.rng.randint(1, 3),
+                        'max_players': 4,
+                    },
+                }],
+            })
+            await asyncio.sleep(interval)
+
+    def report(self, stats, wall, cpu, calibration, options):
+        self.stdout.write(self.style.MIGRATE_HEADING('Load test results'))
+        self.stdout.write(
+            f'  {options["rooms"]} rooms ({options["rooms"] * 4} players), '
+            f'{options["lobby_clients"]} lobby clients, {wall:.1f}s wall, {cpu:.1f}s CPU'
+        )
+        self.stdout.write(
+            f'  {stats.frames:,} frames received ({stats.frames / wall:,.0f} msg/sec, '
+            f'{stats.bytes / wall / 1024:,.0f} KiB/sec)'
+        )
+        self.stdout.write(
+            f'  {stats.games_finished} games finished, {stats.reconnects} reconnects'
+        )
+
+        latencies = sorted(stats.latencies)
+        if latencies:
+            def pct(p):
+                return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+            self.stdout.write(self.style.MIGRATE_HEADING('Broadcast latency'))
+            self.stdout.write(
+                f'  p50 {pct(0.5):.2f} ms  p90 {pct(0.9):.2f} ms  '
+                f'p99 {pct(0.99):.2f} ms  max {latencies[-1] * 1000:.2f} ms'
+            )
+            lower = 0
+            for bucket in LATENCY_BUCKETS_MS + (float('inf'),):
+                count = sum(1 for latency in latencies if lower <= latency * 1000 < bucket)
+                label = f'< {bucket} ms' if bucket != float('inf') else f'>= {lower} ms'
+                self.stdout.write(f'  {label:>10}  {count:8d}  {"#" * (60 * count // len(latencies))}')
+                lower = bucket
+
+        actions = sum(stats.events.values())
+        self.stdout.write(self.style.MIGRATE_HEADING('CPU per event'))
+        if actions:
+            self.stdout.write(f'  under load: {cpu / actions * 1e6:.1f} us per action (all work / actions)')
+        self.stdout.write('  isolated room (client + server in one process):')
+        for event, count in sorted(calibration.events.items()):
+            self.stdout.write(
+                f'    {event:14s} {count:8d} events  {calibration.cpu[event] / count * 1e6:8.1f} us/event'
+            )
@@ -0,0 +1,119 @@
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+from game.engine import LudoBoard
+from game.models import GameRoom
+from game.replay import bulk_replay, replay_moves, restore_board, audit_room
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild games from their GameMove log: restore one room from its '
+        'nearest checkpoint, or audit many rooms across a process pool'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room', help='room_id to restore')
+        parser.add_argument('--upto', type=int,
+                            help='Restore the board as of this move number')
+        parser.add_argument('--status', default='completed',
+                            help='Audit rooms with this status')
+        parser.add_argument('--limit', type=int)
+        parser.add_argument('--processes', type=int,
+                            help='Worker processes (default: CPU count, 0 = no pool)')
+        parser.add_argument('--synthetic', type=int, metavar='GAMES',
+                            help='Audit GAMES engine-generated games instead of the database')
+
+    def handle(self, *args, **options):
+        if options['room']:
+            self.restore(options['room'], options['upto'])
+        elif options['synthetic']:
+            self.synthetic(options['synthetic'], options['processes'])
+        else:
+            self.audit(options)
+
+    def restore(self, room_id, upto):
+        try:
+            room = GameRoom.objects.get(room_id=room_id)
+        except GameRoom.DoesNotExist:
+            raise CommandError(f'Room {room_id} not found')
+
+        start = time.perf_counter()
+        full = restore_board(room.id, upto, store=None)
+        full_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        board = restore_board(room.id, upto)
+        checkpoint_ms = (time.perf_counter() - start) * 1000
+
+        self.stdout.write(f'{room_id} as of move {board.move_number}: {board.snapshot()}')
+        self.stdout.write(
+            f'  full replay {full_ms:.1f} ms, from checkpoint {checkpoint_ms:.1f} ms'
+        )
+        if full.to_bytes() != board.to_bytes():
+            raise CommandError('Checkpoint restore disagrees with a full replay')
+
+    def audit(self, options):
+        rooms = GameRoom.objects.filter(status=options['status']).order_by('id')
+        room_ids = list(rooms.values_list('id', flat=True)[:options['limit']])
+        self.report(bulk_replay(room_ids, processes=options['processes']))
+
+    def synthetic(self, games, processes):
+        rng = random.Random(7)
+        seats = {seat + 1: seat for seat in range(4)}
+        jobs = []
+        for game in range(games):
+            board = LudoBoard()
+            moves = []
+            while board.winner is None:
+                seat = board.turn
+                dice = rng.randint(1, 6)
+                legal = board.roll(seat, dice)
+                if legal:
+                    piece = rng.choice(legal)
+                    from_step, to_step, _ = board.move(seat, piece)
+                    moves.append((seat + 1, dice, piece, from_step, to_step, board.move_number))
+            jobs.append((game, seats, moves))
+
+        start = time.perf_counter()
+        for seat_map, moves in ((job[1], job[2]) for job in jobs):
+            replay_moves(seat_map, moves)
+        serial = time.perf_counter() - start
+        total = sum(len(job[2]) for job in jobs)
+        self.stdout.write(f'{games} games, {total} moves')
+        self.stdout.write(f'  in process: {total / serial:12,.0f} moves/sec')
+
+        if processes != 0:
+            workers = processes or os.cpu_count()
+            start = time.perf_counter()
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(audit_room, jobs, chunksize=64))
+            pooled = time.perf_counter() - start
+            self.stdout.write(
+                f'  pool ({workers} workers): {total / pooled:12,.0f} moves/sec'
+            )
+            self.report(results, summary_only=True)
+
+    def report(self, results, summary_only=False):
+        rooms = moves = failed = 0
+        start = time.perf_counter()
+        for result in results:
+            rooms += 1
+            moves += result['moves']
+            if not result['ok']:
+                failed += 1
+                self.stdout.write(self.style.ERROR(
+                    f'  room {result["game_room_id"]}: {result["error"]}'
+                ))
+        elapsed = time.perf_counter() - start
+
+        if not summary_only:
+            self.stdout.write(
+                f'Replayed {rooms} rooms, {moves} moves in {elapsed:.2f}s '
+                f'({moves / max(elapsed, 1e-9):,.0f} moves/sec)'
+            )
+        style = self.style.ERROR if failed else self.style.SUCCESS
+        self.stdout.write(style(f'{rooms - failed}/{rooms} rooms replayed cleanly'))
@@ -0,0 +1,32 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from game.matchmaking import Matcher, match_queue
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Run the matchmaking loop that turns queued players into rooms'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0.05,
+                            help='Seconds to sleep when no table was matched')
+        parser.add_argument('--stats-every', type=float, default=30.0,
+                            help='Seconds between time-to-match reports')
+
+    def handle(self, *args, **options):
+        matcher = Matcher(match_queue)
+        interval = options['interval']
+        next_report = time.monotonic() + options['stats_every']
+
+        self.stdout.write(self.style.SUCCESS('Matchmaker started'))
+        while True:
+            if not matcher.run_once():
+                time.sleep(interval)
+
+            if time.monotonic() >= next_report:
+                logger.info('Matchmaker stats: %s', matcher.stats())
+                next_report = time.monotonic() + options['stats_every']
@@ -0,0 +1,299 @@
+"""
+Automatic matchmaking.
+
+Players enqueue with a bet amount. Each bet amount has its own Redis sorted
+set scored by enqueue time, so an enqueue is a single O(log n) ``ZADD`` and
+the oldest waiting players are matched first. A background matcher
+(``manage.py run_matchmaker``) pops full tables, creates the room and its
+players in one transaction and notifies the players on their personal
+channel group.
+
+Popping a table and forgetting its players' queue entries is one script
+(``POP_TABLES_LUA``). A ``cancel`` therefore either removes the player
+before the pop or finds them gone and fails. It can never succeed for a
+player who is then charged, and a failed match only requeues players who
+had not cancelled. Notifications go out after the room is committed, for
+the whole run at once, outside the requeue path: a channel layer error is
+logged and never matches or charges anyone again. Players dropped for an
+insufficient balance get a ``match_failed`` notification.
+"""
+import logging
+import time
+from collections import deque
+from decimal import Decimal
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .engine import COLORS
+from .local_redis import LocalRedis
+from .models import GameRoom, GamePlayer, Transaction
+from .protocol import make_frame
+from users import ledger
+from users.ledger import ESCROW, user_account
+from users.wallet import InsufficientBalance
+
+logger = logging.getLogger(__name__)
+
+TABLE_SIZE = 4
+# Tables popped per script call, so one call never blocks Redis for long
+MAX_TABLES_PER_POP = 100
+
+BETS_KEY = 'mm:bets'
+USERS_KEY = 'mm:users'
+
+
+# Pop up to ARGV[2] tables of ARGV[1] players from queue KEYS[1], forget
+# them in the users hash KEYS[2] and drop bet ARGV[3] from KEYS[3] once
+# its queue is empty. Returns one flat member, score list per table.
+POP_TABLES_LUA = """
+    local size = tonumber(ARGV[1])
+    local tables = {}
+    while #tables < tonumber(ARGV[2]) and redis.call('ZCARD', KEYS[1]) >= size do
+        local entries = redis.call('ZPOPMIN', KEYS[1], size)
+        for i = 1, #entries, 2 do
+            redis.call('HDEL', KEYS[2], entries[i])
+        end
+        tables[#tables + 1] = entries
+    end
+    if redis.call('ZCARD', KEYS[1]) == 0 then
+        redis.call('SREM', KEYS[3], ARGV[3])
+    end
+    return tables
+"""
+
+
+@LocalRedis.script(POP_TABLES_LUA)
+def _pop_tables_local(redis, keys, args):
+    queue, users, bets = keys
+    size, limit, bet = int(args[0]), int(args[1]), args[2]
+    tables = []
+    while len(tables) < limit and redis.zcard(queue) >= size:
+        entries = redis.zpopmin(queue, size)
+        redis.hdel(users, *[member for member, _ in entries])
+        tables.append([value for entry in entries for value in entry])
+    if redis.zcard(queue) == 0:
+        redis.srem(bets, bet)
+    return tables
+
+
+def queue_key(bet):
+    return f'mm:queue:{bet}'
+
+
+def user_group(user_id):
+    """Channel group every socket of a user joins for personal notifications"""
+    return f'user_{user_id}'
+
+
+def normalize_bet(amount):
+    return str(Decimal(amount).quantize(Decimal('0.01')))
+
+
+_redis = None
+
+
+def get_redis():
+    global _redis
+    if _redis is None:
+        import redis
+        _redis = redis.Redis.from_url(
+            settings.MATCHMAKING_REDIS_URL, decode_responses=True
+        )
+    return _redis
+
+
+class MatchQueue:
+    """Per-bet FIFO queues of waiting players"""
+
+    def __init__(self, redis=None):
+        self._redis = redis
+
+    @property
+    def redis(self):
+        return self._redis if self._redis is not None else get_redis()
+
+    def enqueue(self, user_id, bet_amount, enqueued_at=None):
+        """Queue a player; re-queueing at another bet moves them"""
+        bet = normalize_bet(bet_amount)
+        previous = self.redis.hget(USERS_KEY, user_id)
+        pipe = self.redis.pipeline()
+        if previous is not None and previous != bet:
+            pipe.zrem(queue_key(previous), user_id)
+        # nx keeps the original enqueue time on retries
+        pipe.zadd(queue_key(bet), {user_id: enqueued_at or time.time()}, nx=True)
+        pipe.sadd(BETS_KEY, bet)
+        pipe.hset(USERS_KEY, user_id, bet)
+        pipe.execute()
+
+    def cancel(self, user_id):
+        """Leave the queue; False when not queued or already popped into a table"""
+        bet = self.redis.hget(USERS_KEY, user_id)
+        if bet is None:
+            return False
+        pipe = self.redis.pipeline()
+        pipe.zrem(queue_key(bet), user_id)
+        pipe.hdel(USERS_KEY, user_id)
+        removed, _ = pipe.execute()
+        return bool(removed)
+
+    def requeue(self, bet, entries):
+        """Put players back with their original enqueue times"""
+        if not entries:
+            return
+        pipe = self.redis.pipeline()
+        pipe.zadd(queue_key(bet), {user_id: score for user_id, score in entries})
+        pipe.sadd(BETS_KEY, bet)
+        for user_id, _ in entries:
+            pipe.hset(USERS_KEY, user_id, bet)
+        pipe.execute()
+
+    def bets(self):
+        return self.redis.smembers(BETS_KEY)
+
+    def pop_tables(self, bet, size=TABLE_SIZE, limit=MAX_TABLES_PER_POP):
+        """Pop up to ``limit`` full tables of ``(user_id, score)`` entries for ``bet``"""
+        tables = self.redis.eval(POP_TABLES_LUA, 3, queue_key(bet), USERS_KEY, BETS_KEY, size, limit, bet)
+        return [
+            [(str(table[i]), float(table[i + 1])) for i in range(0, len(table), 2)]
+            for table in tables
+        ]
+
+
+def create_match_room(bet_amount, user_ids):
+    """
+    Charge every player and create the room and its players in one batch.
+
+    Returns ``(room_id, unpaid)``. When some players could not pay,
+    ``unpaid`` lists them, nothing is written and the caller decides what
+    to do with the rest.
+    """
+    with transaction.atomic():
+        game_room = GameRoom.objects.create(
+            bet_amount=bet_amount,
+            commission_percentage=Decimal('2.00'),
+            current_players=len(user_ids),
+            status='in_progress',
+            started_at=timezone.now()
+        )
+        unpaid = []
+        for user_id in user_ids:
+            try:
+                ledger.transfer(user_account(user_id), ESCROW, bet_amount, 'bet_placed',
+                                reference=game_room.room_id)
+            except InsufficientBalance:
+                unpaid.append(user_id)
+        if unpaid:
+            transaction.set_rollback(True)
+            return None, unpaid
+
+        GamePlayer.objects.bulk_create([
+            GamePlayer(
+                game_room=game_room,
+                user_id=user_id,
+                color=color,
+                position=position,
+                bet_paid=True
+            )
+            for position, (user_id, color) in enumerate(zip(user_ids, COLORS), start=1)
+        ])
+        Transaction.objects.bulk_create([
+            Transaction(
+                user_id=user_id,
+                game_room=game_room,
+                transaction_type='bet_placed',
+                amount=bet_amount,
+                status='completed',
+                description=f'Matched into room {game_room.room_id}'
+            )
+            for user_id in user_ids
+        ])
+        game_room.calculate_pool()
+    return str(game_room.room_id), []
+
+
+def notify_players(notifications):
+    """Send ``(user_id, event)`` notifications in one trip to the event loop"""
+    channel_layer = get_channel_layer()
+
+    async def send_all():
+        for user_id, event in notifications:
+            await channel_layer.group_send(user_group(user_id), make_frame(event))
+
+    async_to_sync(send_all)()
+
+
+class Matcher:
+    """Groups queued players into tables and tracks time-to-match"""
+
+    def __init__(self, queue, on_match=create_match_room, notify=notify_players,
+                 table_size=TABLE_SIZE, window=10000):
+        self.queue = queue
+        self.on_match = on_match
+        self.notify = notify
+        self.table_size = table_size
+        self.matches = 0
+        # Recent time-to-match samples in seconds
+        self.waits = deque(maxlen=window)
+
+    def run_once(self):
+        """Match every full table currently queued; returns tables created"""
+        created = 0
+        notifications = []
+        for bet in self.queue.bets():
+            for table in self.queue.pop_tables(bet, self.table_size):
+                user_ids = [int(user_id) for user_id, _ in table]
+                try:
+                    room_id, unpaid = self.on_match(Decimal(bet), user_ids)
+                except Exception:
+                    logger.exception('Failed to create room for bet %s', bet)
+                    self.queue.requeue(bet, table)
+                    continue
+
+                if unpaid:
+                    # Drop players who can no longer pay, keep the rest waiting
+                    notifications.extend((user_id, {
+                        'type': 'match_failed',
+                        'bet_amount': float(bet),
+                        'message': 'Insufficient balance',
+                    }) for user_id in unpaid)
+                    unpaid = {str(user_id) for user_id in unpaid}
+                    self.queue.requeue(bet, [
+                        (user_id, score) for user_id, score in table if user_id not in unpaid
+                    ])
+                    continue
+
+                notifications.extend((user_id, {
+                    'type': 'match_found',
+                    'room_id': room_id,
+                    'bet_amount': float(bet),
+                    'color': color,
+                }) for user_id, color in zip(user_ids, COLORS))
+                now = time.time()
+                self.waits.extend(now - float(score) for _, score in table)
+                self.matches += 1
+                created += 1
+
+        if notifications:
+            try:
+                self.notify(notifications)
+            except Exception:
+                # The rooms are committed; players still find them through the API
+                logger.exception('Failed to send %d matchmaking notifications', len(notifications))
+        return created
+
+    def stats(self):
+        waits = sorted(self.waits)
+        if not waits:
+            return {'matches': self.matches, 'p50_ms': None, 'p99_ms': None}
+        return {
+            'matches': self.matches,
+            'p50_ms': round(waits[len(waits) // 2] * 1000, 2),
+            'p99_ms': round(waits[min(len(waits) - 1, int(len(waits) * 0.99))] * 1000, 2),
+        }
+
+
+match_queue = MatchQueue()
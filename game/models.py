@@ -1,3 +1,54 @@
+from django.conf import settings
 from django.db import models
 
-# Create your models here.
+
+class ChatMessage(models.Model):
+    """Chat message sent in a game room, kept for moderation"""
+    
+    game_room = models.ForeignKey('GameRoom', on_delete=models.CASCADE, related_name='chat_messages')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='chat_messages')
+    message = models.CharField(max_length=500)
+    # Time the message was sent, not when its batch was written
+    created_at = models.DateTimeField()
+    
+    class Meta:
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['game_room', 'created_at']),
+        ]
+    
+    def __str__(self):
+        return f"{self.user.username} in {self.game_room.room_id}: {self.message[:50]}"
+
+
+class RoomFairness(models.Model):
+    """Dice seeds of a finished room, published so players can verify its rolls"""
+    
+    game_room = models.OneToOneField('GameRoom', on_delete=models.CASCADE, related_name='fairness')
+    server_seed = models.CharField(max_length=64, help_text="Hex, secret until the game ended")
+    server_seed_hash = models.CharField(max_length=64, help_text="SHA-256 committed to before the first roll")
+    client_seed = models.CharField(max_length=400, blank=True)
+    rolls = models.PositiveIntegerField(default=0, help_text="Nonces 0 to rolls - 1 were used")
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        verbose_name_plural = "Room fairness"
+    
+    def __str__(self):
+        return f"{self.game_room.room_id}: {self.server_seed_hash}"
+
+
+class PayoutBatch(models.Model):
+    """Signed payout transaction; withdrawals paid by it carry its hash in usdt_tx_hash"""
+    
+    tx_hash = models.CharField(max_length=100, unique=True)
+    # One batch per nonce, so concurrent runs cannot sign two payouts with the same one
+    nonce = models.PositiveBigIntegerField(unique=True)
+    raw_transaction = models.TextField(help_text="Hex, broadcast again as-is while its nonce is unused")
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['nonce']
+    
+    def __str__(self):
+        return f"{self.nonce}: {self.tx_hash}"
@@ -0,0 +1,256 @@
+"""
+Write-behind buffers for high-frequency rows.
+
+Rows from every room in the process are collected in memory and written
+with a single ``bulk_create`` once ``max_size`` rows are pending or
+``max_delay`` seconds have passed since the first pending row, whichever
+comes first. ``MoveBuffer`` handles GameMove rows; other buffers subclass
+``WriteBehindBuffer`` the same way.
+
+Replay checkpoints queued with ``add_checkpoint`` are written in the same
+flush, after the moves they cover.
+
+A failed flush puts its rows back and retries with exponential backoff.
+After ``max_attempts`` failures in a row the batch is split in halves
+until the rows that fail on their own are found; those are logged and
+moved to ``dead_letters``, so one bad row (a duplicate move number, a
+missing foreign key) cannot hold back every room. When no row at all can
+be written the database is down: everything is kept, up to
+``max_pending`` rows, and the oldest rows beyond that are dead-lettered.
+"""
+import asyncio
+import atexit
+import logging
+import time
+from collections import deque
+
+from channels.db import database_sync_to_async
+
+from .models import GameMove
+from .replay import checkpoint_store
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """Per-process buffer that batches row inserts off the event loop"""
+
+    name = 'rows'
+
+    max_attempts = 5
+    max_retry_delay = 30.0
+
+    def __init__(self, max_size=500, max_delay=0.05, max_pending=None):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.max_pending = max_pending or max_size * 100
+        self._pending = []
+        self._timer = None
+        self._failures = 0
+        # Skip the INSERT but keep the bookkeeping (load tests)
+        self.dry_run = False
+
+        # Flush statistics
+        self.flushes = 0
+        self.rows_flushed = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.failed_flushes = 0
+        self.dead_lettered = 0
+        # Latest rows given up on, for inspection
+        self.dead_letters = deque(maxlen=1000)
+
+    def _append(self, row):
+        """Queue a row; must be called from the event loop"""
+        self._pending.append(row)
+        if len(self._pending) >= self.max_size:
+            self._cancel_timer()
+            asyncio.get_running_loop().create_task(self.flush())
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self.max_delay, self._on_timer
+            )
+
+    async def flush(self):
+        """Write all pending rows; returns the number of rows written"""
+        self._cancel_timer()
+        batch, extra = self._take()
+        if not batch:
+            return 0
+
+        try:
+            await database_sync_to_async(self._write)(batch, extra)
+        except Exception:
+            self.failed_flushes += 1
+            self._failures += 1
+            # Isolate bad rows on every max_attempts-th failure in a row;
+            # plain retries in between cost a single query
+            if self._failures % self.max_attempts:
+                logger.exception('Failed to flush %d %s, retrying', len(batch), self.name)
+                return self._retry_later(batch, extra)
+            logger.exception('Failed to flush %d %s %d times, isolating bad rows',
+                             len(batch), self.name, self._failures)
+            written, failed, extra = await database_sync_to_async(self._write_isolating)(batch, extra)
+            if not written:
+                return self._retry_later(batch, extra)
+            self._dead_letter(failed)
+        self._failures = 0
+        return len(batch)
+
+    def flush_sync(self):
+        """Blocking flush for use outside the event loop (worker shutdown)"""
+        self._timer = None
+        batch, extra = self._take()
+        if batch:
+            self._write(batch, extra)
+        return len(batch)
+
+    def stats(self):
+        return {
+            'pending': len(self._pending),
+            'flushes': self.flushes,
+            'rows_flushed': self.rows_flushed,
+            'last_flush_ms': round(self.last_flush_ms, 2),
+            'max_flush_ms': round(self.max_flush_ms, 2),
+            'failed_flushes': self.failed_flushes,
+            'dead_lettered': self.dead_lettered,
+        }
+
+    def _retry_later(self, batch, extra):
+        """Put a failed batch back and flush again after a backoff"""
+        self._requeue(batch, extra)
+        overflow = len(self._pending) - self.max_pending
+        if overflow > 0:
+            logger.error('%d %s pending, dropping the oldest %d', len(self._pending), self.name, overflow)
+            self._dead_letter(self._pending[:overflow])
+            del self._pending[:overflow]
+        delay = min(self.max_delay * 2 ** self._failures, self.max_retry_delay)
+        self._cancel_timer()
+        self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+        return 0
+
+    def _write_isolating(self, batch, extra):
+        """
+        Write ``batch`` in ever smaller parts, down to single rows. Returns
+        ``(rows written, rows that failed alone, extra still unwritten)``;
+        ``extra`` goes out with the first part that is written.
+        """
+        written = 0
+        failed = []
+        parts = [batch]
+        while parts:
+            part = parts.pop()
+            try:
+                self._write(part, extra)
+            except Exception:
+                if len(part) == 1:
+                    failed.extend(part)
+                else:
+                    middle = len(part) // 2
+                    parts += [part[middle:], part[:middle]]
+                continue
+            written += len(part)
+            extra = None
+        return written, failed, extra
+
+    def _dead_letter(self, rows):
+        for row in rows:
+            logger.error('Giving up on %s row %r', self.name, row)
+        self.dead_letters.extend(rows)
+        self.dead_lettered += len(rows)
+
+    def _take(self):
+        """Swap out the pending rows, plus anything written alongside them"""
+        batch, self._pending = self._pending, []
+        return batch, None
+
+    def _requeue(self, batch, extra):
+        self._pending[:0] = batch
+
+    def _write(self, batch, extra):
+        start = time.perf_counter()
+        if not self.dry_run:
+            self._persist(batch, extra)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        self.flushes += 1
+        self.rows_flushed += len(batch)
+        self.last_flush_ms = elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+        logger.info('Flushed %d %s in %.1f ms', len(batch), self.name, elapsed_ms)
+
+    def _persist(self, batch, extra):
+        raise NotImplementedError
+
+    def _on_timer(self):
+        self._timer = None
+        asyncio.get_running_loop().create_task(self.flush())
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+class MoveBuffer(WriteBehindBuffer):
+    """Batches GameMove inserts and the replay checkpoints that follow them"""
+
+    name = 'moves'
+
+    def __init__(self, max_size=500, max_delay=0.05):
+        super().__init__(max_size, max_delay)
+        self._checkpoints = []
+
+    def add(self, game_room_id, player_id, dice_value, piece_moved,
+            from_position, to_position, move_number):
+        """Queue a move; must be called from the event loop"""
+        self._append((
+            game_room_id, player_id, dice_value, piece_moved,
+            from_position, to_position, move_number
+        ))
+
+    def add_checkpoint(self, game_room_id, move_number, state):
+        """Queue a board checkpoint taken right after ``move_number`` was added"""
+        self._checkpoints.append((game_room_id, move_number, state))
+
+    def _take(self):
+        batch, self._pending = self._pending, []
+        checkpoints, self._checkpoints = self._checkpoints, []
+        return batch, checkpoints
+
+    def _requeue(self, batch, checkpoints):
+        self._pending[:0] = batch
+        self._checkpoints[:0] = checkpoints or []
+
+    def _persist(self, batch, checkpoints):
+        GameMove.objects.bulk_create([
+            GameMove(
+                game_room_id=game_room_id,
+                player_id=player_id,
+                dice_value=dice_value,
+                piece_moved=piece_moved,
+                from_position=from_position,
+                to_position=to_position,
+                move_number=move_number,
+            )
+            for (game_room_id, player_id, dice_value, piece_moved,
+                 from_position, to_position, move_number) in batch
+        ], batch_size=self.max_size)
+        if not checkpoints:
+            return
+        try:
+            checkpoint_store.save_many(checkpoints)
+        except Exception:
+            # Checkpoints only speed up restores; the moves are safe
+            logger.exception('Failed to store %d replay checkpoints', len(checkpoints))
+
+
+move_buffer = MoveBuffer()
+
+
+@atexit.register
+def _flush_on_shutdown():
+    try:
+        move_buffer.flush_sync()
+    except Exception:
+        logger.exception('Failed to flush moves on shutdown')
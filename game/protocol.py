@@ -0,0 +1,99 @@
+"""
+Binary WebSocket subprotocol for hot game events.
+
+Clients that offer the ``zugu.bin.v1`` subprotocol receive ``dice_rolled``
+and ``piece_moved`` as fixed-layout binary frames; every other event, and
+every event for clients that do not negotiate it, stays JSON.
+
+All fields are little-endian:
+
+    dice_rolled   B opcode | I version | B seat | B dice_value | B legal_moves
+    piece_moved   B opcode | I version | B seat | B piece_id | B from | B to | H captured
+
+``legal_moves`` is a bitmask of movable pieces (bit n = piece n) and
+``captured`` is a bitmask of global piece indices sent back to the yard.
+
+Broadcasts are encoded once by the sender with ``make_frame`` and carried
+through the channel layer as ready-to-send frames, so group members forward
+them verbatim instead of re-serializing per recipient.
+"""
+import json
+import struct
+
+from .engine import COLOR_INDEX, COLORS
+
+BINARY_SUBPROTOCOL = 'zugu.bin.v1'
+
+OP_DICE_ROLLED = 1
+OP_PIECE_MOVED = 2
+
+_DICE_ROLLED = struct.Struct('<BIBBB')
+_PIECE_MOVED = struct.Struct('<BIBBBBH')
+
+
+def encode_dice_rolled(version, color, dice_value, legal_moves):
+    mask = 0
+    for piece in legal_moves:
+        mask |= 1 << piece
+    return _DICE_ROLLED.pack(
+        OP_DICE_ROLLED, version, COLOR_INDEX[color], dice_value, mask
+    )
+
+
+def encode_piece_moved(version, color, piece_id, from_position, to_position, captured):
+    return _PIECE_MOVED.pack(
+        OP_PIECE_MOVED, version, COLOR_INDEX[color],
+        piece_id, from_position, to_position, captured
+    )
+
+
+def encode_event(event):
+    """Binary frame for ``event``, or ``None`` if it has no binary layout"""
+    event_type = event['type']
+    if event_type == 'dice_rolled':
+        return encode_dice_rolled(
+            event['version'], event['color'],
+            event['dice_value'], event['legal_moves']
+        )
+    if event_type == 'piece_moved':
+        return encode_piece_moved(
+            event['version'], event['color'], event['piece_id'],
+            event['from_position'], event['to_position'], event['captured']
+        )
+    return None
+
+
+def make_frame(event):
+    """Channel layer message carrying ``event`` pre-encoded for every client"""
+    return {
+        'type': 'broadcast.frame',
+        'text': json.dumps(event),
+        'bytes': encode_event(event),
+    }
+
+
+def decode_frame(frame):
+    """Decode a binary frame back into an event dict (clients and tests)"""
+    opcode = frame[0]
+    if opcode == OP_DICE_ROLLED:
+        _, version, seat, dice_value, mask = _DICE_ROLLED.unpack(frame)
+        return {
+            'type': 'dice_rolled',
+            'version': version,
+            'color': COLORS[seat],
+            'dice_value': dice_value,
+            'legal_moves': [piece for piece in range(4) if mask & (1 << piece)],
+        }
+    if opcode == OP_PIECE_MOVED:
+        _, version, seat, piece_id, from_position, to_position, captured = \
+            _PIECE_MOVED.unpack(frame)
+        return {
+            'type': 'piece_moved',
+            'version': version,
+            'color': COLORS[seat],
+            'piece_id': piece_id,
+            'from_position': from_position,
+            'to_position': to_position,
+            'captured': captured,
+        }
+    raise ValueError(f'Unknown opcode {opcode}')
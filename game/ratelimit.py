@@ -0,0 +1,101 @@
+"""
+In-memory token buckets for incoming WebSocket frames.
+
+Every game socket has its own buckets and every room shares another set,
+so one client cannot flood a room and a full room cannot flood the channel
+layer. Budgets are ``(tokens per second, burst)`` per message type, with the
+pseudo type ``frame`` checked before a frame is even parsed. Types without
+a budget are not limited.
+
+Frames over budget are dropped. A drop over the connection's own budget
+also takes a token from its strike bucket; a client that stays over budget
+long enough to empty it is disconnected. Drops over the room's budget cost
+no strike, since other sockets spent it. Turn actions only charge the room
+for the player whose turn it is (see ``GameConsumer.receive``).
+
+Everything is plain arithmetic on the event loop, with no I/O.
+"""
+from django.conf import settings
+
+
+class TokenBucket:
+    """Classic token bucket refilled lazily on each ``take``"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now=0.0):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now, cost=1):
+        tokens = self.tokens + (now - self.updated) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.updated = now
+        if tokens < cost:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - cost
+        return True
+
+
+class RateLimiter:
+    """One token bucket per message type, created on first use"""
+
+    __slots__ = ('budgets', '_buckets')
+
+    def __init__(self, budgets):
+        self.budgets = budgets
+        self._buckets = {}
+
+    def allow(self, message_type, now):
+        bucket = self._buckets.get(message_type)
+        if bucket is None:
+            budget = self.budgets.get(message_type)
+            if budget is None:
+                return True
+            bucket = self._buckets[message_type] = TokenBucket(*budget, now=now)
+        return bucket.take(now)
+
+
+def connection_limiter():
+    return RateLimiter(settings.WS_RATE_LIMITS)
+
+
+def strike_bucket(now):
+    return TokenBucket(*settings.WS_RATE_LIMIT_STRIKES, now=now)
+
+
+# Shared limiters of the rooms active in this process
+_room_limiters = {}
+
+_stats = {'dropped_frames': 0, 'disconnects': 0}
+
+
+def get_room_limiter(room_id):
+    limiter = _room_limiters.get(room_id)
+    if limiter is None:
+        limiter = _room_limiters[room_id] = RateLimiter(settings.WS_ROOM_RATE_LIMITS)
+    return limiter
+
+
+def release_room_limiter(room_id):
+    _room_limiters.pop(room_id, None)
+
+
+def record_drop(strikes=None, now=None):
+    """
+    Count a dropped frame and, given the client's ``strikes``, charge it a
+    strike; returns False once the client should be disconnected
+    """
+    _stats['dropped_frames'] += 1
+    if strikes is None or strikes.take(now):
+        return True
+    _stats['disconnects'] += 1
+    return False
+
+
+def stats():
+    return dict(_stats, rooms=len(_room_limiters))
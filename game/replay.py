@@ -0,0 +1,247 @@
+"""
+Deterministic game replay from the GameMove log.
+
+Every ``REPLAY_CHECKPOINT_INTERVAL`` moves the live board is packed into a
+22-byte checkpoint (``LudoBoard.to_bytes``) and written to Redis together
+with the batch of moves it covers, so a checkpoint never gets ahead of the
+move log. Restoring a room loads the nearest checkpoint at or below the
+target move and replays only the tail.
+
+Moves are replayed through the rules engine, which recomputes every
+position and capture; a row that disagrees with the engine raises
+``ReplayMismatch``. Turns that produced no row (a roll without legal moves,
+a skipped turn) are implied by the player of the next recorded move. A
+forfeit is logged as a row with dice value ``FORFEIT`` and takes the seat
+out of the turn order. Replays start from a board with the room's seats
+only.
+
+Audits replay from move 1 without checkpoints. ``bulk_replay`` streams the
+move log from the database and fans the pure engine work out to a process
+pool.
+"""
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+
+from .engine import COLOR_INDEX, COLORS, IllegalMove, LudoBoard
+from .models import GameMove, GamePlayer
+
+logger = logging.getLogger(__name__)
+
+
+class ReplayMismatch(ValueError):
+    """Raised when a recorded move cannot be reproduced by the engine"""
+
+    def __init__(self, move_number, message):
+        super().__init__(f'Move {move_number}: {message}')
+        self.move_number = move_number
+
+
+# Dice value of a logged forfeit; real rolls are 1-6
+FORFEIT = 0
+
+# Checkpoints outlive the game long enough to settle disputes
+CHECKPOINT_TTL = 7 * 24 * 3600
+
+
+def checkpoint_key(game_room_id):
+    return f'replay:{game_room_id}'
+
+
+def checkpoint_due(move_number):
+    interval = settings.REPLAY_CHECKPOINT_INTERVAL
+    return interval > 0 and move_number % interval == 0
+
+
+_redis = None
+
+
+def get_redis():
+    global _redis
+    if _redis is None:
+        import redis
+        _redis = redis.Redis.from_url(
+            settings.REPLAY_REDIS_URL, decode_responses=True
+        )
+    return _redis
+
+
+class CheckpointStore:
+    """Board checkpoints of each room, one Redis hash per room keyed by move number"""
+
+    def __init__(self, redis=None):
+        self._redis = redis
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            self._redis = get_redis()
+        return self._redis
+
+    def save_many(self, checkpoints):
+        """Store ``(game_room_id, move_number, state)`` tuples in one round trip"""
+        if not checkpoints:
+            return
+        with self.redis.pipeline(transaction=False) as pipe:
+            for game_room_id, move_number, state in checkpoints:
+                key = checkpoint_key(game_room_id)
+                pipe.hset(key, move_number, state.hex())
+                pipe.expire(key, CHECKPOINT_TTL)
+            pipe.execute()
+
+    def nearest(self, game_room_id, upto=None):
+        """Return the latest checkpoint board at or below ``upto``, or None"""
+        # A room holds one small field per interval, fetch them all at once
+        checkpoints = self.redis.hgetall(checkpoint_key(game_room_id))
+        move_numbers = [
+            int(move_number) for move_number in checkpoints
+            if upto is None or int(move_number) <= upto
+        ]
+        if not move_numbers:
+            return None
+        return LudoBoard.from_bytes(bytes.fromhex(checkpoints[str(max(move_numbers))]))
+
+    def delete(self, game_room_id):
+        self.redis.delete(checkpoint_key(game_room_id))
+
+
+checkpoint_store = CheckpointStore()
+
+
+def apply_move(board, seat, dice_value, piece_moved, from_position, to_position,
+               move_number):
+    """Replay one recorded move on ``board`` and check it against the row"""
+    # Turns without a recorded move pass silently; the row says whose turn it was
+    board.turn = seat
+    board.dice = 0
+    try:
+        if dice_value == FORFEIT:
+            board.remove_seat(seat)
+            result = (from_position, to_position)
+        else:
+            board.roll(seat, dice_value)
+            result = board.move(seat, piece_moved)
+    except IllegalMove as e:
+        raise ReplayMismatch(move_number, str(e)) from None
+    if result[:2] != (from_position, to_position):
+        raise ReplayMismatch(
+            move_number,
+            f'recorded {from_position}->{to_position}, engine {result[0]}->{result[1]}'
+        )
+    if board.move_number != move_number:
+        raise ReplayMismatch(move_number, f'expected move {board.move_number}')
+
+
+def replay_moves(seats, moves, board=None):
+    """
+    Replay ``moves`` on ``board`` (a fresh board with the seats of ``seats``
+    by default) and return it.
+
+    ``seats`` maps GamePlayer ids to seats; ``moves`` are
+    ``(player_id, dice_value, piece_moved, from_position, to_position,
+    move_number)`` tuples in move order. Only uses the engine, so it can run
+    in a worker process.
+    """
+    if board is None:
+        board = LudoBoard([COLORS[seat] for seat in sorted(set(seats.values()))] or COLORS)
+    for player_id, dice_value, piece_moved, from_position, to_position, move_number in moves:
+        seat = seats.get(player_id)
+        if seat is None:
+            raise ReplayMismatch(move_number, f'unknown player {player_id}')
+        apply_move(board, seat, dice_value, piece_moved, from_position,
+                   to_position, move_number)
+    return board
+
+
+def load_seats(game_room_id):
+    return {
+        player_id: COLOR_INDEX[color]
+        for player_id, color in GamePlayer.objects.filter(
+            game_room_id=game_room_id
+        ).values_list('id', 'color')
+    }
+
+
+def load_moves(game_room_id, after=0, upto=None):
+    moves = GameMove.objects.filter(
+        game_room_id=game_room_id, move_number__gt=after
+    )
+    if upto is not None:
+        moves = moves.filter(move_number__lte=upto)
+    return moves.order_by('move_number').values_list(
+        'player_id', 'dice_value', 'piece_moved',
+        'from_position', 'to_position', 'move_number'
+    )
+
+
+def restore_board(game_room_id, upto=None, store=checkpoint_store):
+    """
+    Rebuild the board of a room as of move ``upto`` (the latest by default)
+    from the nearest checkpoint plus a replay of the moves after it.
+    """
+    board = None
+    if store is not None:
+        try:
+            board = store.nearest(game_room_id, upto)
+        except Exception:
+            # Checkpoints only speed up restores; replay the whole log instead
+            logger.exception('Replay checkpoints of room %s could not be read', game_room_id)
+    after = board.move_number if board is not None else 0
+    return replay_moves(
+        load_seats(game_room_id), load_moves(game_room_id, after, upto), board
+    )
+
+
+def audit_room(job):
+    """Replay ``(game_room_id, seats, moves)`` from move 1 into a result dict"""
+    game_room_id, seats, moves = job
+    try:
+        board = replay_moves(seats, moves)
+    except ReplayMismatch as e:
+        return {'game_room_id': game_room_id, 'ok': False, 'moves': len(moves),
+                'failed_at': e.move_number, 'error': str(e)}
+    return {'game_room_id': game_room_id, 'ok': True, 'moves': len(moves),
+            'winner': board.snapshot()['winner']}
+
+
+def _batches(game_room_ids, batch_size):
+    """Load seats and moves of ``batch_size`` rooms at a time"""
+    for i in range(0, len(game_room_ids), batch_size):
+        batch = game_room_ids[i:i + batch_size]
+        seats = {game_room_id: {} for game_room_id in batch}
+        for player_id, game_room_id, color in GamePlayer.objects.filter(
+            game_room_id__in=batch
+        ).values_list('id', 'game_room_id', 'color'):
+            seats[game_room_id][player_id] = COLOR_INDEX[color]
+
+        moves = {game_room_id: [] for game_room_id in batch}
+        for row in GameMove.objects.filter(game_room_id__in=batch).order_by(
+            'game_room_id', 'move_number'
+        ).values_list(
+            'game_room_id', 'player_id', 'dice_value', 'piece_moved',
+            'from_position', 'to_position', 'move_number'
+        ).iterator(chunk_size=5000):
+            moves[row[0]].append(row[1:])
+
+        yield [(game_room_id, seats[game_room_id], moves[game_room_id])
+               for game_room_id in batch]
+
+
+def bulk_replay(game_room_ids, processes=None, batch_size=200):
+    """
+    Replay many rooms from move 1 and yield one result dict per room.
+
+    The parent streams rows from the database; workers only run the engine,
+    so they need no database connection or Django setup. ``processes=0``
+    replays in this process.
+    """
+    batches = _batches(list(game_room_ids), batch_size)
+    if processes == 0:
+        for jobs in batches:
+            yield from map(audit_room, jobs)
+        return
+    # Submit one batch at a time so memory stays bounded by batch_size rooms
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for jobs in batches:
+            yield from pool.map(audit_room, jobs, chunksize=8)
@@ -1,6 +1,6 @@
 from rest_framework import serializers
 from .models import (
-    GameRoom, GamePlayer, GameMove, Transaction,
+    GameRoom, GamePlayer, GameMove, Transaction, RoomFairness,
     Tournament, TournamentParticipant, PlatformSettings
 )
 from users.serializers import UserProfileSerializer
@@ -68,6 +68,15 @@ class TransactionSerializer(serializers.ModelSerializer):
         read_only_fields = ['transaction_id', 'created_at']
 
 
+class RoomFairnessSerializer(serializers.ModelSerializer):
+    """Serializer for the revealed dice seeds of a room"""
+    room_id = serializers.CharField(source='game_room.room_id', read_only=True)
+    
+    class Meta:
+        model = RoomFairness
+        fields = ['room_id', 'server_seed', 'server_seed_hash', 'client_seed', 'rolls']
+
+
 class TournamentSerializer(serializers.ModelSerializer):
     """Serializer for Tournament"""
     participants_count = serializers.IntegerField(source='current_participants', read_only=True)
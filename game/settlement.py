@@ -0,0 +1,68 @@
+"""
+Settlement of a finished game room.
+
+``settle_room`` closes the room, pays the winner and the platform out of
+escrow and updates every player's stats with a fixed number of statements,
+whatever the table size. Nothing is loaded per player: every increment is
+an ``F()`` update over the table's players and the ledger entries go in
+with one ``bulk_create``.
+"""
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from users import ledger
+from users.ledger import ESCROW, PLATFORM, user_account
+from users.models import User
+
+from .models import GamePlayer, GameRoom, Transaction
+
+
+def settle_room(game_room, winner_player):
+    """
+    Complete ``game_room`` with ``winner_player`` as the winner. Returns
+    False, changing nothing, when the room is no longer in progress (for
+    example settled by a concurrent request).
+    """
+    now = timezone.now()
+    reference = game_room.room_id
+    with transaction.atomic():
+        # Claim the room first, so it can only ever be paid out once
+        if not GameRoom.objects.filter(pk=game_room.pk, status='in_progress').update(
+            status='completed', winner_id=winner_player.user_id, completed_at=now
+        ):
+            return False
+        GamePlayer.objects.filter(pk=winner_player.pk).update(is_winner=True)
+
+        ledger.transfer_many([
+            (ESCROW, user_account(winner_player.user_id), game_room.winner_amount, 'win', {
+                'total_games_played': 1,
+                'total_games_won': 1,
+                'total_amount_won': game_room.winner_amount,
+            }),
+            (ESCROW, PLATFORM, game_room.commission_amount, 'commission', None),
+        ], reference=reference)
+
+        User.objects.filter(
+            pk__in=GamePlayer.objects.filter(game_room=game_room).exclude(
+                pk=winner_player.pk
+            ).values('user_id')
+        ).update(
+            total_games_played=F('total_games_played') + 1,
+            total_amount_lost=F('total_amount_lost') + game_room.bet_amount
+        )
+
+        Transaction.objects.create(
+            user_id=winner_player.user_id,
+            game_room=game_room,
+            transaction_type='win',
+            amount=game_room.winner_amount,
+            status='completed',
+            description=f'Won game {reference}'
+        )
+
+    game_room.status = 'completed'
+    game_room.winner_id = winner_player.user_id
+    game_room.completed_at = now
+    winner_player.is_winner = True
+    return True
@@ -0,0 +1,18 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .lobby import publish_room_change, publish_room_removed
+from .models import GameRoom
+
+
+@receiver(post_save, sender=GameRoom)
+def update_waiting_rooms(sender, instance, **kwargs):
+    """Keep the lobby index in sync once the room change is committed"""
+    transaction.on_commit(lambda: publish_room_change(instance))
+
+
+@receiver(post_delete, sender=GameRoom)
+def remove_waiting_room(sender, instance, **kwargs):
+    room_id = instance.room_id
+    transaction.on_commit(lambda: publish_room_removed(room_id))
@@ -0,0 +1,86 @@
+"""
+Per-room state versioning and bounded event log.
+
+Every event broadcast to a room is stamped with the next value of a
+monotonically increasing version and kept in a fixed-size log. A client
+that reconnects with ``?since=<version>&epoch=<epoch>`` is sent only the
+events it missed, as long as the log still covers that version; otherwise
+it falls back to a full snapshot. Events are kept as the JSON text already
+sent to clients.
+
+Versions count from 0 again whenever a log is created, e.g. after a worker
+restart or when the room moves to another worker. Each log therefore has a
+random ``epoch``, sent with the snapshot and resume payloads, and a client
+whose epoch does not match gets a full snapshot.
+
+The last ``CHAT_HISTORY_SIZE`` chat messages of a room are kept as well, so
+players who join or reconnect get them with the snapshot.
+"""
+import secrets
+from collections import deque
+from itertools import islice
+
+from .protocol import make_frame
+
+EVENT_LOG_SIZE = 256
+CHAT_HISTORY_SIZE = 50
+
+
+class RoomState:
+    """Version counter, recent events, chat history and cached snapshot of one room"""
+
+    __slots__ = ('epoch', 'version', 'events', 'chat', 'snapshot')
+
+    def __init__(self, capacity=EVENT_LOG_SIZE, chat_capacity=CHAT_HISTORY_SIZE):
+        # Tells this log's versions apart from those of an earlier log
+        self.epoch = secrets.token_hex(8)
+        self.version = 0
+        self.events = deque(maxlen=capacity)
+        # Recent chat messages for the connect snapshot
+        self.chat = deque(maxlen=chat_capacity)
+        # Last DB snapshot; only cached once the player roster is fixed
+        self.snapshot = None
+
+    def record(self, event):
+        """
+        Stamp ``event`` with the next version, append it to the log and
+        return its pre-encoded broadcast frame.
+        """
+        self.version += 1
+        event['version'] = self.version
+        frame = make_frame(event)
+        self.events.append((self.version, frame['text']))
+        return frame
+
+    def events_since(self, version, epoch=None):
+        """
+        Encoded events newer than ``version`` of ``epoch``, or ``None`` when
+        the log no longer covers it and the client needs a full snapshot.
+        """
+        if epoch != self.epoch:
+            return None
+        if version == self.version:
+            return []
+        if version > self.version or not self.events:
+            return None
+        if self.events[0][0] > version + 1:
+            return None
+        skip = len(self.events) - (self.version - version)
+        return [text for _, text in islice(self.events, skip, None)]
+
+
+# State of the rooms active in this process
+_rooms = {}
+
+
+def get_room_state(room_id):
+    """Return the state for ``room_id``, creating it on first use"""
+    state = _rooms.get(room_id)
+    if state is None:
+        state = _rooms[room_id] = RoomState()
+    return state
+
+
+def release_room_state(room_id):
+    """Drop the state of a finished room"""
+    _rooms.pop(room_id, None)
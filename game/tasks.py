@@ -0,0 +1,9 @@
+from celery import shared_task
+
+from . import withdrawals
+
+
+@shared_task
+def process_withdrawals():
+    """Settle sent payouts, then pay out pending withdrawals in batches (see withdrawals.py)"""
+    return {**withdrawals.confirm_submitted(), **withdrawals.process_pending()}
@@ -1,3 +1,1137 @@
-from django.test import TestCase
+import asyncio
+import json
+import random
+import struct
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory
+
+from users import ledger
+from users.ledger import ESCROW, EXTERNAL, PLATFORM
+from users.models import LedgerAccount, User
+
+from . import history, ratelimit, turns
+from .actors import get_room_actor, release_room_actor
+from .affinity import WORKERS_KEY, HashRing, RoomAffinity
+from .chain import FAILED, ChainError, InMemoryChainClient
+from .consumers import GameConsumer
+from .dice import RoomDice, verify_rolls
+from .engine import COLORS, HOME, YARD, IllegalMove, LudoBoard
+from .idempotency import IdempotencyStore
+from .local_redis import LocalRedis
+from .matchmaking import Matcher, MatchQueue
+from .move_buffer import WriteBehindBuffer
+from .protocol import decode_frame, encode_event, make_frame
+from .ratelimit import RateLimiter, TokenBucket
+from .models import GamePlayer, GameRoom, PayoutBatch, Transaction
+from .replay import FORFEIT, ReplayMismatch, replay_moves
+from .settlement import settle_room
+from .state_log import RoomState
+from .timers import TimerWheel
+from .withdrawals import confirm_submitted, process_pending
+
+
+class SettlementQueryCountTest(TestCase):
+    """Settling a room costs the same number of queries at any table size"""
+
+    def setUp(self):
+        ledger.open_account(ESCROW)
+        ledger.open_account(PLATFORM)
+
+    def make_room(self, players):
+        game_room = GameRoom.objects.create(
+            bet_amount=Decimal('10.00'),
+            commission_percentage=Decimal('2.00'),
+            current_players=players,
+            status='in_progress'
+        )
+        game_room.calculate_pool()
+        LedgerAccount.objects.filter(code=ESCROW).update(balance=game_room.total_pool)
+        for position, color in enumerate(COLORS[:players], start=1):
+            user = User.objects.create(
+                username=f'{game_room.pk}-{color}', email=f'{game_room.pk}-{color}@example.com'
+            )
+            GamePlayer.objects.create(
+                game_room=game_room, user=user, color=color, position=position, bet_paid=True
+            )
+        return game_room, game_room.players.first()
+
+    def test_constant_queries(self):
+        game_room, winner = self.make_room(2)
+        with CaptureQueriesContext(connection) as two_players:
+            self.assertTrue(settle_room(game_room, winner))
+
+        game_room, winner = self.make_room(4)
+        with self.assertNumQueries(len(two_players.captured_queries)):
+            self.assertTrue(settle_room(game_room, winner))
+
+    def test_balances_and_stats(self):
+        game_room, winner = self.make_room(4)
+        settle_room(game_room, winner)
+
+        winner_user = User.objects.get(pk=winner.user_id)
+        self.assertEqual(winner_user.wallet_balance, game_room.winner_amount)
+        self.assertEqual(winner_user.total_games_won, 1)
+        self.assertEqual(winner_user.total_amount_won, game_room.winner_amount)
+        losers = User.objects.filter(
+            pk__in=game_room.players.values('user_id')
+        ).exclude(pk=winner.user_id)
+        for loser in losers:
+            self.assertEqual(loser.total_games_played, 1)
+            self.assertEqual(loser.total_amount_lost, game_room.bet_amount)
+        self.assertEqual(ledger.balance(ESCROW), Decimal('0.00'))
+        self.assertEqual(ledger.balance(PLATFORM), game_room.commission_amount)
+
+    def test_settles_once(self):
+        game_room, winner = self.make_room(2)
+        self.assertTrue(settle_room(game_room, winner))
+        self.assertFalse(settle_room(game_room, winner))
+
+
+@override_settings(MIN_WITHDRAWAL_AMOUNT=10.0, WITHDRAWAL_BATCH_SIZE=2, WITHDRAWAL_MAX_PER_RUN=100)
+class WithdrawalPipelineTest(TestCase):
+    """Pending withdrawals are paid in batches through the in-memory chain"""
+
+    addresses = ['0x' + str(digit) * 40 for digit in range(1, 4)]
+
+    def setUp(self):
+        ledger.open_account(EXTERNAL)
+        self.chain = InMemoryChainClient()
+        self.user = User.objects.create(username='payee', email='payee@example.com')
+
+    def withdraw(self, amount, address):
+        return Transaction.objects.create(
+            user=self.user,
+            transaction_type='withdraw',
+            amount=Decimal(amount),
+            status='pending',
+            description=f'Withdrawal to {address}'
+        )
+
+    def test_pays_in_batches(self):
+        first, second, third = self.addresses
+        rows = [self.withdraw('10.00', first), self.withdraw('15.00', second),
+                self.withdraw('20.00', first), self.withdraw('12.50', third)]
+
+        stats = process_pending(self.chain)
+
+        self.assertEqual(stats['submitted'], 4)
+        # Three recipients at two per batch
+        self.assertEqual(len(self.chain.batches), 2)
+        self.assertEqual(self.chain.balances[first], Decimal('30.00'))
+        hashes = dict(Transaction.objects.filter(status='submitted').values_list('pk', 'usdt_tx_hash'))
+        self.assertEqual(len(hashes), 4)
+        self.assertEqual(hashes[rows[0].pk], hashes[rows[2].pk])
+        self.assertNotEqual(hashes[rows[0].pk], hashes[rows[3].pk])
+        self.assertEqual(process_pending(self.chain)['claimed'], 0)
+
+        # Completed only once the receipts are in
+        self.assertEqual(confirm_submitted(self.chain)['confirmed'], 4)
+        self.assertEqual(Transaction.objects.filter(status='completed').count(), 4)
+        self.assertEqual(confirm_submitted(self.chain)['confirmed'], 0)
+
+    def test_waits_for_receipt(self):
+        row = self.withdraw('10.00', self.addresses[0])
+        self.chain.hold = True
+        process_pending(self.chain)
+
+        self.assertEqual(confirm_submitted(self.chain)['waiting'], 1)
+        row.refresh_from_db()
+        self.assertEqual(row.status, 'submitted')
+
+    def test_refunds_reverted_payout(self):
+        row = self.withdraw('25.00', self.addresses[0])
+        process_pending(self.chain)
+        self.chain.outcomes[self.chain.batches[0][0]] = FAILED
+
+        self.assertEqual(confirm_submitted(self.chain)['reverted'], 1)
+        row.refresh_from_db()
+        self.assertEqual(row.status, 'failed')
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.wallet_balance, Decimal('25.00'))
+        # Refunded once, however often confirmation runs
+        confirm_submitted(self.chain)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.wallet_balance, Decimal('25.00'))
+
+    def test_rebroadcasts_missing_payout(self):
+        address = self.addresses[0]
+        row = self.withdraw('10.00', address)
+        self.chain.hold = True
+        process_pending(self.chain)
+        row.refresh_from_db()
+        tx_hash = row.usdt_tx_hash
+        # The node lost it, but the original still reaches a miner
+        self.chain.forget(tx_hash)
+        original = PayoutBatch.objects.get(tx_hash=tx_hash).raw_transaction
+
+        self.assertEqual(confirm_submitted(self.chain)['rebroadcast'], 1)
+        self.assertEqual(process_pending(self.chain)['claimed'], 0)
+        self.chain.mine(tx_hash)
+        with self.assertRaises(ChainError):
+            self.chain.broadcast(original)
+
+        self.assertEqual(confirm_submitted(self.chain)['confirmed'], 1)
+        row.refresh_from_db()
+        self.assertEqual((row.status, row.usdt_tx_hash), ('completed', tx_hash))
+        # Paid once
+        self.assertEqual(len(self.chain.batches), 1)
+        self.assertEqual(self.chain.balances[address], Decimal('10.00'))
+
+    def test_resends_payout_whose_nonce_was_used(self):
+        row = self.withdraw('10.00', self.addresses[0])
+        self.chain.hold = True
+        process_pending(self.chain)
+        row.refresh_from_db()
+        batch = PayoutBatch.objects.get(tx_hash=row.usdt_tx_hash)
+        # Another transaction from the wallet took the nonce
+        self.chain.forget(batch.tx_hash)
+        self.chain.mined[batch.nonce] = '0xother'
+
+        self.assertEqual(confirm_submitted(self.chain)['dropped'], 1)
+        row.refresh_from_db()
+        self.assertEqual((row.status, row.usdt_tx_hash), ('pending', ''))
+        self.chain.hold = False
+        self.assertEqual(process_pending(self.chain)['submitted'], 1)
+        row.refresh_from_db()
+        self.assertEqual(PayoutBatch.objects.get(tx_hash=row.usdt_tx_hash).nonce, batch.nonce + 1)
+
+    def test_failed_broadcast_is_sent_again(self):
+        address = self.addresses[0]
+        row = self.withdraw('10.00', address)
+        with mock.patch.object(self.chain, 'broadcast', side_effect=ConnectionError('RPC down')):
+            self.assertEqual(process_pending(self.chain)['unsent'], 1)
+        row.refresh_from_db()
+        self.assertEqual(row.status, 'submitted')
+
+        self.assertEqual(confirm_submitted(self.chain)['rebroadcast'], 1)
+        self.assertEqual(confirm_submitted(self.chain)['confirmed'], 1)
+        self.assertEqual(self.chain.balances[address], Decimal('10.00'))
+
+    def test_nonces_follow_signed_batches(self):
+        self.chain.hold = True
+        for address in self.addresses:
+            self.withdraw('10.00', address)
+        process_pending(self.chain)
+        # The node forgot every batch, yet nonces are not reused
+        self.chain.mempool.clear()
+        self.withdraw('10.00', self.addresses[0])
+        process_pending(self.chain)
+        self.assertEqual(list(PayoutBatch.objects.values_list('nonce', flat=True)), [0, 1, 2])
+
+    def test_rejects_and_refunds(self):
+        bad_address = self.withdraw('25.00', 'not-an-address')
+        too_small = self.withdraw('5.00', self.addresses[0])
+
+        stats = process_pending(self.chain)
+
+        self.assertEqual(stats['rejected'], 2)
+        self.assertEqual(self.chain.batches, [])
+        self.assertEqual(
+            set(Transaction.objects.filter(status='failed').values_list('pk', flat=True)),
+            {bad_address.pk, too_small.pk}
+        )
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.wallet_balance, Decimal('30.00'))
+
+    def test_retries_failed_broadcast(self):
+        row = self.withdraw('10.00', self.addresses[0])
+        self.chain.fail_next = 1
+
+        self.assertEqual(process_pending(self.chain)['retried'], 1)
+        row.refresh_from_db()
+        self.assertEqual(row.status, 'pending')
+
+        self.assertEqual(process_pending(self.chain)['submitted'], 1)
+        row.refresh_from_db()
+        self.assertEqual(row.status, 'submitted')
+
+
+class TransactionHistoryTest(TestCase):
+    """Keyset pages of a user's transactions"""
+
+    url = '/api/v1/game/wallet/transactions/'
+
+    def setUp(self):
+        self.user = User.objects.create(username='history', email='history@example.com')
+        # Bursts of rows written in the same instant, as settlement does
+        self.times = [timezone.now() - timedelta(minutes=n) for n in range(3)]
+        for when in self.times:
+            for _ in range(4):
+                row = Transaction.objects.create(
+                    user=self.user, transaction_type='bet', amount=Decimal('1.00'), status='completed'
+                )
+                Transaction.objects.filter(pk=row.pk).update(created_at=when)
+
+    def page(self, **params):
+        request = Request(APIRequestFactory().get(self.url, params))
+        rows, next_url = history.keyset_page(request, Transaction.objects.filter(user=self.user))
+        cursor = next_url and parse_qs(urlparse(next_url).query)['cursor'][0]
+        return [row.pk for row in rows], cursor
+
+    def test_pages_through_equal_timestamps(self):
+        seen = []
+        pages = 0
+        cursor = None
+        while True:
+            params = {'limit': 5}
+            if cursor:
+                params['cursor'] = cursor
+            rows, cursor = self.page(**params)
+            seen += rows
+            pages += 1
+            if cursor is None:
+                break
+
+        expected = list(Transaction.objects.order_by('-created_at', '-pk').values_list('pk', flat=True))
+        self.assertEqual(seen, expected)
+        self.assertEqual(pages, 3)
+
+    def test_cursor_round_trip(self):
+        row = Transaction.objects.order_by('-pk').first()
+        self.assertEqual(history.decode_cursor(history.encode_cursor(row)), (row.created_at, row.pk))
+
+    def test_malformed_cursor(self):
+        for cursor in ['!!!', 'bm8tcGlwZQ', 'eHx5']:
+            with self.subTest(cursor=cursor), self.assertRaises(history.InvalidQuery):
+                history.decode_cursor(cursor)
+
+        # WalletViewSet.transactions answers InvalidQuery with a 400
+        with self.assertRaisesMessage(history.InvalidQuery, 'Invalid cursor'):
+            self.page(cursor='bm8tcGlwZQ')
+
+
+class LudoBoardTest(SimpleTestCase):
+    """Rules and checkpoints of the board engine"""
+
+    def setUp(self):
+        self.board = LudoBoard(['red', 'blue'])
+
+    def test_six_needed_to_leave_yard(self):
+        self.assertEqual(self.board.roll(0, 3), [])
+        self.assertEqual(self.board.turn, 1)
+        self.assertEqual(self.board.roll(1, 6), [0, 1, 2, 3])
+        self.assertEqual(self.board.move(1, 2), (0, 1, 0))
+        # A six rolls again
+        self.assertEqual(self.board.turn, 1)
+
+    def test_turn_order_and_pending_dice(self):
+        with self.assertRaises(IllegalMove):
+            self.board.roll(1, 6)
+        with self.assertRaises(IllegalMove):
+            self.board.move(0, 0)
+        self.board.roll(0, 6)
+        with self.assertRaises(IllegalMove):
+            self.board.roll(0, 6)
+        with self.assertRaises(IllegalMove):
+            self.board.move(0, 4)
+        with self.assertRaises(IllegalMove):
+            self.board.roll(1, 7)
+
+    def test_illegal_moves(self):
+        self.board.positions[0] = 10
+        self.board.positions[1] = HOME - 2
+        self.assertEqual(self.board.roll(0, 3), [0])
+        with self.assertRaises(IllegalMove):
+            self.board.move(0, 1)
+        with self.assertRaises(IllegalMove):
+            self.board.move(0, 2)
+        self.assertEqual(self.board.move(0, 0), (10, 13, 0))
+        self.assertEqual(self.board.turn, 1)
+
+    def test_capture(self):
+        # Red step 3 and blue step 42 are both on square 2
+        self.board.positions[0] = 3
+        self.board.positions[4] = 40
+        self.board.turn = 1
+        self.board.roll(1, 2)
+        self.assertEqual(self.board.move(1, 0), (40, 42, 1 << 0))
+        self.assertEqual(self.board.positions[0], 0)
+        self.assertEqual(self.board.turn, 1)
+
+    def test_no_capture_on_safe_square(self):
+        # Red step 9 and blue step 48 are both on safe square 8
+        self.board.positions[0] = 9
+        self.board.positions[4] = 46
+        self.board.turn = 1
+        self.board.roll(1, 2)
+        self.assertEqual(self.board.move(1, 0), (46, 48, 0))
+        self.assertEqual(self.board.positions[0], 9)
+
+    def test_last_piece_home_wins(self):
+        for piece in range(3):
+            self.board.positions[piece] = HOME
+        self.board.positions[3] = HOME - 4
+        self.board.roll(0, 4)
+        self.board.move(0, 3)
+        self.assertEqual(self.board.winner, 0)
+        with self.assertRaises(IllegalMove):
+            self.board.roll(1, 6)
+
+    def test_remove_seat(self):
+        board = LudoBoard()
+        board.remove_seat(0)
+        self.assertEqual(board.turn, 1)
+        board.roll(1, 1)
+        self.assertEqual(board.turn, 2)
+        board.remove_seat(3)
+        board.remove_seat(2)
+        self.assertEqual(board.winner, 1)
+        with self.assertRaises(IllegalMove):
+            board.remove_seat(1)
+
+    def test_checkpoint_round_trip(self):
+        board = LudoBoard(['red', 'green', 'yellow'])
+        board.roll(0, 6)
+        board.move(0, 1)
+        board.roll(0, 5)
+        data = board.to_bytes()
+        self.assertEqual(len(data), 22)
+        restored = LudoBoard.from_bytes(data)
+        self.assertEqual(restored.snapshot(), board.snapshot())
+        self.assertEqual(restored._next, board._next)
+        self.assertEqual(restored.to_bytes(), data)
+        # The restored board goes on where the original left off
+        self.assertEqual(restored.move(0, 1), (1, 6, 0))
+        self.assertEqual(restored.turn, 2)
+
+    def test_checkpoint_keeps_winner(self):
+        board = LudoBoard(['red', 'blue'])
+        board.remove_seat(1)
+        restored = LudoBoard.from_bytes(board.to_bytes())
+        self.assertEqual(restored.winner, 0)
+
+
+class ProtocolTest(SimpleTestCase):
+    """Binary frames decode back to the events they were encoded from"""
+
+    def test_dice_rolled_round_trip(self):
+        for color in COLORS:
+            for legal_moves in ([], [2], [0, 1, 2, 3]):
+                event = {'type': 'dice_rolled', 'version': 7, 'color': color,
+                         'dice_value': 6, 'legal_moves': legal_moves}
+                with self.subTest(color=color, legal_moves=legal_moves):
+                    self.assertEqual(decode_frame(encode_event(event)), event)
+
+    def test_piece_moved_round_trip(self):
+        for color in COLORS:
+            event = {'type': 'piece_moved', 'version': 12, 'color': color, 'piece_id': 3,
+                     'from_position': YARD, 'to_position': 1, 'captured': 0}
+            with self.subTest(color=color):
+                self.assertEqual(decode_frame(encode_event(event)), event)
+
+    def test_field_bounds(self):
+        # Widest values each packed field has to carry
+        dice = {'type': 'dice_rolled', 'version': 2 ** 32 - 1, 'color': 'yellow',
+                'dice_value': 6, 'legal_moves': [0, 1, 2, 3]}
+        moved = {'type': 'piece_moved', 'version': 2 ** 32 - 1, 'color': 'yellow', 'piece_id': 3,
+                 'from_position': HOME - 1, 'to_position': HOME, 'captured': 2 ** 16 - 1}
+        for event in (dice, moved):
+            self.assertEqual(decode_frame(encode_event(event)), event)
+
+        for field, value in [('version', 2 ** 32), ('captured', 2 ** 16), ('to_position', 256),
+                             ('version', -1)]:
+            with self.subTest(field=field, value=value), self.assertRaises(struct.error):
+                encode_event(dict(moved, **{field: value}))
+
+    def test_frames(self):
+        event = {'type': 'dice_rolled', 'version': 1, 'color': 'red', 'dice_value': 4, 'legal_moves': [1]}
+        frame = make_frame(event)
+        self.assertEqual(frame['type'], 'broadcast.frame')
+        self.assertEqual(json.loads(frame['text']), event)
+        self.assertEqual(decode_frame(frame['bytes']), event)
+
+        # Events without a binary layout stay JSON only
+        self.assertIsNone(make_frame({'type': 'game_ended', 'winner': 'red'})['bytes'])
+        with self.assertRaises(ValueError):
+            decode_frame(bytes([99]))
+
+
+class ReplayTest(SimpleTestCase):
+    """Replaying a game's move log rebuilds its board"""
+
+    # GamePlayer ids of a three-player room
+    seats = {11: 0, 12: 1, 13: 3}
+
+    def play(self, seed, forfeit_at=None):
+        """Play a random game to the end; returns the board and its move log"""
+        rng = random.Random(seed)
+        players = {seat: player_id for player_id, seat in self.seats.items()}
+        board = LudoBoard([COLORS[seat] for seat in players])
+        moves = []
+        while board.winner is None:
+            seat = board.turn
+            if board.move_number == forfeit_at:
+                board.remove_seat(seat)
+                moves.append((players[seat], FORFEIT, 0, YARD, YARD, board.move_number))
+                continue
+            dice = rng.randint(1, 6)
+            legal = board.roll(seat, dice)
+            if legal:
+                piece = rng.choice(legal)
+                from_step, to_step, _ = board.move(seat, piece)
+                moves.append((players[seat], dice, piece, from_step, to_step, board.move_number))
+        return board, moves
+
+    def test_replay_reproduces_board(self):
+        for seed in range(5):
+            board, moves = self.play(seed)
+            self.assertEqual(replay_moves(self.seats, moves).to_bytes(), board.to_bytes())
+
+    def test_replay_with_forfeit(self):
+        board, moves = self.play(1, forfeit_at=30)
+        replayed = replay_moves(self.seats, moves)
+        self.assertEqual(replayed.to_bytes(), board.to_bytes())
+        self.assertEqual(set(replayed._next), set(board._next))
+
+    def test_replay_from_checkpoint(self):
+        board, moves = self.play(2, forfeit_at=10)
+        checkpoint = replay_moves(self.seats, moves[:40]).to_bytes()
+        restored = replay_moves(self.seats, moves[40:], LudoBoard.from_bytes(checkpoint))
+        self.assertEqual(restored.to_bytes(), board.to_bytes())
+
+    def test_mismatch(self):
+        _, moves = self.play(3)
+        player_id, dice, piece, from_step, to_step, move_number = moves[5]
+        moves[5] = (player_id, dice, piece, from_step, to_step + 1, move_number)
+        with self.assertRaises(ReplayMismatch) as raised:
+            replay_moves(self.seats, moves)
+        self.assertEqual(raised.exception.move_number, move_number)
+
+
+class RoomDiceTest(SimpleTestCase):
+    """Dice rolls can be checked against the revealed seed"""
+
+    def test_revealed_rolls_verify(self):
+        dice = RoomDice('room', batch_size=4)
+        dice.set_client_seed('red', 'lucky:seed')
+        rolls = [dice.roll()[0] for _ in range(10)]
+        self.assertTrue(all(1 <= value <= 6 for value in rolls))
+        revealed = dice.reveal()
+        self.assertEqual(revealed['client_seed'], 'room:luckyseed')
+        self.assertIsNone(verify_rolls(revealed['server_seed'], revealed['server_seed_hash'],
+                                       revealed['client_seed'], rolls))
+        rolls[7] = rolls[7] % 6 + 1
+        self.assertEqual(verify_rolls(revealed['server_seed'], revealed['server_seed_hash'],
+                                      revealed['client_seed'], rolls), 7)
+        with self.assertRaises(ValueError):
+            verify_rolls('00' * 32, revealed['server_seed_hash'], revealed['client_seed'], rolls)
+
+    def test_client_seed_locked_after_first_roll(self):
+        dice = RoomDice('room')
+        self.assertEqual(dice.peek(), dice.roll()[0])
+        with self.assertRaises(IllegalMove):
+            dice.set_client_seed('blue', 'late')
+
+
+class TimerWheelTest(SimpleTestCase):
+    """Timers fire on the tick of their deadline, however long the wheel idled"""
+
+    def setUp(self):
+        self.now = 1000
+        self.wheel = TimerWheel(tick=1, slots=8, clock=lambda: self.now)
+        self.fired = []
+
+    def run_for(self, seconds):
+        self.now += seconds
+        self.wheel.advance()
+
+    def test_schedule(self):
+        self.wheel.schedule(5, self.fired.append, 'a')
+        self.run_for(4)
+        self.assertEqual(self.fired, [])
+        self.run_for(1)
+        self.assertEqual(self.fired, ['a'])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_reschedule(self):
+        timer = self.wheel.schedule(5, self.fired.append, 'a')
+        self.run_for(3)
+        self.wheel.reschedule(timer, 5)
+        self.run_for(3)
+        self.assertEqual(self.fired, [])
+        self.run_for(2)
+        self.assertEqual(self.fired, ['a'])
+
+        # A fired timer can be scheduled again
+        self.wheel.reschedule(timer, 2)
+        self.run_for(2)
+        self.assertEqual(self.fired, ['a', 'a'])
+
+    def test_cancel(self):
+        timer = self.wheel.schedule(5, self.fired.append, 'a')
+        timer.cancel()
+        self.assertFalse(timer.active)
+        self.run_for(10)
+        self.assertEqual(self.fired, [])
+
+    def test_cascade(self):
+        # Level 0 spans 8 ticks, level 1 64 and level 2 512
+        self.wheel.schedule(20, self.fired.append, 'level1')
+        self.wheel.schedule(100, self.fired.append, 'level2')
+        self.wheel.schedule(600, self.fired.append, 'parked')
+        expected = {20: ['level1'], 100: ['level1', 'level2'], 600: ['level1', 'level2', 'parked']}
+        fired = []
+        for elapsed in range(1, 601):
+            self.run_for(1)
+            fired = expected.get(elapsed, fired)
+            self.assertEqual(self.fired, fired)
+
+    def test_idle(self):
+        self.wheel.schedule(1, self.fired.append, 'a')
+        self.run_for(1)
+
+        # Nothing drives the wheel while it is empty
+        self.now += 3600
+        self.wheel.schedule(30, self.fired.append, 'b')
+        self.wheel.advance()
+        self.run_for(29)
+        self.assertEqual(self.fired, ['a'])
+        self.run_for(1)
+        self.assertEqual(self.fired, ['a', 'b'])
+
+    def test_first_timer_after_start(self):
+        self.now += 60
+        self.wheel.schedule(30, self.fired.append, 'a')
+        self.run_for(1)
+        self.assertEqual(self.fired, [])
+
+
+class RoomStateTest(SimpleTestCase):
+    """Reconnecting clients get the events they missed from the same log only"""
+
+    def setUp(self):
+        self.state = RoomState(capacity=4)
+        for n in range(6):
+            self.state.record({'type': 'chat_message', 'n': n})
+
+    def test_events_since(self):
+        events = self.state.events_since(4, self.state.epoch)
+        self.assertEqual([json.loads(text)['n'] for text in events], [4, 5])
+        self.assertEqual(self.state.events_since(6, self.state.epoch), [])
+
+    def test_trimmed_or_future_version(self):
+        self.assertIsNone(self.state.events_since(1, self.state.epoch))
+        self.assertIsNone(self.state.events_since(7, self.state.epoch))
+
+    def test_other_epoch(self):
+        # A new log (worker restart) reuses low version numbers
+        restarted = RoomState()
+        restarted.record({'type': 'chat_message', 'n': 0})
+        self.assertIsNone(restarted.events_since(0, self.state.epoch))
+        self.assertIsNone(restarted.events_since(0))
+        self.assertEqual(len(restarted.events_since(0, restarted.epoch)), 1)
+
+
+class RoomAffinityTest(SimpleTestCase):
+    """Workers agree on one owner per room, even when their rings disagree"""
+
+    def setUp(self):
+        self.redis = LocalRedis()
+        self.workers = {}
+        for name in ('a', 'b'):
+            worker = self.workers[name] = RoomAffinity(self.redis)
+            worker.worker_id = name
+            worker.channel_name = f'room_owner.{name}'
+            worker.refresh()
+        self.workers['a'].refresh()
+
+    def test_first_claim_wins(self):
+        a, b = self.workers['a'], self.workers['b']
+        self.assertEqual(a.claim('room'), 'a')
+        self.assertEqual(b.claim('room'), 'a')
+        self.assertIsNone(a.resolve_sync('room'))
+        self.assertEqual(b.resolve_sync('room'), 'room_owner.a')
+
+    def test_split_ring(self):
+        a, b = self.workers['a'], self.workers['b']
+        # b has not seen a yet and believes it owns everything
+        b.members = {'b': b.channel_name}
+        b.ring = HashRing(['b'])
+        a.ring = HashRing(['a'])
+        self.assertIsNone(a.resolve_sync('room'))
+        self.assertEqual(b.resolve_sync('room'), 'room_owner.a')
+
+    def test_dead_owner_is_replaced(self):
+        a, b = self.workers['a'], self.workers['b']
+        a.claim('room')
+        self.redis.zadd(WORKERS_KEY, {'a': time.time() - 2 * a.ttl})
+        self.assertEqual(b.claim('room'), 'b')
+        self.assertEqual(a.claim('room'), 'b')
+
+
+class MatchmakingTest(SimpleTestCase):
+    """Queued players are matched and charged once, and a cancel is final"""
+
+    def setUp(self):
+        self.queue = MatchQueue(LocalRedis())
+        self.rooms = []
+        self.sent = []
+        self.unpaid = set()
+        self.matcher = Matcher(self.queue, on_match=self.create_room, notify=self.sent.extend)
+
+    def create_room(self, bet, user_ids):
+        unpaid = [user_id for user_id in user_ids if user_id in self.unpaid]
+        if unpaid:
+            return None, unpaid
+        self.rooms.append((bet, user_ids))
+        return f'room-{len(self.rooms)}', []
+
+    def enqueue(self, *user_ids):
+        for n, user_id in enumerate(user_ids):
+            self.queue.enqueue(user_id, '5', enqueued_at=n + 1)
+
+    def test_matches_full_tables(self):
+        self.enqueue(*range(1, 10))
+        self.assertEqual(self.matcher.run_once(), 2)
+        self.assertEqual(self.rooms, [(Decimal('5.00'), [1, 2, 3, 4]), (Decimal('5.00'), [5, 6, 7, 8])])
+        self.assertEqual([(user_id, event['room_id'], event['color']) for user_id, event in self.sent[:4]],
+                         [(user_id, 'room-1', color) for user_id, color in zip([1, 2, 3, 4], COLORS)])
+        self.assertTrue(self.queue.cancel(9))
+        self.assertEqual(self.matcher.run_once(), 0)
+        self.assertEqual(self.queue.bets(), set())
+
+    def test_cancel_after_pop_fails(self):
+        self.enqueue(1, 2, 3, 4)
+        self.queue.pop_tables('5.00')
+        self.assertFalse(self.queue.cancel(1))
+
+    def test_notify_failure_does_not_match_again(self):
+        self.enqueue(1, 2, 3, 4)
+        self.matcher.notify = mock.Mock(side_effect=RuntimeError('channel layer down'))
+        with self.assertLogs('game.matchmaking', 'ERROR'):
+            self.assertEqual(self.matcher.run_once(), 1)
+        self.assertEqual(self.matcher.run_once(), 0)
+        self.assertEqual(len(self.rooms), 1)
+
+    def test_unpaid_players_are_told(self):
+        self.unpaid = {2}
+        self.enqueue(1, 2, 3, 4, 5)
+        self.assertEqual(self.matcher.run_once(), 0)
+        self.assertEqual(self.sent, [(2, {'type': 'match_failed', 'bet_amount': 5.0,
+                                          'message': 'Insufficient balance'})])
+        self.assertFalse(self.queue.cancel(2))
+        self.assertEqual(self.matcher.run_once(), 1)
+        self.assertEqual(self.rooms, [(Decimal('5.00'), [1, 3, 4, 5])])
+
+    def test_failed_room_is_requeued(self):
+        self.enqueue(1, 2, 3, 4)
+        with mock.patch.object(self.matcher, 'on_match', side_effect=RuntimeError('database down')), \
+                self.assertLogs('game.matchmaking', 'ERROR'):
+            self.assertEqual(self.matcher.run_once(), 0)
+        self.assertEqual(self.sent, [])
+        self.assertEqual(self.matcher.run_once(), 1)
+        self.assertEqual(self.rooms, [(Decimal('5.00'), [1, 2, 3, 4])])
+
+
+class FakeSender:
+    """Stands in for the socket of a seated player"""
+
+    channel_name = 'test.sender'
+
+    def __init__(self, player):
+        self.player_pk = player['id']
+        self.color = player['color']
+        self.seat = COLORS.index(player['color'])
+        self.game_room_pk = 1
+        self.scope = {'user': mock.Mock(id=player['user_id'], username=player['username'])}
+        self.errors = []
+
+    async def send_error(self, message):
+        self.errors.append(message)
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class RoomActorTest(SimpleTestCase):
+    """Game actions applied by a room's actor"""
+
+    room_id = 'actor-test'
+
+    def roster(self, status, colors=('red', 'green')):
+        return {
+            'id': 1, 'room_id': self.room_id, 'status': status, 'bet_amount': 5.0,
+            'current_players': len(colors),
+            'players': [
+                {'id': n + 1, 'user_id': n + 1, 'username': f'player{n + 1}',
+                 'color': color, 'position': n + 1}
+                for n, color in enumerate(colors)
+            ],
+        }
+
+    def tearDown(self):
+        release_room_actor(self.room_id)
+        turns.release_room(self.room_id)
+
+    def test_waiting_room_rejects_game_actions(self):
+        game_state = self.roster('waiting')
+        sender = FakeSender(game_state['players'][0])
+
+        async def play():
+            actor = get_room_actor(self.room_id)
+            await actor.ready.wait()
+            await actor.roll(sender)
+            await actor.move(sender, 0)
+            await actor.client_seed(sender, 'seed')
+            return actor
+
+        with mock.patch('game.actors.load_game_state', mock.AsyncMock(return_value=game_state)):
+            actor = async_to_sync(play)()
+        self.assertEqual(sender.errors, ['Game has not started'] * 3)
+        self.assertEqual((actor.dice.nonce, actor.board.move_number), (0, 0))
+        self.assertNotIn(self.room_id, turns._turn_timers)
+
+    @override_settings(TURN_TIMEOUT_FORFEIT=40)
+    def test_two_player_room(self):
+        game_state = self.roster('in_progress')
+        moves = []
+        buffer = mock.Mock(add=lambda *row: moves.append(row))
+        broadcast = mock.AsyncMock()
+        settle = mock.AsyncMock()
+
+        async def play():
+            actor = get_room_actor(self.room_id)
+            await actor.ready.wait()
+            # Auto-play until a seat forfeits
+            while actor.board.winner is None:
+                await actor.timeout()
+            return actor
+
+        with mock.patch('game.actors.load_game_state', mock.AsyncMock(return_value=game_state)), \
+                mock.patch('game.actors.restore_board', mock.Mock(return_value=LudoBoard())), \
+                mock.patch('game.actors.move_buffer', buffer), \
+                mock.patch('game.actors.broadcast_room', broadcast), \
+                mock.patch('game.actors.save_fairness', mock.AsyncMock()), \
+                mock.patch('game.actors.settle_game', settle):
+            actor = async_to_sync(play)()
+
+        colors = {event['color'] for (_, event), _ in broadcast.call_args_list}
+        self.assertLessEqual(colors, {'red', 'green'})
+        self.assertIn(COLORS[actor.board.winner], colors)
+        winner = actor.player(actor.board.winner)
+        settle.assert_awaited_once_with(1, winner['id'])
+        # Every move was played by a seated player and logged in order
+        self.assertTrue(moves)
+        self.assertEqual([row[-1] for row in moves], list(range(1, len(moves) + 1)))
+        self.assertLessEqual({row[1] for row in moves}, {1, 2})
+        # The log, forfeit included, rebuilds the final board
+        replayed = replay_moves({1: 0, 2: 2}, [row[1:] for row in moves])
+        self.assertEqual(replayed.to_bytes(), actor.board.to_bytes())
+
+    @override_settings(ROOM_AFFINITY=False)
+    def test_restores_game_in_progress(self):
+        game_state = self.roster('in_progress')
+        played = LudoBoard(['red', 'green'])
+        played.roll(0, 6)
+        played.move(0, 1)
+        restore = mock.Mock(return_value=played)
+
+        async def start():
+            actor = get_room_actor(self.room_id)
+            await actor.ready.wait()
+            return actor
+
+        with mock.patch('game.actors.load_game_state', mock.AsyncMock(return_value=game_state)), \
+                mock.patch('game.actors.restore_board', restore):
+            actor = async_to_sync(start)()
+        restore.assert_called_once_with(1)
+        self.assertIs(actor.board, played)
+        self.assertEqual(actor.board.move_number, 1)
+
+
+class RateLimitTest(SimpleTestCase):
+    """Token buckets and the budget checks in ``GameConsumer.receive``"""
+
+    room_id = 'ratelimit-test'
+
+    def tearDown(self):
+        ratelimit.release_room_limiter(self.room_id)
+
+    def consumer(self, seat=None, turn=0):
+        consumer = GameConsumer()
+        consumer.limiter = ratelimit.connection_limiter()
+        consumer.room_limiter = ratelimit.get_room_limiter(self.room_id)
+        consumer.strikes = ratelimit.strike_bucket(time.monotonic())
+        consumer.rate_limited = False
+        consumer.seat = seat
+        consumer.actor = mock.Mock(board=mock.Mock(turn=turn))
+        consumer.send_error = mock.AsyncMock()
+        consumer.close = mock.AsyncMock()
+        consumer.handle_dice_roll = mock.AsyncMock()
+        consumer.handle_chat = mock.AsyncMock()
+        return consumer
+
+    def send(self, consumer, message_type, times=1):
+        async def run():
+            for _ in range(times):
+                await consumer.receive(text_data=json.dumps({'type': message_type}))
+        async_to_sync(run)()
+
+    def test_bucket_refills_up_to_burst(self):
+        bucket = TokenBucket(2, 3, now=0)
+        self.assertEqual([bucket.take(0) for _ in range(4)], [True, True, True, False])
+        # Half a second at 2 tokens/sec buys one more
+        self.assertTrue(bucket.take(0.5))
+        self.assertFalse(bucket.take(0.5))
+        # A long pause never banks more than the burst
+        self.assertEqual([bucket.take(100) for _ in range(4)], [True, True, True, False])
+
+    def test_bucket_cost(self):
+        bucket = TokenBucket(1, 5, now=0)
+        self.assertTrue(bucket.take(0, cost=5))
+        self.assertFalse(bucket.take(1, cost=2))
+        self.assertTrue(bucket.take(2, cost=2))
+
+    def test_unbudgeted_types_are_unlimited(self):
+        limiter = RateLimiter({'roll_dice': (0, 1)})
+        self.assertTrue(limiter.allow('roll_dice', 0))
+        self.assertFalse(limiter.allow('roll_dice', 0))
+        self.assertTrue(all(limiter.allow('chat_message', 0) for _ in range(100)))
+
+    @override_settings(WS_RATE_LIMITS={'chat_message': (0, 1)}, WS_RATE_LIMIT_STRIKES=(0, 2))
+    def test_strikes_disconnect(self):
+        consumer = self.consumer(seat=0)
+        self.send(consumer, 'chat_message', times=3)
+        self.assertEqual(consumer.handle_chat.await_count, 1)
+        # One notice per burst of dropped frames
+        consumer.send_error.assert_awaited_once_with('Rate limit exceeded, slow down')
+        consumer.close.assert_not_awaited()
+
+        self.send(consumer, 'chat_message')
+        consumer.close.assert_awaited_once_with(code=4029)
+        self.assertIsNone(consumer.strikes)
+        # Frames after the close are ignored
+        self.send(consumer, 'chat_message')
+        self.assertEqual(consumer.close.await_count, 1)
+
+    @override_settings(WS_RATE_LIMITS={'frame': (0, 1)}, WS_RATE_LIMIT_STRIKES=(0, 5))
+    def test_bad_frames_cost_strikes(self):
+        consumer = self.consumer(seat=0)
+
+        async def run():
+            await consumer.receive(text_data='not json')
+            await consumer.receive(text_data=json.dumps({'type': 'chat_message'}))
+        async_to_sync(run)()
+        # The unparseable frame spent the frame budget, and both cost a strike
+        consumer.handle_chat.assert_not_awaited()
+        self.assertEqual(consumer.strikes.tokens, 3)
+
+    @override_settings(WS_RATE_LIMITS={}, WS_ROOM_RATE_LIMITS={'roll_dice': (0, 1)})
+    def test_spectators_do_not_spend_the_room_budget(self):
+        spectator = self.consumer(seat=None)
+        waiting = self.consumer(seat=1, turn=0)
+        self.send(spectator, 'roll_dice', times=5)
+        self.send(waiting, 'roll_dice', times=5)
+        spectator.send_error.assert_awaited_with('Only players can play')
+        waiting.send_error.assert_awaited_with('Not your turn')
+
+        player = self.consumer(seat=0, turn=0)
+        self.send(player, 'roll_dice')
+        player.handle_dice_roll.assert_awaited_once()
+
+    @override_settings(WS_RATE_LIMITS={}, WS_ROOM_RATE_LIMITS={'chat_message': (0, 1)},
+                       WS_RATE_LIMIT_STRIKES=(0, 1))
+    def test_room_budget_drops_cost_no_strike(self):
+        first = self.consumer(seat=0)
+        second = self.consumer(seat=1)
+        self.send(first, 'chat_message')
+        self.send(second, 'chat_message', times=5)
+        second.handle_chat.assert_not_awaited()
+        second.send_error.assert_awaited_once_with('Rate limit exceeded, slow down')
+        second.close.assert_not_awaited()
+        self.assertEqual(second.strikes.tokens, 1)
+
+
+class FailingBuffer(WriteBehindBuffer):
+    """Buffer whose writes fail for ``bad`` rows, or for every row while ``down``"""
+
+    max_attempts = 3
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.bad = set()
+        self.down = False
+        self.written = []
+
+    def _persist(self, batch, extra):
+        if self.down or self.bad.intersection(batch):
+            raise ValueError('write failed')
+        self.written.extend(batch)
+
+
+class WriteBehindBufferTest(SimpleTestCase):
+    """Retries, backoff and dead-lettering of failed flushes"""
+
+    def flush(self, buffer, times):
+        """Flush ``times`` in a row; returns the rows written and the retry delay after each"""
+        async def run():
+            loop = asyncio.get_running_loop()
+            results = []
+            for _ in range(times):
+                written = await buffer.flush()
+                timer = buffer._timer
+                results.append((written, timer and round(timer.when() - loop.time(), 1)))
+                buffer._cancel_timer()
+            return results
+        return async_to_sync(run)()
+
+    def test_bad_row_is_dead_lettered(self):
+        buffer = FailingBuffer(max_delay=0.1)
+        buffer._pending = list(range(1, 9))
+        buffer.bad = {5}
+        with self.assertLogs('game.move_buffer', 'ERROR') as logs:
+            results = self.flush(buffer, 3)
+
+        # Plain retries back off; the third failure isolates the bad row
+        self.assertEqual(results, [(0, 0.2), (0, 0.4), (8, None)])
+        self.assertEqual(sorted(buffer.written), [1, 2, 3, 4, 6, 7, 8])
+        self.assertEqual(list(buffer.dead_letters), [5])
+        self.assertEqual(buffer.dead_lettered, 1)
+        self.assertIn('Giving up on rows row 5', logs.output[-1])
+
+        # The failure streak is over: no more backoff
+        self.assertEqual(buffer._pending, [])
+        self.assertEqual(buffer._failures, 0)
+        buffer._pending = [9]
+        self.assertEqual(self.flush(buffer, 1), [(1, None)])
+        self.assertEqual(buffer.written[-1], 9)
+
+    def test_database_down_keeps_rows(self):
+        buffer = FailingBuffer(max_delay=0.1)
+        buffer.max_retry_delay = 0.5
+        buffer._pending = [1, 2, 3]
+        buffer.down = True
+        with self.assertLogs('game.move_buffer', 'ERROR'):
+            results = self.flush(buffer, 4)
+
+        # Isolation writes nothing, so everything is kept and retried
+        self.assertEqual(results, [(0, 0.2), (0, 0.4), (0, 0.5), (0, 0.5)])
+        self.assertEqual(buffer._pending, [1, 2, 3])
+        self.assertEqual(list(buffer.dead_letters), [])
+
+        buffer.down = False
+        self.assertEqual(self.flush(buffer, 1), [(3, None)])
+        self.assertEqual(buffer.written, [1, 2, 3])
+
+    def test_oldest_rows_dropped_past_max_pending(self):
+        buffer = FailingBuffer(max_pending=4)
+        buffer._pending = list(range(6))
+        buffer.down = True
+        with self.assertLogs('game.move_buffer', 'ERROR'):
+            self.flush(buffer, 1)
+        self.assertEqual(buffer._pending, [2, 3, 4, 5])
+        self.assertEqual(list(buffer.dead_letters), [0, 1])
+
+
+class FlakyRedis(LocalRedis):
+    """Fails the next ``failures`` plain SETs, as a Redis outage would"""
+    failures = 0
+
+    def set(self, key, value, nx=False, ex=None):
+        if not nx and self.failures:
+            self.failures -= 1
+            raise ConnectionError('Redis unavailable')
+        return super().set(key, value, nx=nx, ex=ex)
+
+
+@override_settings(IDEMPOTENCY_WAIT_SECONDS=5, IDEMPOTENCY_POLL_SECONDS=0.01,
+                   IDEMPOTENCY_LOCK_SECONDS=30, IDEMPOTENCY_TTL_SECONDS=3600)
+class IdempotencyStoreTest(SimpleTestCase):
+    """A key runs its request once; retries get the stored response"""
+
+    def setUp(self):
+        self.now = 0.0
+        self.redis = FlakyRedis(clock=lambda: self.now)
+        self.store = IdempotencyStore(redis=self.redis, clock=lambda: self.now, sleep=self.advance)
+        self.calls = 0
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def execute(self, status=201):
+        self.calls += 1
+        return Response({'call': self.calls}, status=status)
+
+    def fail(self):
+        raise RuntimeError('view failed')
+
+    def test_replay(self):
+        first = self.store.run('key', 'body', self.execute)
+        retry = self.store.run('key', 'body', self.execute)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual((retry.status_code, retry.data), (201, first.data))
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+
+    def test_conflicting_body(self):
+        self.store.run('key', 'body', self.execute)
+        response = self.store.run('key', 'other body', self.execute)
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(self.calls, 1)
+
+    def test_claim_in_progress(self):
+        inner = []
+
+        def execute():
+            inner.append(self.store.run('key', 'body', self.execute))
+            return self.execute()
+
+        self.store.run('key', 'body', execute)
+        self.assertEqual(inner[0].status_code, 409)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.store.stats()['waited'], 1)
+
+    def test_concurrent_duplicate_waits_for_response(self):
+        store = IdempotencyStore(redis=self.redis)
+        results = []
+        duplicate = threading.Thread(target=lambda: results.append(store.run('key', 'body', self.execute)))
+
+        def execute():
+            duplicate.start()
+            while not store.stats()['waited']:
+                time.sleep(0.001)
+            return self.execute()
+
+        first = store.run('key', 'body', execute)
+        duplicate.join()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results[0].data, first.data)
+        self.assertEqual(results[0]['Idempotent-Replayed'], 'true')
+
+    def test_server_error_releases_claim(self):
+        self.store.run('key', 'body', lambda: self.execute(status=503))
+        with self.assertRaises(RuntimeError):
+            self.store.run('key', 'body', self.fail)
+        response = self.store.run('key', 'body', self.execute)
+        self.assertEqual((response.status_code, self.calls), (201, 2))
+
+    def test_release_keeps_newer_claim(self):
+        self.redis.set('key', json.dumps({'token': 'newer', 'fingerprint': 'body'}))
+        self.store._release('key', 'expired')
+        self.assertIsNotNone(self.redis.get('key'))
+
+    def test_unstored_response_is_not_run_again(self):
+        self.redis.failures = 3
+        with self.assertLogs('game.idempotency', 'ERROR'):
+            first = self.store.run('key', 'body', self.execute)
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(self.store.stats()['unstored'], 1)
+        # The claim still holds retries off instead of paying out twice
+        self.assertEqual(self.store.run('key', 'body', self.execute).status_code, 409)
+        self.assertEqual(self.calls, 1)
+
+    def test_store_retried(self):
+        self.redis.failures = 2
+        self.store.run('key', 'body', self.execute)
+        self.assertEqual(self.store.run('key', 'body', self.execute)['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.calls, 1)
@@ -0,0 +1,159 @@
+"""
+Hierarchical timer wheel shared by every room in the process.
+
+Turn deadlines for all rooms live in one wheel driven by a single asyncio
+task, instead of one ``call_later`` handle per room per turn. Scheduling,
+cancelling and rescheduling are O(1) set operations; each tick fires every
+timer that expired in it as one batch.
+
+Level 0 has ``slots`` buckets of one tick each, level 1 buckets of ``slots``
+ticks, level 2 buckets of ``slots ** 2`` ticks. Timers in higher levels are
+cascaded down when the lower wheel wraps around.
+"""
+import asyncio
+import inspect
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Timer:
+    """Handle for a scheduled callback"""
+
+    __slots__ = ('expires', 'callback', 'args', 'bucket')
+
+    def __init__(self, expires, callback, args):
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+        self.bucket = None
+
+    def cancel(self):
+        if self.bucket is not None:
+            self.bucket.discard(self)
+            self.bucket = None
+
+    @property
+    def active(self):
+        return self.bucket is not None
+
+
+class TimerWheel:
+    """Three-level hashed timer wheel"""
+
+    LEVELS = 3
+
+    def __init__(self, tick=0.1, slots=256, clock=time.monotonic):
+        self.tick = tick
+        self.slots = slots
+        self.clock = clock
+        self.current = int(clock() / tick)
+        self._wheels = [[set() for _ in range(slots)] for _ in range(self.LEVELS)]
+        self._task = None
+        self.fired = 0
+
+    def schedule(self, delay, callback, *args):
+        """Run ``callback(*args)`` after ``delay`` seconds"""
+        timer = Timer(self._deadline(delay), callback, args)
+        self._place(timer)
+        self._ensure_running()
+        return timer
+
+    def reschedule(self, timer, delay):
+        """Move an existing (possibly fired or cancelled) timer to a new deadline"""
+        timer.cancel()
+        timer.expires = self._deadline(delay)
+        self._place(timer)
+        self._ensure_running()
+        return timer
+
+    def _deadline(self, delay):
+        # Deadlines count from the clock, not from the last processed tick,
+        # which lags behind after the wheel has been idle
+        now = int(self.clock() / self.tick)
+        if now > self.current + 1 and not self._running() and not len(self):
+            # Idle and empty: skip the ticks nobody processed
+            self.current = now
+        return max(now, self.current) + max(1, round(delay / self.tick))
+
+    def __len__(self):
+        return sum(len(bucket) for wheel in self._wheels for bucket in wheel)
+
+    def advance(self, now=None):
+        """Process every tick up to ``now``; returns the number of timers fired"""
+        target = int((self.clock() if now is None else now) / self.tick)
+        fired = 0
+        while self.current < target:
+            self.current += 1
+            self._cascade()
+            fired += self._fire(self._wheels[0][self.current % self.slots])
+        return fired
+
+    def _place(self, timer):
+        slots = self.slots
+        delta = timer.expires - self.current
+        if delta < slots:
+            bucket = self._wheels[0][timer.expires % slots]
+        elif delta < slots ** 2:
+            bucket = self._wheels[1][(timer.expires // slots) % slots]
+        else:
+            # Beyond the top level the timer is parked in the farthest
+            # bucket and re-placed when it cascades
+            expires = min(timer.expires, self.current + slots ** 3 - 1)
+            bucket = self._wheels[2][(expires // slots ** 2) % slots]
+        bucket.add(timer)
+        timer.bucket = bucket
+
+    def _cascade(self):
+        slots = self.slots
+        if self.current % slots:
+            return
+        for level in range(1, self.LEVELS):
+            index = (self.current // slots ** level) % slots
+            bucket = self._wheels[level][index]
+            if bucket:
+                timers = list(bucket)
+                bucket.clear()
+                for timer in timers:
+                    self._place(timer)
+            if index:
+                break
+
+    def _fire(self, bucket):
+        if not bucket:
+            return 0
+        due = [timer for timer in bucket if timer.expires <= self.current]
+        for timer in due:
+            bucket.discard(timer)
+            timer.bucket = None
+
+        for timer in due:
+            try:
+                result = timer.callback(*timer.args)
+                if inspect.isawaitable(result):
+                    asyncio.ensure_future(result)
+            except Exception:
+                logger.exception('Timer callback failed')
+        self.fired += len(due)
+        return len(due)
+
+    def _running(self):
+        return self._task is not None and not self._task.done()
+
+    def _ensure_running(self):
+        if not self._running():
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # No loop (benchmarks, tests): the caller drives advance()
+                return
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while len(self):
+            await asyncio.sleep(self.tick)
+            self.advance()
+
+
+timer_wheel = TimerWheel()
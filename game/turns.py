@@ -0,0 +1,86 @@
+"""
+Turn deadlines for active rooms.
+
+Every in-progress room has one timer in the shared ``timer_wheel`` that is
+rescheduled after each roll or move. When a player lets it expire the turn
+is played for them by the room's actor: it rolls if needed and moves the
+first legal piece. After ``TURN_TIMEOUT_FORFEIT`` expired turns in a row
+the player forfeits, and the last player left wins.
+"""
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .dice import release_room_dice
+from .engine import IllegalMove, release_board
+from .move_buffer import move_buffer
+from .ratelimit import release_room_limiter
+from .state_log import get_room_state, release_room_state
+from .timers import timer_wheel
+
+# Turn timer of each room active in this process
+_turn_timers = {}
+
+
+def room_group(room_id):
+    return f'game_{room_id}'
+
+
+async def broadcast_room(room_id, event):
+    """Record event in the room log and send it, encoded once, to the room group"""
+    frame = get_room_state(room_id).record(event)
+    await get_channel_layer().group_send(room_group(room_id), frame)
+
+
+def arm_turn_timer(room_id):
+    """Start or restart the deadline for the current turn"""
+    timer = _turn_timers.get(room_id)
+    if timer is None:
+        _turn_timers[room_id] = timer_wheel.schedule(
+            settings.TURN_TIMEOUT_SECONDS, on_turn_timeout, room_id
+        )
+    else:
+        timer_wheel.reschedule(timer, settings.TURN_TIMEOUT_SECONDS)
+
+
+def ensure_turn_timer(room_id):
+    """Arm the turn timer unless the room already has one"""
+    if room_id not in _turn_timers:
+        arm_turn_timer(room_id)
+
+
+def disarm_turn_timer(room_id):
+    timer = _turn_timers.pop(room_id, None)
+    if timer is not None:
+        timer.cancel()
+
+
+async def finish_room(room_id, winner):
+    """Announce the winner, reveal the dice seed and release the room's in-memory state"""
+    dice = release_room_dice(room_id)
+    await broadcast_room(room_id, {
+        'type': 'game_ended',
+        'winner': winner,
+        'fairness': dice.reveal() if dice else None
+    })
+    release_room(room_id)
+    await move_buffer.flush()
+
+
+def release_room(room_id):
+    """Drop the turn timer, board, state log and limiter of ``room_id``"""
+    disarm_turn_timer(room_id)
+    release_room_dice(room_id)
+    release_board(room_id)
+    release_room_state(room_id)
+    release_room_limiter(room_id)
+
+
+def on_turn_timeout(room_id):
+    """Hand the expired turn to the room's actor"""
+    from .actors import get_room_actor
+
+    try:
+        get_room_actor(room_id).submit('timeout')
+    except IllegalMove:
+        # Mailbox full: try again after another turn period
+        arm_turn_timer(room_id)
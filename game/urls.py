@@ -5,6 +5,7 @@ from .views import (
     WalletViewSet,
     TournamentViewSet,
     LeaderboardViewSet,
+    MatchmakingViewSet,
     GameStatsView
 )
 
@@ -13,6 +14,7 @@ router.register(r'rooms', GameRoomViewSet, basename='gameroom')
 router.register(r'wallet', WalletViewSet, basename='wallet')
 router.register(r'tournaments', TournamentViewSet, basename='tournament')
 router.register(r'leaderboard', LeaderboardViewSet, basename='leaderboard')
+router.register(r'matchmaking', MatchmakingViewSet, basename='matchmaking')
 
 urlpatterns = [
     path('', include(router.urls)),
@@ -2,11 +2,19 @@ from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
+from django.conf import settings
 from django.db import transaction
 from django.utils import timezone
 from decimal import Decimal
-from .models import GameRoom, GamePlayer, Transaction, User
-from .serializers import GameRoomSerializer, GamePlayerSerializer, TransactionSerializer
+from .models import GameRoom, GamePlayer, Transaction, RoomFairness
+from .serializers import GameRoomSerializer, TransactionSerializer, RoomFairnessSerializer
+from . import history
+from .idempotency import idempotent
+from .lobby import bet_bands, reload_waiting_rooms, waiting_rooms
+from .matchmaking import match_queue
+from .settlement import settle_room
+from users import ledger
+from users.ledger import ESCROW, PLATFORM
 
 class GameRoomViewSet(viewsets.ModelViewSet):
     """API for Game Room Management"""
@@ -22,6 +30,7 @@ class GameRoomViewSet(viewsets.ModelViewSet):
         return self.queryset
 
     @action(detail=False, methods=['post'])
+    @idempotent
     def create_room(self, request):
         """Create a new game room"""
         bet_amount = Decimal(request.data.get('bet_amount', 0))
@@ -33,42 +42,41 @@ class GameRoomViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        # Check user balance
-        if request.user.wallet_balance < bet_amount:
-            return Response(
-                {'error': 'Insufficient balance'},
-                status=status.HTTP_400_BAD_REQUEST
+        with transaction.atomic():
+            # Create game room
+            game_room = GameRoom.objects.create(
+                bet_amount=bet_amount,
+                commission_percentage=Decimal('2.00'),  # 2% commission
+                current_players=1
+            )
+            
+            # Move bet from user wallet to escrow, unless the balance is too low
+            if not request.user.deduct_balance(bet_amount, ESCROW, 'bet_placed',
+                                               reference=game_room.room_id):
+                transaction.set_rollback(True)
+                return Response(
+                    {'error': 'Insufficient balance'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            
+            # Add creator as first player
+            GamePlayer.objects.create(
+                game_room=game_room,
+                user=request.user,
+                color='red',
+                position=1,
+                bet_paid=True
+            )
+            
+            # Create transaction record
+            Transaction.objects.create(
+                user=request.user,
+                game_room=game_room,
+                transaction_type='bet_placed',
+                amount=bet_amount,
+                status='completed',
+                description=f'Bet placed for room {game_room.room_id}'
             )
-        
-        # Create game room
-        game_room = GameRoom.objects.create(
-            bet_amount=bet_amount,
-            commission_percentage=Decimal('2.00'),  # 2% commission
-            current_players=1
-        )
-        
-        # Add creator as first player
-        GamePlayer.objects.create(
-            game_room=game_room,
-            user=request.user,
-            color='red',
-            position=1,
-            bet_paid=True
-        )
-        
-        # Deduct bet from user wallet
-        request.user.wallet_balance -= bet_amount
-        request.user.save()
-        
-        # Create transaction record
-        Transaction.objects.create(
-            user=request.user,
-            game_room=game_room,
-            transaction_type='bet_placed',
-            amount=bet_amount,
-            status='completed',
-            description=f'Bet placed for room {game_room.room_id}'
-        )
         
         game_room.calculate_pool()
         
@@ -76,6 +84,7 @@ class GameRoomViewSet(viewsets.ModelViewSet):
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     @action(detail=True, methods=['post'])
+    @idempotent
     def join_room(self, request, pk=None):
         """Join an existing game room"""
         game_room = self.get_object()
@@ -101,19 +110,20 @@ class GameRoomViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        # Check user balance
-        if request.user.wallet_balance < game_room.bet_amount:
-            return Response(
-                {'error': 'Insufficient balance'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
         # Assign color and position
         colors = ['red', 'blue', 'green', 'yellow']
         used_colors = game_room.players.values_list('color', flat=True)
         available_color = [c for c in colors if c not in used_colors][0]
         
         with transaction.atomic():
+            # Move bet from user wallet to escrow, unless the balance is too low
+            if not request.user.deduct_balance(game_room.bet_amount, ESCROW, 'bet_placed',
+                                               reference=game_room.room_id):
+                return Response(
+                    {'error': 'Insufficient balance'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            
             # Add player to room
             GamePlayer.objects.create(
                 game_room=game_room,
@@ -127,10 +137,6 @@ class GameRoomViewSet(viewsets.ModelViewSet):
             game_room.current_players += 1
             game_room.calculate_pool()
             
-            # Deduct bet from user wallet
-            request.user.wallet_balance -= game_room.bet_amount
-            request.user.save()
-            
             # Create transaction record
             Transaction.objects.create(
                 user=request.user,
@@ -170,60 +176,47 @@ class GameRoomViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        with transaction.atomic():
-            # Mark winner
-            winner_player.is_winner = True
-            winner_player.save()
-            
-            # Update game room
-            game_room.winner = winner_player.user
-            game_room.status = 'completed'
-            game_room.completed_at = timezone.now()
-            game_room.save()
-            
-            # Credit winner
-            winner_player.user.wallet_balance += game_room.winner_amount
-            winner_player.user.total_games_won += 1
-            winner_player.user.save()
-            
-            # Create win transaction
-            Transaction.objects.create(
-                user=winner_player.user,
-                game_room=game_room,
-                transaction_type='win',
-                amount=game_room.winner_amount,
-                status='completed',
-                description=f'Won game {game_room.room_id}'
-            )
-            
-            # Create commission transaction (platform earning)
-            Transaction.objects.create(
-                user=winner_player.user,  # Can be admin user or null
-                game_room=game_room,
-                transaction_type='commission',
-                amount=game_room.commission_amount,
-                status='completed',
-                description=f'Platform commission from game {game_room.room_id}'
+        # Payout, commission and every player's stats in a fixed number of queries
+        if not settle_room(game_room, winner_player):
+            return Response(
+                {'error': 'Game is not in progress'},
+                status=status.HTTP_400_BAD_REQUEST
             )
-            
-            # Update stats for all players
-            for player in game_room.players.all():
-                player.user.total_games_played += 1
-                player.user.save()
         
         serializer = self.get_serializer(game_room)
         return Response(serializer.data)
 
+    @action(detail=True, methods=['get'])
+    def fairness(self, request, pk=None):
+        """Revealed dice seeds of a finished game, to verify its rolls"""
+        game_room = self.get_object()
+        
+        if game_room.status != 'completed':
+            return Response(
+                {'error': 'Seeds are revealed once the game is over'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        try:
+            fairness = game_room.fairness
+        except RoomFairness.DoesNotExist:
+            return Response(
+                {'error': 'No dice seeds were recorded for this game'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        
+        return Response(RoomFairnessSerializer(fairness).data)
+
     @action(detail=False, methods=['get'])
     def available_rooms(self, request):
-        """Get all rooms waiting for players"""
-        rooms = GameRoom.objects.filter(
-            status='waiting',
-            current_players__lt=4
-        ).order_by('-created_at')
-        
-        serializer = self.get_serializer(rooms, many=True)
-        return Response(serializer.data)
+        """Get all rooms waiting for players, optionally by bet band"""
+        if waiting_rooms.is_stale():
+            reload_waiting_rooms()
+        bands = request.query_params.getlist('band')
+        if bands:
+            bands = [int(b) for b in bands if b.isdigit() and int(b) < bet_bands()]
+            return Response(waiting_rooms.snapshot(bands))
+        return Response(waiting_rooms.snapshot())
 
     @action(detail=False, methods=['get'])
     def my_games(self, request):
@@ -264,6 +257,7 @@ class WalletViewSet(viewsets.ViewSet):
         })
 
     @action(detail=False, methods=['post'])
+    @idempotent
     def deposit(self, request):
         """Deposit funds (for MVP, just add virtual currency)"""
         amount = Decimal(request.data.get('amount', 0))
@@ -275,8 +269,7 @@ class WalletViewSet(viewsets.ViewSet):
             )
         
         with transaction.atomic():
-            request.user.wallet_balance += amount
-            request.user.save()
+            request.user.add_balance(amount)
             
             Transaction.objects.create(
                 user=request.user,
@@ -292,6 +285,7 @@ class WalletViewSet(viewsets.ViewSet):
         })
 
     @action(detail=False, methods=['post'])
+    @idempotent
     def withdraw(self, request):
         """Withdraw funds"""
         amount = Decimal(request.data.get('amount', 0))
@@ -303,15 +297,12 @@ class WalletViewSet(viewsets.ViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        if request.user.wallet_balance < amount:
-            return Response(
-                {'error': 'Insufficient balance'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
         with transaction.atomic():
-            request.user.wallet_balance -= amount
-            request.user.save()
+            if not request.user.deduct_balance(amount, description=f'Withdrawal to {usdt_address}'):
+                return Response(
+                    {'error': 'Insufficient balance'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
             
             Transaction.objects.create(
                 user=request.user,
@@ -328,13 +319,32 @@ class WalletViewSet(viewsets.ViewSet):
 
     @action(detail=False, methods=['get'])
     def transactions(self, request):
-        """Get user transaction history"""
-        transactions = Transaction.objects.filter(
-            user=request.user
-        ).order_by('-created_at')
+        """
+        Get user transaction history, newest first, one keyset page at a
+        time. ``?export=csv`` or ``?export=ndjson`` streams all of it instead.
+        """
+        try:
+            transactions = history.filter_transactions(
+                Transaction.objects.filter(user=request.user), request.query_params
+            )
+            export_format = request.query_params.get('export')
+            if export_format:
+                return history.export_response(transactions, export_format)
+            
+            rows, next_url = history.keyset_page(
+                request, transactions.select_related('user', 'game_room')
+            )
+        except history.InvalidQuery as e:
+            return Response(
+                {'error': str(e)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
         
-        serializer = TransactionSerializer(transactions, many=True)
-        return Response(serializer.data)
+        serializer = TransactionSerializer(rows, many=True)
+        return Response({
+            'next': next_url,
+            'results': serializer.data
+        })
 
 
 class TournamentViewSet(viewsets.ModelViewSet):
@@ -344,6 +354,7 @@ class TournamentViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
 
     @action(detail=True, methods=['post'])
+    @idempotent
     def join(self, request, pk=None):
         """Join a tournament"""
         tournament = self.get_object()
@@ -366,16 +377,14 @@ class TournamentViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        if request.user.wallet_balance < tournament.entry_fee:
-            return Response(
-                {'error': 'Insufficient balance'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
         with transaction.atomic():
-            # Deduct entry fee
-            request.user.wallet_balance -= tournament.entry_fee
-            request.user.save()
+            # Move entry fee to escrow until prizes are paid
+            if not request.user.deduct_balance(tournament.entry_fee, ESCROW, 'bet_placed',
+                                               reference=f'tournament:{tournament.pk}'):
+                return Response(
+                    {'error': 'Insufficient balance'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
             
             # Add to tournament
             TournamentParticipant.objects.create(
@@ -403,6 +412,44 @@ class TournamentViewSet(viewsets.ModelViewSet):
         })
 
 
+class MatchmakingViewSet(viewsets.ViewSet):
+    """Automatic matchmaking APIs"""
+    permission_classes = [IsAuthenticated]
+
+    @action(detail=False, methods=['post'])
+    def enqueue(self, request):
+        """Wait for a table at the given bet amount"""
+        bet_amount = Decimal(request.data.get('bet_amount', 0))
+        
+        if not settings.MIN_BET_AMOUNT <= bet_amount <= settings.MAX_BET_AMOUNT:
+            return Response(
+                {'error': f'Bet amount must be between {settings.MIN_BET_AMOUNT} and {settings.MAX_BET_AMOUNT}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        if request.user.wallet_balance < bet_amount:
+            return Response(
+                {'error': 'Insufficient balance'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        match_queue.enqueue(request.user.id, bet_amount)
+        return Response({
+            'message': 'Waiting for players',
+            'bet_amount': bet_amount
+        }, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=False, methods=['post'])
+    def cancel(self, request):
+        """Leave the matchmaking queue"""
+        if not match_queue.cancel(request.user.id):
+            return Response(
+                {'error': 'Not in matchmaking queue'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response({'message': 'Left matchmaking queue'})
+
+
 class LeaderboardViewSet(viewsets.ViewSet):
     """Leaderboard APIs"""
     permission_classes = [IsAuthenticated]
@@ -441,7 +488,7 @@ class GameStatsView(APIView):
     permission_classes = [IsAuthenticated]
     
     def get(self, request):
-        from django.db.models import Sum, Count
+        from django.db.models import Sum
         from users.models import User
         
         stats = {
@@ -453,9 +500,7 @@ class GameStatsView(APIView):
             'total_winnings': Transaction.objects.filter(
                 transaction_type='win'
             ).aggregate(total=Sum('amount'))['total'] or 0,
-            'platform_earnings': Transaction.objects.filter(
-                transaction_type='commission'
-            ).aggregate(total=Sum('amount'))['total'] or 0,
+            'platform_earnings': ledger.balance(PLATFORM),
             'active_rooms': GameRoom.objects.filter(status='waiting').count(),
             'ongoing_games': GameRoom.objects.filter(status='in_progress').count(),
         }
@@ -0,0 +1,202 @@
+"""
+Batched processing of pending withdrawals.
+
+``process_withdrawals`` runs from Celery beat (``game.tasks``, every
+``WITHDRAWAL_INTERVAL_SECONDS``) and calls ``confirm_submitted`` and then
+``process_pending``.
+
+``process_pending``:
+
+1. claims up to ``WITHDRAWAL_MAX_PER_RUN`` pending withdrawals, oldest
+   first, by moving them to ``processing`` (rows locked by a concurrent
+   run are skipped),
+2. validates them: the address in the description must be an Ethereum
+   address and the amount at least ``MIN_WITHDRAWAL_AMOUNT``. Rejected
+   rows are marked ``failed`` and refunded with one ledger booking,
+3. merges withdrawals to the same address and splits them into batches of
+   ``WITHDRAWAL_BATCH_SIZE`` recipients,
+4. signs each batch with the next wallet nonce through the chain client
+   (``game/chain.py``). In one transaction it records the batch as a
+   ``PayoutBatch`` (hash, nonce, raw transaction) and marks its rows
+   ``submitted`` with the hash. Only then is it broadcast.
+
+A batch that cannot be signed goes back to ``pending`` and is retried next
+run. A failed broadcast is only logged, because the batch is already
+recorded and ``confirm_submitted`` sends it again.
+
+``confirm_submitted`` asks the client what became of each recorded batch
+that still has submitted rows. Rows become ``completed`` once it is
+confirmed. A reverted transaction paid nothing, so its rows are marked
+``failed`` and refunded. A transaction the node does not know is
+broadcast again as-is, under the same nonce. A batch is only sent again
+as a new transaction once its nonce has been used by another one, when it
+can never be mined. Until then the rows stay ``submitted``.
+"""
+import logging
+import re
+from collections import OrderedDict
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Max
+
+from users import ledger
+from users.ledger import EXTERNAL, user_account
+
+from .chain import CONFIRMED, DROPPED, FAILED, MISSING, ChainError, get_chain_client
+from .models import PayoutBatch, Transaction
+
+logger = logging.getLogger(__name__)
+
+ADDRESS_PATTERN = re.compile(r'^0x[0-9a-fA-F]{40}$')
+DESCRIPTION_PREFIX = 'Withdrawal to '
+
+
+def withdrawal_address(description):
+    """The payout address recorded by ``WalletViewSet.withdraw``"""
+    if description.startswith(DESCRIPTION_PREFIX):
+        return description[len(DESCRIPTION_PREFIX):].strip()
+    return ''
+
+
+def claim_pending(limit):
+    """Move up to ``limit`` pending withdrawals to processing and return them"""
+    with transaction.atomic():
+        ids = list(
+            Transaction.objects.select_for_update(skip_locked=True).filter(
+                transaction_type='withdraw', status='pending'
+            ).order_by('created_at', 'pk').values_list('pk', flat=True)[:limit]
+        )
+        Transaction.objects.filter(pk__in=ids).update(status='processing')
+    return list(
+        Transaction.objects.filter(pk__in=ids).order_by('created_at', 'pk').values_list(
+            'pk', 'user_id', 'amount', 'description'
+        )
+    )
+
+
+def validate(rows):
+    """Split claimed rows into ``(valid, rejected)``"""
+    minimum = Decimal(str(settings.MIN_WITHDRAWAL_AMOUNT))
+    valid, rejected = [], []
+    for pk, user_id, amount, description in rows:
+        address = withdrawal_address(description)
+        if ADDRESS_PATTERN.match(address) and amount >= minimum:
+            valid.append((pk, address.lower(), amount))
+        else:
+            rejected.append((pk, user_id, amount))
+    return valid, rejected
+
+
+def refund(rows, description):
+    """Mark ``(pk, user_id, amount)`` withdrawals failed and give the money back"""
+    with transaction.atomic():
+        Transaction.objects.filter(pk__in=[pk for pk, _, _ in rows]).update(status='failed')
+        ledger.transfer_many([
+            (EXTERNAL, user_account(user_id), amount, 'refund', None)
+            for _, user_id, amount in rows
+        ], description=description)
+
+
+def reject(rows):
+    refund(rows, 'Rejected withdrawal')
+
+
+def make_batches(rows, size):
+    """
+    Merge withdrawals per address and yield ``(payouts, ids)`` batches of
+    at most ``size`` recipients, in the order the rows came in.
+    """
+    totals = OrderedDict()
+    for pk, address, amount in rows:
+        total, ids = totals.get(address, (Decimal('0'), []))
+        totals[address] = (total + amount, ids + [pk])
+    addresses = list(totals)
+    for start in range(0, len(addresses), size):
+        chunk = addresses[start:start + size]
+        yield (
+            [(address, totals[address][0]) for address in chunk],
+            [pk for address in chunk for pk in totals[address][1]]
+        )
+
+
+def next_nonce(client):
+    """Nonce for the next batch: past the wallet's count and every batch signed so far"""
+    signed = PayoutBatch.objects.aggregate(nonce=Max('nonce'))['nonce']
+    return max(client.next_nonce(), -1 if signed is None else signed + 1)
+
+
+def process_pending(client=None):
+    """One run of the pipeline; returns counts of what happened"""
+    client = client or get_chain_client()
+    rows = claim_pending(settings.WITHDRAWAL_MAX_PER_RUN)
+    valid, rejected = validate(rows)
+    stats = {
+        'claimed': len(rows), 'rejected': len(rejected),
+        'submitted': 0, 'batches': 0, 'retried': 0, 'unsent': 0,
+    }
+    if rejected:
+        reject(rejected)
+
+    nonce = None
+    for payouts, ids in make_batches(valid, settings.WITHDRAWAL_BATCH_SIZE):
+        try:
+            if nonce is None:
+                nonce = next_nonce(client)
+            tx_hash, raw_transaction = client.sign_batch(payouts, nonce)
+            with transaction.atomic():
+                PayoutBatch.objects.create(tx_hash=tx_hash, nonce=nonce, raw_transaction=raw_transaction)
+                Transaction.objects.filter(pk__in=ids).update(status='submitted', usdt_tx_hash=tx_hash)
+        except (ChainError, IntegrityError) as e:
+            # IntegrityError: a concurrent run took the nonce; look it up again
+            logger.warning('Payout batch of %d withdrawals not signed, retrying next run: %s', len(ids), e)
+            Transaction.objects.filter(pk__in=ids).update(status='pending')
+            stats['retried'] += len(ids)
+            nonce = None
+            continue
+        nonce += 1
+        stats['submitted'] += len(ids)
+        stats['batches'] += 1
+        try:
+            client.broadcast(raw_transaction)
+        except Exception:
+            logger.exception('Payout %s not broadcast; the next confirmation run sends it again', tx_hash)
+            stats['unsent'] += len(ids)
+    return stats
+
+
+def confirm_submitted(client=None):
+    """Settle submitted withdrawals whose transactions have an outcome"""
+    client = client or get_chain_client()
+    stats = {'confirmed': 0, 'reverted': 0, 'dropped': 0, 'rebroadcast': 0, 'waiting': 0}
+    submitted = Transaction.objects.filter(transaction_type='withdraw', status='submitted')
+    hashes = submitted.order_by().values_list('usdt_tx_hash', flat=True).distinct()
+    # In nonce order, so rebroadcasts fill the lowest gap first
+    for batch in PayoutBatch.objects.filter(tx_hash__in=list(hashes)).order_by('nonce'):
+        tx_hash = batch.tx_hash
+        rows = submitted.filter(usdt_tx_hash=tx_hash)
+        outcome = client.receipt_status(tx_hash, batch.nonce)
+        if outcome == CONFIRMED:
+            stats['confirmed'] += rows.update(status='completed')
+        elif outcome == FAILED:
+            logger.warning('Payout %s reverted; refunding its withdrawals', tx_hash)
+            with transaction.atomic():
+                # Locked so a concurrent run cannot refund the same rows
+                reverted = list(rows.select_for_update(skip_locked=True).values_list('pk', 'user_id', 'amount'))
+                if reverted:
+                    refund(reverted, 'Reverted withdrawal')
+            stats['reverted'] += len(reverted)
+        elif outcome == DROPPED:
+            logger.warning('Nonce %d of payout %s was used by another transaction; '
+                           'sending its withdrawals again', batch.nonce, tx_hash)
+            stats['dropped'] += rows.update(status='pending', usdt_tx_hash='')
+        elif outcome == MISSING:
+            try:
+                client.broadcast(batch.raw_transaction)
+            except Exception:
+                logger.exception('Payout %s could not be broadcast again', tx_hash)
+            stats['rebroadcast'] += rows.count()
+        else:
+            stats['waiting'] += rows.count()
+    return stats
@@ -0,0 +1,272 @@
+"""
+Double-entry ledger.
+
+Every movement of money is one immutable ``LedgerEntry`` that takes
+``amount`` from its debit account and adds it to its credit account. User
+accounts are named ``user:<id>`` and keep their balance in
+``User.wallet_balance``. Platform-owned accounts keep theirs in
+``LedgerAccount``:
+
+- ``escrow`` holds bets and tournament fees until a game is settled,
+- ``platform`` collects commission,
+- ``external`` is the outside world. Deposits come from it and
+  withdrawals go to it, so its balance is minus the money on the platform.
+
+``transfer`` writes the entry and moves both balances in one transaction,
+so the balances always equal the sum of the entries and all balances sum
+to zero. Balances are updated in account order, so concurrent transfers
+touching the same accounts cannot deadlock.
+
+Nearly every transfer touches a platform account, so each one keeps its
+balance in ``LEDGER_ACCOUNT_SHARDS`` rows (``escrow``, ``escrow#1``, ...)
+and a transfer moves a random one. Transfers then only queue behind each
+other on the same shard. ``balance`` sums the shards.
+
+``take_snapshots`` (run periodically by the ``ledger`` command) records
+the balance of every account that moved since the previous run, as of a
+cutoff. An account's latest snapshot plus the entries since then give its
+balance. ``balance_at`` and ``reconcile`` work that way, so they read
+snapshots and the recent entries rather than the whole history.
+"""
+import random
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Max, OuterRef, Q, Subquery, Sum
+from django.utils import timezone
+
+from .models import BalanceSnapshot, LedgerAccount, LedgerEntry, User
+from . import wallet
+
+PLATFORM = LedgerAccount.PLATFORM
+ESCROW = LedgerAccount.ESCROW
+EXTERNAL = LedgerAccount.EXTERNAL
+USER_PREFIX = 'user:'
+SHARD_SEPARATOR = '#'
+ZERO = Decimal('0.00')
+
+
+def user_account(user_id):
+    return f'{USER_PREFIX}{user_id}'
+
+
+def shard_codes(code):
+    """The LedgerAccount rows holding the balance of platform account ``code``"""
+    return [code] + [f'{code}{SHARD_SEPARATOR}{n}' for n in range(1, settings.LEDGER_ACCOUNT_SHARDS)]
+
+
+def _account(code):
+    return code.split(SHARD_SEPARATOR, 1)[0]
+
+
+def open_account(code):
+    """Create the balance rows of platform account ``code``"""
+    LedgerAccount.objects.bulk_create(
+        [LedgerAccount(code=shard) for shard in shard_codes(code)], ignore_conflicts=True
+    )
+
+
+def _user_id(account):
+    if account.startswith(USER_PREFIX):
+        return int(account[len(USER_PREFIX):])
+    return None
+
+
+def transfer(debit_account, credit_account, amount, entry_type, reference='',
+             description='', **counters):
+    """
+    Move ``amount`` from ``debit_account`` to ``credit_account`` and record
+    the entry. ``counters`` are added to the user side in the same UPDATE.
+    Returns the new balance of the user side (the credited user if both are
+    users), or None between platform accounts. Raises
+    ``wallet.InsufficientBalance`` when a debited user cannot cover it.
+    """
+    balances = transfer_many(
+        [(debit_account, credit_account, amount, entry_type, counters)],
+        reference=reference, description=description
+    )
+    user_side = credit_account if _user_id(credit_account) is not None else debit_account
+    return balances.get(user_side)
+
+
+def transfer_many(transfers, reference='', description=''):
+    """
+    Book several transfers with a fixed number of statements: one UPDATE
+    per account touched, in account order, and one INSERT for all entries.
+    ``transfers`` are ``(debit_account, credit_account, amount, entry_type,
+    counters)``; counters go to the user side as in ``transfer``. Returns
+    the new balances of the user accounts involved.
+    """
+    deltas = defaultdict(lambda: ZERO)
+    counters = defaultdict(dict)
+    entries = []
+    for debit_account, credit_account, amount, entry_type, extra in transfers:
+        amount = Decimal(str(amount))
+        deltas[debit_account] -= amount
+        deltas[credit_account] += amount
+        if extra:
+            side = credit_account if _user_id(credit_account) is not None else debit_account
+            for name, value in extra.items():
+                counters[side][name] = counters[side].get(name, 0) + value
+        entries.append(LedgerEntry(
+            debit_account=debit_account,
+            credit_account=credit_account,
+            amount=amount,
+            entry_type=entry_type,
+            reference=str(reference),
+            description=description
+        ))
+
+    balances = {}
+    with transaction.atomic():
+        for account in sorted(deltas):
+            delta = deltas[account]
+            user_id = _user_id(account)
+            if user_id is None:
+                _move(account, delta)
+            elif delta < 0:
+                balances[account] = wallet.debit(user_id, -delta, **counters[account])
+            else:
+                balances[account] = wallet.credit(user_id, delta, **counters[account])
+        LedgerEntry.objects.bulk_create(entries)
+    return balances
+
+
+def _move(code, delta):
+    shard = random.choice(shard_codes(code))
+    if not LedgerAccount.objects.filter(code=shard).update(balance=F('balance') + delta):
+        open_account(code)
+        LedgerAccount.objects.filter(code=shard).update(balance=F('balance') + delta)
+
+
+def balance(account):
+    """Current balance of ``account``"""
+    user_id = _user_id(account)
+    if user_id is not None:
+        return User.objects.values_list('wallet_balance', flat=True).get(pk=user_id)
+    shards = LedgerAccount.objects.filter(Q(code=account) | Q(code__startswith=account + SHARD_SEPARATOR))
+    return shards.aggregate(total=Sum('balance'))['total'] or ZERO
+
+
+def balance_at(account, at):
+    """Balance of ``account`` including the entries created up to ``at``"""
+    snapshot = BalanceSnapshot.objects.filter(account=account, cutoff__lte=at).first()
+    entries = LedgerEntry.objects.filter(created_at__lte=at)
+    start = ZERO
+    if snapshot is not None:
+        start = snapshot.balance
+        entries = entries.filter(created_at__gte=snapshot.cutoff)
+    credited = entries.filter(credit_account=account).aggregate(total=Sum('amount'))['total']
+    debited = entries.filter(debit_account=account).aggregate(total=Sum('amount'))['total']
+    return start + (credited or ZERO) - (debited or ZERO)
+
+
+def _deltas(entries):
+    """Net change per account over ``entries``"""
+    deltas = defaultdict(lambda: ZERO)
+    for account, total in entries.values_list('credit_account').annotate(total=Sum('amount')).order_by():
+        deltas[account] += total
+    for account, total in entries.values_list('debit_account').annotate(total=Sum('amount')).order_by():
+        deltas[account] -= total
+    return deltas
+
+
+def _latest_snapshots(accounts=None):
+    """
+    Each account's balance as of the latest snapshot run, and that run's
+    cutoff, or ({}, None). Limited to ``accounts`` when given.
+    """
+    cutoff = BalanceSnapshot.objects.aggregate(cutoff=Max('cutoff'))['cutoff']
+    if cutoff is None:
+        return {}, None
+    newest = BalanceSnapshot.objects.filter(account=OuterRef('account')).order_by('-cutoff').values('cutoff')[:1]
+    snapshots = BalanceSnapshot.objects.filter(cutoff=Subquery(newest))
+    if accounts is not None:
+        snapshots = snapshots.filter(account__in=accounts)
+    return dict(snapshots.values_list('account', 'balance').iterator()), cutoff
+
+
+def take_snapshots(cutoff=None):
+    """
+    Snapshot every account that moved since the last run, as of
+    ``cutoff``, which defaults to ``LEDGER_SNAPSHOT_LAG_SECONDS`` ago so
+    transactions still in flight land after it. Returns the number of
+    snapshots written.
+    """
+    if cutoff is None:
+        cutoff = timezone.now() - timedelta(seconds=settings.LEDGER_SNAPSHOT_LAG_SECONDS)
+    previous = BalanceSnapshot.objects.aggregate(cutoff=Max('cutoff'))['cutoff']
+    if previous is not None and previous >= cutoff:
+        return 0
+
+    entries = LedgerEntry.objects.filter(created_at__lt=cutoff)
+    if previous is not None:
+        entries = entries.filter(created_at__gte=previous)
+    deltas = _deltas(entries)
+    if not deltas:
+        return 0
+    balances, _ = _latest_snapshots(list(deltas))
+
+    BalanceSnapshot.objects.bulk_create([
+        BalanceSnapshot(account=account, balance=balances.get(account, ZERO) + delta, cutoff=cutoff)
+        for account, delta in deltas.items()
+    ], batch_size=1000)
+    return len(deltas)
+
+
+def reconcile():
+    """
+    Check every balance against the ledger: latest snapshot plus the
+    entries since. Returns ``[(account, ledger balance, stored balance)]``
+    for the accounts that disagree. Transfers committing while it runs can
+    show up as transient mismatches, so re-run before acting on one.
+    """
+    expected, cutoff = _latest_snapshots()
+    entries = LedgerEntry.objects.all()
+    if cutoff is not None:
+        entries = entries.filter(created_at__gte=cutoff)
+    for account, delta in _deltas(entries).items():
+        expected[account] = expected.get(account, ZERO) + delta
+
+    stored = defaultdict(lambda: ZERO)
+    for code, amount in LedgerAccount.objects.values_list('code', 'balance'):
+        stored[_account(code)] += amount
+    for user_id, amount in User.objects.values_list('pk', 'wallet_balance').iterator():
+        stored[user_account(user_id)] = amount
+
+    return [
+        (account, expected.get(account, ZERO), stored.get(account, ZERO))
+        for account in sorted(set(expected) | set(stored))
+        if expected.get(account, ZERO) != stored.get(account, ZERO)
+    ]
+
+
+def open_balances():
+    """
+    Book an opening entry from ``external`` for every wallet that holds
+    money but has no ledger entries yet, i.e. balances from before the
+    ledger. Returns the number of entries written.
+    """
+    with transaction.atomic():
+        accounts = set(LedgerEntry.objects.values_list('credit_account', flat=True).distinct())
+        accounts.update(LedgerEntry.objects.values_list('debit_account', flat=True).distinct())
+        users = User.objects.exclude(wallet_balance=0).values_list('pk', 'wallet_balance')
+        entries = []
+        total = ZERO
+        for user_id, amount in users.iterator():
+            if user_account(user_id) in accounts:
+                continue
+            debit, credit = EXTERNAL, user_account(user_id)
+            if amount < 0:
+                debit, credit, amount = credit, debit, -amount
+            entries.append(LedgerEntry(
+                debit_account=debit, credit_account=credit, amount=amount,
+                entry_type='opening', description='Balance before the ledger'
+            ))
+            total += amount if credit != EXTERNAL else -amount
+        LedgerEntry.objects.bulk_create(entries, batch_size=1000)
+        _move(EXTERNAL, -total)
+    return len(entries)
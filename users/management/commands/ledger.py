@@ -0,0 +1,61 @@
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from users import ledger
+
+
+class Command(BaseCommand):
+    help = (
+        'Maintain the double-entry ledger: take balance snapshots (run this '
+        'periodically), reconcile balances, or look up a balance at a time'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--snapshot', action='store_true',
+                            help='Snapshot every account balance')
+        parser.add_argument('--reconcile', action='store_true',
+                            help='Check every balance against the ledger')
+        parser.add_argument('--open-balances', action='store_true',
+                            help='Book opening entries for wallets funded before the ledger')
+        parser.add_argument('--account', help="'user:<id>', 'platform', 'escrow' or 'external'")
+        parser.add_argument('--at', help='ISO timestamp for --account (default: now)')
+
+    def handle(self, *args, **options):
+        if not any(options[name] for name in ('snapshot', 'reconcile', 'open_balances', 'account')):
+            raise CommandError('Nothing to do, see --help')
+
+        if options['open_balances']:
+            self.stdout.write(f'{ledger.open_balances()} opening entries booked')
+
+        if options['snapshot']:
+            start = time.perf_counter()
+            written = ledger.take_snapshots()
+            elapsed = (time.perf_counter() - start) * 1000
+            self.stdout.write(self.style.SUCCESS(f'{written} balances snapshotted in {elapsed:.0f} ms'))
+
+        if options['reconcile']:
+            self.reconcile()
+
+        if options['account']:
+            at = timezone.now()
+            if options['at']:
+                at = datetime.fromisoformat(options['at'])
+                if timezone.is_naive(at):
+                    at = timezone.make_aware(at)
+            self.stdout.write(f'{options["account"]} at {at.isoformat()}: '
+                              f'{ledger.balance_at(options["account"], at)}')
+
+    def reconcile(self):
+        start = time.perf_counter()
+        mismatches = ledger.reconcile()
+        elapsed = (time.perf_counter() - start) * 1000
+        for account, expected, stored in mismatches:
+            self.stdout.write(self.style.ERROR(
+                f'{account}: ledger says {expected}, balance is {stored}'
+            ))
+        if mismatches:
+            raise CommandError(f'{len(mismatches)} accounts do not reconcile ({elapsed:.0f} ms)')
+        self.stdout.write(self.style.SUCCESS(f'All balances reconcile ({elapsed:.0f} ms)'))
@@ -0,0 +1,193 @@
+"""
+JWT authentication for WebSocket connections.
+
+Sockets authenticate with the same access tokens as the REST API, passed
+either as ``?token=<access>`` or as an ``access_token.<access>`` entry in
+the offered subprotocols (browsers cannot set headers on a WebSocket). The
+token subprotocol is moved out of ``scope['subprotocols']`` into
+``scope['token_subprotocol']``. A browser fails any handshake that offered
+subprotocols but got none back, so consumers accept with
+``accept_subprotocol``: the protocol they speak when the client offered it,
+otherwise the token subprotocol.
+
+Verified tokens and users are kept in small TTL/LRU caches, so a reconnect
+storm costs one signature check and one query per user instead of one per
+connection. Tokens are cached no longer than their expiry and users for
+``WS_AUTH_USER_TTL_SECONDS``, so bans and deactivations take effect within
+that window. The user cache holds immutable ``SocketUser`` records rather
+than model instances, since one entry is shared by every socket of that
+user.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .models import User
+
+TOKEN_SUBPROTOCOL_PREFIX = 'access_token.'
+USER_FIELDS = ('pk', 'username', 'is_active', 'is_banned', 'is_staff', 'is_superuser')
+
+
+class SocketUser:
+    """Identity and role of an authenticated socket's user, read-only"""
+
+    __slots__ = ('id', 'username', 'is_active', 'is_banned', 'is_staff', 'is_superuser')
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, pk, username, is_active, is_banned, is_staff, is_superuser):
+        for name, value in zip(self.__slots__, (pk, username, is_active, is_banned, is_staff, is_superuser)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('SocketUser is read-only')
+
+    @property
+    def pk(self):
+        return self.id
+
+    def __repr__(self):
+        return f'<SocketUser {self.id} {self.username}>'
+
+
+def accept_subprotocol(scope, supported=()):
+    """
+    The subprotocol to accept a socket with: the first of ``supported``
+    that the client offered, otherwise the token subprotocol it
+    authenticated with (None when it offered neither)
+    """
+    offered = scope.get('subprotocols') or []
+    for subprotocol in supported:
+        if subprotocol in offered:
+            return subprotocol
+    return scope.get('token_subprotocol')
+
+
+class TTLCache:
+    """Bounded LRU mapping whose entries also expire"""
+
+    def __init__(self, max_size, ttl, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, expires = entry
+            if expires > self.clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        self._entries[key] = (value, self.clock() + ttl)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+        }
+
+
+# Shared by every socket in the process
+token_cache = TTLCache(
+    settings.WS_AUTH_CACHE_SIZE, api_settings.ACCESS_TOKEN_LIFETIME.total_seconds()
+)
+user_cache = TTLCache(settings.WS_AUTH_CACHE_SIZE, settings.WS_AUTH_USER_TTL_SECONDS)
+
+# User lookups in flight, so simultaneous reconnects of one user share a query
+_user_lookups = {}
+_user_queries = 0
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """Populate ``scope['user']`` from a JWT access token"""
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+        raw_token = self.get_raw_token(scope)
+        user = None
+        if raw_token:
+            user = await self.authenticate(raw_token)
+        scope['user'] = user or AnonymousUser()
+        return await super().__call__(scope, receive, send)
+
+    def get_raw_token(self, scope):
+        subprotocols = scope.get('subprotocols') or []
+        for subprotocol in subprotocols:
+            if subprotocol.startswith(TOKEN_SUBPROTOCOL_PREFIX):
+                scope['subprotocols'] = [p for p in subprotocols if p != subprotocol]
+                scope['token_subprotocol'] = subprotocol
+                return subprotocol[len(TOKEN_SUBPROTOCOL_PREFIX):]
+
+        query = parse_qs(scope.get('query_string', b'').decode())
+        tokens = query.get('token')
+        return tokens[0] if tokens else None
+
+    async def authenticate(self, raw_token):
+        """Return the active user for ``raw_token``, or None"""
+        global _user_queries
+        user_id = token_cache.get(raw_token)
+        if user_id is None:
+            try:
+                token = AccessToken(raw_token)
+            except TokenError:
+                return None
+            user_id = token.get(api_settings.USER_ID_CLAIM)
+            if user_id is None:
+                return None
+            token_cache.set(raw_token, user_id, token['exp'] - time.time())
+
+        user = user_cache.get(user_id)
+        if user is None:
+            lookup = _user_lookups.get(user_id)
+            if lookup is None:
+                _user_queries += 1
+                lookup = _user_lookups[user_id] = asyncio.ensure_future(self.get_user(user_id))
+                lookup.add_done_callback(lambda _: _user_lookups.pop(user_id, None))
+            user = await asyncio.shield(lookup)
+            if user is None:
+                return None
+            user_cache.set(user_id, user)
+
+        if not user.is_active or user.is_banned:
+            return None
+        return user
+
+    @database_sync_to_async
+    def get_user(self, user_id):
+        row = User.objects.filter(**{api_settings.USER_ID_FIELD: user_id}).values_list(*USER_FIELDS).first()
+        return SocketUser(*row) if row else None
+
+
+def auth_cache_stats():
+    return {
+        'tokens': token_cache.stats(),
+        'users': user_cache.stats(),
+        'user_queries': _user_queries,
+    }
@@ -1,5 +1,6 @@
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+from django.utils import timezone
 from decimal import Decimal
 
 class User(AbstractUser):
@@ -71,18 +72,20 @@ class User(AbstractUser):
         """Check if user has sufficient balance"""
         return self.wallet_balance >= amount
     
-    def add_balance(self, amount):
-        """Add money to wallet"""
-        self.wallet_balance += Decimal(str(amount))
-        self.save()
-    
-    def deduct_balance(self, amount):
-        """Deduct money from wallet"""
-        if self.can_place_bet(amount):
-            self.wallet_balance -= Decimal(str(amount))
-            self.save()
-            return True
-        return False
+    def add_balance(self, amount, source='external', entry_type='deposit', **kwargs):
+        """Add money to wallet from a ledger account (see users/ledger.py)"""
+        from .ledger import transfer, user_account
+        self.wallet_balance = transfer(source, user_account(self.pk), amount, entry_type, **kwargs)
+    
+    def deduct_balance(self, amount, destination='external', entry_type='withdraw', **kwargs):
+        """Deduct money from wallet to a ledger account; False when the balance is too low"""
+        from .ledger import transfer, user_account
+        from .wallet import InsufficientBalance
+        try:
+            self.wallet_balance = transfer(user_account(self.pk), destination, amount, entry_type, **kwargs)
+        except InsufficientBalance:
+            return False
+        return True
 
 
 class UserActivity(models.Model):
@@ -112,3 +115,83 @@ class UserActivity(models.Model):
     
     def __str__(self):
         return f"{self.user.username} - {self.activity_type} - {self.created_at}"
+
+
+class LedgerAccount(models.Model):
+    """Balance of a platform-owned ledger account; user balances live on User"""
+    PLATFORM = 'platform'
+    ESCROW = 'escrow'
+    EXTERNAL = 'external'
+    
+    code = models.CharField(max_length=32, primary_key=True)
+    balance = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0.00'))
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"{self.code}: {self.balance}"
+
+
+class LedgerEntry(models.Model):
+    """Immutable movement of money from the debit account to the credit account"""
+    ENTRY_TYPES = (
+        ('deposit', 'Deposit'),
+        ('withdraw', 'Withdraw'),
+        ('bet_placed', 'Bet Placed'),
+        ('win', 'Win'),
+        ('commission', 'Commission'),
+        ('refund', 'Refund'),
+        ('opening', 'Opening Balance'),
+    )
+    
+    # Accounts are 'user:<id>' or a LedgerAccount code
+    debit_account = models.CharField(max_length=32, help_text="Account the amount leaves")
+    credit_account = models.CharField(max_length=32, help_text="Account the amount enters")
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    entry_type = models.CharField(max_length=20, choices=ENTRY_TYPES)
+    reference = models.CharField(max_length=64, blank=True, help_text="Game room or tournament")
+    description = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    
+    class Meta:
+        ordering = ['created_at', 'id']
+        verbose_name_plural = "Ledger Entries"
+        indexes = [
+            models.Index(fields=['debit_account', 'created_at']),
+            models.Index(fields=['credit_account', 'created_at']),
+            models.Index(fields=['created_at']),
+        ]
+        constraints = [
+            models.CheckConstraint(check=models.Q(amount__gt=0), name='ledger_entry_amount_positive'),
+            models.CheckConstraint(
+                check=~models.Q(debit_account=models.F('credit_account')),
+                name='ledger_entry_distinct_accounts'
+            ),
+        ]
+    
+    def __str__(self):
+        return f"{self.debit_account} -> {self.credit_account}: {self.amount}"
+    
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("Ledger entries are immutable")
+        super().save(*args, **kwargs)
+    
+    def delete(self, *args, **kwargs):
+        raise ValueError("Ledger entries are immutable")
+
+
+class BalanceSnapshot(models.Model):
+    """Balance of an account including every entry created before ``cutoff``"""
+    account = models.CharField(max_length=32)
+    balance = models.DecimalField(max_digits=14, decimal_places=2)
+    cutoff = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['-cutoff']
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'cutoff'], name='balance_snapshot_account_cutoff'),
+        ]
+    
+    def __str__(self):
+        return f"{self.account} @ {self.cutoff}: {self.balance}"
@@ -62,6 +62,13 @@ class UserProfileSerializer(serializers.ModelSerializer):
             'total_games_won', 'total_amount_won', 'total_amount_lost',
             'is_verified', 'kyc_verified', 'created_at'
         ]
+    
+    def update(self, instance, validated_data):
+        """Save only the edited fields, never a stale copy of the wallet"""
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        instance.save(update_fields=[*validated_data, 'updated_at'])
+        return instance
 
 
 class ChangePasswordSerializer(serializers.Serializer):
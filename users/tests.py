@@ -1,3 +1,156 @@
-from django.test import TestCase
+import threading
+from decimal import Decimal
+from unittest import skipUnless
 
-# Create your tests here.
+from datetime import timedelta
+
+from django.db import connection, connections
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from . import ledger
+from .ledger import ESCROW, EXTERNAL, user_account
+from .models import BalanceSnapshot, LedgerAccount, User
+from .wallet import InsufficientBalance, credit, debit
+
+
+@skipUnless(connection.vendor == 'postgresql', 'needs a database that takes concurrent writers')
+class WalletStressTest(TransactionTestCase):
+    """Hammer one wallet from several threads at once"""
+
+    threads = 8
+    operations = 250
+
+    def setUp(self):
+        self.user = User.objects.create(
+            username='stress', email='stress@example.com', wallet_balance=Decimal('100.00')
+        )
+
+    def run_threads(self, work):
+        errors = []
+
+        def run(worker):
+            try:
+                work(worker)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=run, args=(worker,)) for worker in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_no_drift(self):
+        credited = [Decimal('0.00')] * self.threads
+        debited = [Decimal('0.00')] * self.threads
+
+        def work(worker):
+            for i in range(self.operations):
+                if i % 2:
+                    credit(self.user.pk, '1.25')
+                    credited[worker] += Decimal('1.25')
+                else:
+                    try:
+                        debit(self.user.pk, '2.00')
+                        debited[worker] += Decimal('2.00')
+                    except InsufficientBalance:
+                        pass
+
+        self.run_threads(work)
+        self.user.refresh_from_db()
+        expected = Decimal('100.00') + sum(credited) - sum(debited)
+        self.assertEqual(self.user.wallet_balance, expected)
+        self.assertGreaterEqual(self.user.wallet_balance, 0)
+
+    def test_never_overdrawn(self):
+        User.objects.filter(pk=self.user.pk).update(wallet_balance=Decimal('10.00'))
+        paid = []
+
+        def work(worker):
+            for _ in range(20):
+                try:
+                    debit(self.user.pk, '1.00')
+                    paid.append(worker)
+                except InsufficientBalance:
+                    pass
+
+        self.run_threads(work)
+        self.user.refresh_from_db()
+        self.assertEqual(len(paid), 10)
+        self.assertEqual(self.user.wallet_balance, Decimal('0.00'))
+
+    def test_crossing_transfers(self):
+        other = User.objects.create(
+            username='other', email='other@example.com', wallet_balance=Decimal('100.00')
+        )
+        accounts = [user_account(self.user.pk), user_account(other.pk)]
+
+        def work(worker):
+            # Half the threads pay one way, half the other
+            debit_account, credit_account = accounts if worker % 2 else accounts[::-1]
+            for _ in range(50):
+                ledger.transfer(debit_account, credit_account, '0.01', 'refund')
+                ledger.transfer_many([(credit_account, debit_account, '0.01', 'refund', None)])
+
+        self.run_threads(work)
+        self.assertEqual(ledger.balance(accounts[0]) + ledger.balance(accounts[1]), Decimal('200.00'))
+
+    def test_counters_and_returned_balance(self):
+        self.assertEqual(credit(self.user.pk, '5.50', total_games_won=1), Decimal('105.50'))
+        self.assertEqual(debit(self.user.pk, '105.50'), Decimal('0.00'))
+        with self.assertRaises(InsufficientBalance):
+            debit(self.user.pk, '0.01')
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.total_games_won, 1)
+        self.assertEqual(self.user.wallet_balance, Decimal('0.00'))
+
+
+@override_settings(LEDGER_ACCOUNT_SHARDS=4, LEDGER_SNAPSHOT_LAG_SECONDS=0)
+class LedgerTest(TestCase):
+    """Sharded platform balances and incremental snapshots"""
+
+    def setUp(self):
+        self.users = [
+            User.objects.create(username=f'player{n}', email=f'player{n}@example.com')
+            for n in range(3)
+        ]
+
+    def deposit(self, user, amount):
+        return ledger.transfer(EXTERNAL, user_account(user.pk), amount, 'deposit')
+
+    def test_platform_balance_spans_shards(self):
+        for _ in range(20):
+            self.deposit(self.users[0], '1.00')
+        ledger.transfer(user_account(self.users[0].pk), ESCROW, '5.00', 'bet_placed')
+
+        self.assertEqual(LedgerAccount.objects.filter(code__startswith=EXTERNAL).count(), 4)
+        self.assertEqual(ledger.balance(EXTERNAL), Decimal('-20.00'))
+        self.assertEqual(ledger.balance(ESCROW), Decimal('5.00'))
+        self.assertEqual(ledger.balance(user_account(self.users[0].pk)), Decimal('15.00'))
+        self.assertEqual(ledger.reconcile(), [])
+
+    def test_transfer_returns_user_balance(self):
+        self.assertEqual(self.deposit(self.users[0], '3.00'), Decimal('3.00'))
+        paid = ledger.transfer(user_account(self.users[0].pk), user_account(self.users[1].pk), '1.00', 'win')
+        self.assertEqual(paid, Decimal('1.00'))
+        with self.assertRaises(InsufficientBalance):
+            ledger.transfer(user_account(self.users[2].pk), ESCROW, '1.00', 'bet_placed')
+
+    def test_snapshots_only_changed_accounts(self):
+        for user in self.users:
+            self.deposit(user, '10.00')
+        start = timezone.now()
+        self.assertEqual(ledger.take_snapshots(start), 4)
+
+        self.deposit(self.users[0], '2.50')
+        self.assertEqual(ledger.take_snapshots(start + timedelta(seconds=1)), 2)
+        self.assertEqual(ledger.take_snapshots(start + timedelta(seconds=2)), 0)
+
+        self.assertEqual(BalanceSnapshot.objects.count(), 6)
+        self.assertEqual(ledger.balance_at(user_account(self.users[1].pk), timezone.now()), Decimal('10.00'))
+        self.assertEqual(ledger.balance_at(EXTERNAL, timezone.now()), Decimal('-32.50'))
+        self.assertEqual(ledger.reconcile(), [])
@@ -81,7 +81,7 @@ class LoginView(APIView):
         
         # Update last login IP
         user.last_login_ip = get_client_ip(request)
-        user.save()
+        user.save(update_fields=['last_login_ip'])
         
         # Generate tokens
         refresh = RefreshToken.for_user(user)
@@ -183,7 +183,7 @@ class ChangePasswordView(APIView):
         
         # Set new password
         user.set_password(new_password)
-        user.save()
+        user.save(update_fields=['password'])
         
         # Log activity
         UserActivity.objects.create(
@@ -0,0 +1,106 @@
+"""
+Atomic wallet updates.
+
+Every change to ``User.wallet_balance`` is a single conditional UPDATE
+that does the arithmetic in the database and returns the new balance in
+the same round trip::
+
+    UPDATE users_user SET wallet_balance = wallet_balance - %s, ...
+    WHERE id = %s AND wallet_balance >= %s RETURNING wallet_balance
+
+Concurrent debits and credits therefore never lose updates, a debit can
+never take a balance below zero, and no other column is rewritten. Extra
+counters (``total_games_won=1``) are incremented in the same statement.
+Backends without ``UPDATE ... RETURNING`` fall back to an UPDATE followed
+by a read inside a transaction.
+
+Money should move through ``ledger.transfer``, which calls these and books
+the matching ledger entry.
+"""
+from decimal import Decimal
+
+from django.db import connections, router, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import User
+
+CENT = Decimal('0.01')
+
+
+class InsufficientBalance(Exception):
+    """The wallet does not hold enough for a debit"""
+
+
+def credit(user_id, amount, **counters):
+    """Add ``amount`` to the wallet of ``user_id``; returns the new balance"""
+    balance = _update(user_id, Decimal(str(amount)), counters)
+    if balance is None:
+        raise User.DoesNotExist(f'User {user_id} does not exist')
+    return balance
+
+
+def debit(user_id, amount, **counters):
+    """
+    Take ``amount`` from the wallet of ``user_id``; returns the new balance.
+    Raises InsufficientBalance, leaving the wallet untouched, when the
+    balance is lower than ``amount``.
+    """
+    amount = Decimal(str(amount))
+    balance = _update(user_id, -amount, counters, minimum=amount)
+    if balance is None:
+        raise InsufficientBalance('Insufficient balance')
+    return balance
+
+
+def _update(user_id, delta, counters, minimum=None):
+    db = router.db_for_write(User)
+    connection = connections[db]
+    if connection.vendor not in ('postgresql', 'sqlite') or \
+            not connection.features.can_return_columns_from_insert:
+        return _update_then_read(db, user_id, delta, counters, minimum)
+
+    quote = connection.ops.quote_name
+    column = _column('wallet_balance', quote)
+    assignments = [f'{column} = {column} + %s']
+    params = [delta]
+    for name, value in counters.items():
+        counter = _column(name, quote)
+        assignments.append(f'{counter} = {counter} + %s')
+        params.append(value)
+    assignments.append(f'{_column("updated_at", quote)} = %s')
+    params.append(connection.ops.adapt_datetimefield_value(timezone.now()))
+
+    where = f'{_column("id", quote)} = %s'
+    params.append(user_id)
+    if minimum is not None:
+        where += f' AND {column} >= %s'
+        params.append(minimum)
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'UPDATE {quote(User._meta.db_table)} SET {", ".join(assignments)} '
+            f'WHERE {where} RETURNING {column}',
+            params
+        )
+        row = cursor.fetchone()
+    return None if row is None else Decimal(str(row[0])).quantize(CENT)
+
+
+def _update_then_read(db, user_id, delta, counters, minimum):
+    users = User.objects.using(db).filter(pk=user_id)
+    if minimum is not None:
+        users = users.filter(wallet_balance__gte=minimum)
+    with transaction.atomic(using=db):
+        updated = users.update(
+            wallet_balance=F('wallet_balance') + delta,
+            updated_at=timezone.now(),
+            **{name: F(name) + value for name, value in counters.items()}
+        )
+        if not updated:
+            return None
+        return User.objects.using(db).values_list('wallet_balance', flat=True).get(pk=user_id)
+
+
+def _column(name, quote):
+    return quote(User._meta.get_field(name).column)
@@ -154,6 +154,10 @@ SIMPLE_JWT = {
     'AUTH_HEADER_TYPES': ('Bearer',),
 }
 
+# WebSocket auth caches (users/middleware.py)
+WS_AUTH_CACHE_SIZE = config('WS_AUTH_CACHE_SIZE', default=10000, cast=int)
+WS_AUTH_USER_TTL_SECONDS = config('WS_AUTH_USER_TTL_SECONDS', default=60, cast=int)
+
 # CORS Settings
 CORS_ALLOW_ALL_ORIGINS = DEBUG  # Only in development
 CORS_ALLOWED_ORIGINS = [
@@ -166,7 +170,9 @@ CORS_ALLOW_CREDENTIALS = True
 # Channels (WebSocket) Configuration
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        # Pipelines the sends of each event-loop tick (game/channel_layer.py);
+        # channels_redis.core.RedisChannelLayer sends them one by one
+        'BACKEND': config('CHANNEL_LAYER_BACKEND', default='game.channel_layer.BatchedRedisChannelLayer'),
         'CONFIG': {
             "hosts": [(config('REDIS_HOST', default='127.0.0.1'), 6379)],
         },
@@ -180,18 +186,70 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
+CELERY_BEAT_SCHEDULE = {
+    'process-withdrawals': {
+        'task': 'game.tasks.process_withdrawals',
+        'schedule': config('WITHDRAWAL_INTERVAL_SECONDS', default=60, cast=int),
+    },
+}
 
 # Blockchain Configuration (USDT)
 ETHEREUM_NODE_URL = config('ETHEREUM_NODE_URL', default='https://mainnet.infura.io/v3/YOUR_INFURA_KEY')
 USDT_CONTRACT_ADDRESS = config('USDT_CONTRACT_ADDRESS', default='0xdac17f958d2ee523a2206206994597c13d831ec7')
 PLATFORM_WALLET_ADDRESS = config('PLATFORM_WALLET_ADDRESS', default='')
 PLATFORM_WALLET_PRIVATE_KEY = config('PLATFORM_WALLET_PRIVATE_KEY', default='')
+# Batch-transfer contract with disperseToken(token, recipients, values), approved to spend the platform wallet's USDT
+USDT_DISPERSE_ADDRESS = config('USDT_DISPERSE_ADDRESS', default='')
+# Batched withdrawal payouts (game/withdrawals.py); game.chain.InMemoryChainClient pays nothing out
+WITHDRAWAL_CHAIN_CLIENT = config('WITHDRAWAL_CHAIN_CLIENT', default='game.chain.Web3ChainClient')
+WITHDRAWAL_BATCH_SIZE = config('WITHDRAWAL_BATCH_SIZE', default=100, cast=int)  # recipients per transaction
+WITHDRAWAL_MAX_PER_RUN = config('WITHDRAWAL_MAX_PER_RUN', default=1000, cast=int)
+WITHDRAWAL_CONFIRMATIONS = config('WITHDRAWAL_CONFIRMATIONS', default=12, cast=int)  # blocks before a payout counts as final
 
 # Platform Settings
 PLATFORM_COMMISSION_PERCENTAGE = 2.0  # 2%
 MIN_BET_AMOUNT = 1.0
 MAX_BET_AMOUNT = 1000.0
 MIN_WITHDRAWAL_AMOUNT = 10.0
+LEDGER_SNAPSHOT_LAG_SECONDS = 60  # snapshots leave out entries newer than this (users/ledger.py)
+LEDGER_ACCOUNT_SHARDS = 8  # balance rows per platform account, spreading row locks (users/ledger.py)
+TRANSACTION_PAGE_MAX = 100  # largest ?limit= on the transaction history (game/history.py)
+TRANSACTION_EXPORT_CHUNK = 2000  # rows fetched per round trip by history exports
+# Idempotency-Key replay for money-moving endpoints (game/idempotency.py)
+IDEMPOTENCY_REDIS_URL = config('IDEMPOTENCY_REDIS_URL', default='redis://localhost:6379/4')
+IDEMPOTENCY_TTL_SECONDS = config('IDEMPOTENCY_TTL_SECONDS', default=86400, cast=int)  # responses kept this long
+IDEMPOTENCY_LOCK_SECONDS = 30  # claim on a running request; longer than the slowest request
+IDEMPOTENCY_WAIT_SECONDS = 10  # duplicates wait this long for the first request, then get a 409
+IDEMPOTENCY_POLL_SECONDS = 0.05
+
+# Realtime Settings
+LOBBY_TICK_SECONDS = config('LOBBY_TICK_SECONDS', default=0.2, cast=float)  # lobby update batching
+LOBBY_BET_BANDS = [MIN_BET_AMOUNT, 5.0, 25.0, 100.0, MAX_BET_AMOUNT]  # lobby group boundaries
+TURN_TIMEOUT_SECONDS = config('TURN_TIMEOUT_SECONDS', default=30, cast=int)  # auto-play after this
+TURN_TIMEOUT_FORFEIT = config('TURN_TIMEOUT_FORFEIT', default=3, cast=int)  # expired turns in a row that forfeit
+MATCHMAKING_REDIS_URL = config('MATCHMAKING_REDIS_URL', default='redis://localhost:6379/1')
+# Incoming game frames, (tokens per second, burst) per message type; 'frame'
+# covers every frame before parsing. Types not listed are unlimited.
+WS_RATE_LIMITS = {
+    'frame': (10, 30),
+    'roll_dice': (2, 5),
+    'move_piece': (2, 5),
+    'chat_message': (1, 5),
+    'client_seed': (0.2, 2),
+}
+WS_ROOM_RATE_LIMITS = {
+    'roll_dice': (4, 10),
+    'move_piece': (4, 10),
+    'chat_message': (3, 15),
+}
+WS_RATE_LIMIT_STRIKES = (1, 20)  # dropped frames forgiven per second, and before disconnecting
+WS_MAX_FRAME_BYTES = 4096
+REPLAY_REDIS_URL = config('REPLAY_REDIS_URL', default='redis://localhost:6379/2')
+REPLAY_CHECKPOINT_INTERVAL = config('REPLAY_CHECKPOINT_INTERVAL', default=50, cast=int)  # moves between checkpoints
+# Pin each room to one worker of a multi-process deployment (game/affinity.py)
+ROOM_AFFINITY = config('ROOM_AFFINITY', default=False, cast=bool)
+WORKER_ID = config('WORKER_ID', default='')  # defaults to hostname-pid
+AFFINITY_REDIS_URL = config('AFFINITY_REDIS_URL', default='redis://localhost:6379/3')
 
 # Email Configuration (for notifications)
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'